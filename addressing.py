@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+# Chargers are identified by their port number.
+# On a charger port the port itself selects the charger.
+# On a multiplexed port many chargers share one socket and are addressed by
+# - a path prefix: /c/<id>/status -> charger <id>, path /status
+# - a host header: Host: c<id>.chargersim.local -> charger <id>
+
+PATH_PREFIX = "/c/"
+HOST_PREFIX = "c"
+
+
+def _parse_id(text):
+    return int(text) if text.isdigit() else None
+
+
+def _id_from_path(path):
+    if not path.startswith(PATH_PREFIX):
+        return None, path
+    charger_id, sep, rest = path[len(PATH_PREFIX):].partition("/")
+    return _parse_id(charger_id), (sep + rest) or "/"
+
+
+def _id_from_host(host):
+    if not host:
+        return None
+    label = host.split(":", 1)[0].split(".", 1)[0]
+    if not label.startswith(HOST_PREFIX):
+        return None
+    return _parse_id(label[len(HOST_PREFIX):])
+
+
+def resolve_charger(chargers, mux_ports, port, path, host=None):
+    """Determine the addressed charger and the device local path of a request.
+
+    Returns (None, path) if no charger matches.
+    """
+    if port not in mux_ports:
+        return chargers.get(port), path
+
+    charger_id, local_path = _id_from_path(path)
+    if charger_id is None:
+        charger_id = _id_from_host(host)
+        local_path = path
+    if charger_id is None:
+        return None, path
+    return chargers.get(charger_id), local_path
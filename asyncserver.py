@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+import asyncio
+import logging
+import time
+from http import HTTPStatus
+from urllib.parse import parse_qs
+
+from addressing import resolve_charger
+import clock
+import metrics
+
+
+class AsyncHttpServer:
+    """HTTP front-end serving all charger ports from one asyncio event loop.
+
+    Requests are dispatched to the same handle_get_data/handle_post_data methods
+    the blocking HttpRequestHandler uses, so device classes work unchanged.
+    Connections are kept alive and pipelined requests are answered in order.
+    """
+    REQUEST_TIMEOUT = 10   # seconds to receive a complete request
+    KEEP_ALIVE_TIMEOUT = 15  # seconds a connection may stay idle between requests
+    MAX_KEEP_ALIVE_REQUESTS = 1000  # requests per connection
+    MAX_HEADER_LINES = 100
+
+    def __init__(self, chargers, mux_ports=(), fleet=None, admin_routes=None, recorder=None, admin_post_routes=None,
+                 faults=None):
+        self.chargers = chargers  # handle to the correspondig chargers, by id
+        self.mux_ports = set(mux_ports)  # ports shared by all chargers
+        self.fleet = fleet
+        self.recorder = recorder
+        self.admin_routes = admin_routes or {}  # simulator wide GET handlers on the multiplexed ports, called with the query
+        self.admin_post_routes = admin_post_routes or {}  # simulator wide POST handlers, with the query and the body
+        self.faults = faults  # FaultInjector, see faults.py
+        self.servers = []
+
+    async def start(self, ports, host=None):
+        for port in ports:
+            server = await asyncio.start_server(self._handle_connection, host, port, reuse_address=True)
+            self.servers.append(server)
+        logging.info("serving %d ports via asyncio", len(self.servers))
+
+    def close(self):
+        for server in self.servers:
+            server.close()
+        self.servers = []
+
+    async def _read_request(self, reader, request_line):
+        method, path, version = request_line.decode("latin-1").split()
+
+        headers = {}
+        for _ in range(self.MAX_HEADER_LINES):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise ValueError("too many header lines")
+
+        content_length = int(headers.get("content-length", 0))
+        body = await reader.readexactly(content_length) if content_length else b""
+        return method, path, version, headers, body
+
+    def _dispatch_admin(self, port, method, path, body):
+        route, _, query = path.partition("?")
+        routes = self.admin_routes if method == "GET" else self.admin_post_routes
+        if port not in self.mux_ports or route not in routes:
+            return HTTPStatus.NOT_FOUND, "", "text/plain", None
+        args = (parse_qs(query),) if method == "GET" else (parse_qs(query), body)
+        try:
+            response, content_type = routes[route](*args)
+        except ValueError as exc:
+            return HTTPStatus.BAD_REQUEST, "{}\n".format(exc), "text/plain", None
+        return HTTPStatus.OK, response, content_type, None
+
+    def _dispatch(self, port, method, path, headers, body):
+        """Returns status, content, content type and entity tag of the response.
+
+        Content is an iterator or asynchronous iterator of chunks for streamed responses.
+        """
+        start = time.perf_counter()
+        charger, path = resolve_charger(self.chargers, self.mux_ports, port, path, headers.get("host"))
+        if charger is None:
+            with clock.frozen():
+                return self._dispatch_admin(port, method, path, body)
+        with clock.frozen():
+            records = b""
+            if self.recorder is not None:
+                try:
+                    records = self.recorder.encode_request(charger, method, path, body)
+                except ValueError as exc:
+                    return HTTPStatus.BAD_REQUEST, "{}\n".format(exc), "text/plain", None
+            result = self._dispatch_charger(charger, method, path, headers, body)
+            if records:
+                self.recorder.write(records)
+        metrics.observe_request(type(charger).__name__, charger.get_route_key(method, path),
+                                time.perf_counter() - start)
+        return result
+
+    def _dispatch_charger(self, charger, method, path, headers, body):
+        if self.fleet is not None:
+            self.fleet.before_request(charger)
+        if method == "GET":
+            etag = charger.get_etag(path)
+            if etag is not None and etag in headers.get("if-none-match", ""):
+                return HTTPStatus.NOT_MODIFIED, "", None, etag
+            response, content_type = charger.handle_get_data(path)
+            return HTTPStatus.OK, response, content_type, etag
+        if method in ("POST", "PUT"):
+            response, content_type = charger.handle_post_data(path, body)
+            return HTTPStatus.OK, response, content_type, None
+        return HTTPStatus.NOT_IMPLEMENTED, "", "text/plain", None
+
+    def _draw_fault(self, port, method, path, headers):
+        if self.faults is None or not self.faults.active:
+            return None
+        with clock.frozen():
+            # may instantiate a lazy charger
+            charger, local_path = resolve_charger(self.chargers, self.mux_ports, port, path, headers.get("host"))
+        if charger is None:
+            return None
+        return self.faults.decide(charger._id, method, local_path)
+
+    @staticmethod
+    def _encode_response(status, content, content_type, etag=None, keep_alive=False):
+        if isinstance(content, str):
+            content = content.encode("utf8")
+        header = "HTTP/1.1 {} {}\r\n".format(status.value, status.phrase)
+        if content_type is not None:
+            header += "Content-type: {}\r\n".format(content_type)
+        if etag is not None:
+            header += "ETag: {}\r\n".format(etag)
+        if content is None:
+            header += "Transfer-Encoding: chunked\r\n"
+        else:
+            header += "Content-Length: {}\r\n".format(len(content))
+        header += "Connection: {}\r\n\r\n".format("keep-alive" if keep_alive else "close")
+        return header.encode("latin-1") + (content or b"")
+
+    @staticmethod
+    async def _write_chunks(writer, chunks):
+        if hasattr(chunks, "__aiter__"):
+            # event streams end when the client disconnects
+            try:
+                async for chunk in chunks:
+                    writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    await writer.drain()
+            finally:
+                await chunks.aclose()
+            return
+        chunks = iter(chunks)
+        while True:
+            with clock.frozen():
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            # the chargers may tick while the client reads
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+
+    @staticmethod
+    def _is_keep_alive(version, headers):
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    async def _handle_connection(self, reader, writer):
+        port = writer.get_extra_info("sockname")[1]
+        try:
+            for nr_request in range(1, self.MAX_KEEP_ALIVE_REQUESTS + 1):
+                request_line = await asyncio.wait_for(reader.readline(), self.KEEP_ALIVE_TIMEOUT)
+                if not request_line:
+                    break
+                method, path, version, headers, body = await asyncio.wait_for(
+                    self._read_request(reader, request_line), self.REQUEST_TIMEOUT)
+                keep_alive = self._is_keep_alive(version, headers) and nr_request < self.MAX_KEEP_ALIVE_REQUESTS
+                fault = self._draw_fault(port, method, path, headers)
+                if fault is not None:
+                    # only this connection waits, the other connections and the ticks go on
+                    if fault.delay:
+                        await asyncio.sleep(fault.delay)
+                    if fault.close:
+                        await asyncio.sleep(fault.hold)
+                        break
+                if fault is not None and fault.response is not None:
+                    # not dispatched to the charger, and thus not recorded either
+                    status, content, content_type, etag = fault.response
+                else:
+                    try:
+                        status, content, content_type, etag = self._dispatch(port, method, path, headers, body)
+                    except Exception:
+                        logging.exception("error handling %s %s on port %d", method, path, port)
+                        status, content, content_type, etag = HTTPStatus.INTERNAL_SERVER_ERROR, "", "text/plain", None
+                    if fault is not None and fault.remember:
+                        self.faults.remember(fault, (status, content, content_type, etag))
+                if isinstance(content, (str, bytes)):
+                    writer.write(self._encode_response(status, content, content_type, etag, keep_alive))
+                else:
+                    writer.write(self._encode_response(status, None, content_type, etag, keep_alive))
+                    await self._write_chunks(writer, content)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ValueError as exc:
+            logging.warning("malformed request on port %d: %s", port, exc)
+            writer.write(self._encode_response(HTTPStatus.BAD_REQUEST, "", "text/plain"))
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+# Minimal WebSocket (RFC 6455) connections on asyncio streams, for text messages
+# as used by OCPP-J. Control frames are answered internally, fragmented messages
+# are reassembled. Client frames are masked, server frames are not.
+
+import asyncio
+import base64
+import hashlib
+import os
+import ssl
+import struct
+from urllib.parse import urlsplit
+
+_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+CONTINUATION, TEXT, BINARY, CLOSE, PING, PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+
+
+class ConnectionClosed(Exception):
+    pass
+
+
+def _accept_key(key):
+    return base64.b64encode(hashlib.sha1((key + _GUID).encode("ascii")).digest()).decode("ascii")
+
+
+def _mask(data, mask):
+    # xor of the whole payload at once as big integers
+    length = len(data)
+    key = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(data, "big") ^ int.from_bytes(key, "big")).to_bytes(length, "big")
+
+
+class WebSocket:
+    MAX_MESSAGE_SIZE = 1 << 20
+
+    def __init__(self, reader, writer, client, subprotocol=None):
+        self.reader = reader
+        self.writer = writer
+        self.client = client  # clients mask their frames
+        self.subprotocol = subprotocol
+        self.closed = False
+
+    def _write_frame(self, opcode, payload):
+        length = len(payload)
+        mask_bit = 0x80 if self.client else 0
+        if length < 126:
+            header = struct.pack(">BB", 0x80 | opcode, mask_bit | length)
+        elif length < 1 << 16:
+            header = struct.pack(">BBH", 0x80 | opcode, mask_bit | 126, length)
+        else:
+            header = struct.pack(">BBQ", 0x80 | opcode, mask_bit | 127, length)
+        if self.client:
+            mask = os.urandom(4)
+            header += mask
+            payload = _mask(payload, mask)
+        self.writer.write(header + payload)
+
+    def send(self, text):
+        """Queues a text message, the pending size is get_write_buffer_size()."""
+        if self.closed:
+            raise ConnectionClosed()
+        self._write_frame(TEXT, text.encode("utf8"))
+
+    def get_write_buffer_size(self):
+        return self.writer.transport.get_write_buffer_size()
+
+    async def _read_frame(self):
+        first, second = await self.reader.readexactly(2)
+        length = second & 0x7F
+        if length == 126:
+            length, = struct.unpack(">H", await self.reader.readexactly(2))
+        elif length == 127:
+            length, = struct.unpack(">Q", await self.reader.readexactly(8))
+        if length > self.MAX_MESSAGE_SIZE:
+            raise ConnectionClosed("frame too large")
+        mask = await self.reader.readexactly(4) if second & 0x80 else None
+        payload = await self.reader.readexactly(length)
+        if mask is not None:
+            payload = _mask(payload, mask)
+        return first & 0x80, first & 0x0F, payload
+
+    async def recv(self):
+        """Next text message, raises ConnectionClosed when the connection got closed."""
+        fragments = []
+        size = 0
+        while True:
+            try:
+                final, opcode, payload = await self._read_frame()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self.closed = True
+                raise ConnectionClosed()
+            if opcode == PING:
+                self._write_frame(PONG, payload)
+            elif opcode == PONG:
+                pass
+            elif opcode == CLOSE:
+                if not self.closed:
+                    self._write_frame(CLOSE, payload[:2])
+                self.closed = True
+                raise ConnectionClosed()
+            else:
+                fragments.append(payload)
+                size += len(payload)
+                if size > self.MAX_MESSAGE_SIZE:
+                    raise ConnectionClosed("message too large")
+                if final:
+                    return b"".join(fragments).decode("utf8")
+
+    def close(self, code=1000):
+        if not self.closed:
+            self.closed = True
+            try:
+                self._write_frame(CLOSE, struct.pack(">H", code))
+            except (ConnectionError, RuntimeError):
+                pass
+        self.writer.close()
+
+
+async def _read_headers(reader):
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            return headers
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+
+async def connect(url, subprotocol=None):
+    """Opens a client connection to a ws:// or wss:// URL."""
+    parts = urlsplit(url)
+    secure = parts.scheme == "wss"
+    port = parts.port or (443 if secure else 80)
+    reader, writer = await asyncio.open_connection(
+        parts.hostname, port, ssl=ssl.create_default_context() if secure else None)
+    key = base64.b64encode(os.urandom(16)).decode("ascii")
+    request = [
+        "GET {} HTTP/1.1".format(parts.path or "/"),
+        "Host: {}:{}".format(parts.hostname, port),
+        "Upgrade: websocket",
+        "Connection: Upgrade",
+        "Sec-WebSocket-Key: " + key,
+        "Sec-WebSocket-Version: 13",
+    ]
+    if subprotocol is not None:
+        request.append("Sec-WebSocket-Protocol: " + subprotocol)
+    writer.write(("\r\n".join(request) + "\r\n\r\n").encode("latin-1"))
+    try:
+        status_line = await reader.readline()
+        headers = await _read_headers(reader)
+        if status_line.split()[1:2] != [b"101"] or headers.get("sec-websocket-accept") != _accept_key(key):
+            raise ConnectionError("WebSocket handshake failed: {}".format(status_line.decode("latin-1").strip()))
+    except BaseException:
+        writer.close()
+        raise
+    return WebSocket(reader, writer, True, headers.get("sec-websocket-protocol"))
+
+
+async def accept(reader, writer, subprotocols=()):
+    """Answers the opening handshake of a client, returns the connection and the requested path."""
+    request_line = await reader.readline()
+    headers = await _read_headers(reader)
+    parts = request_line.decode("latin-1").split()
+    key = headers.get("sec-websocket-key")
+    if len(parts) != 3 or parts[0] != "GET" or key is None or \
+            headers.get("upgrade", "").lower() != "websocket":
+        writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        writer.close()
+        raise ConnectionClosed("no WebSocket handshake")
+    requested = [name.strip() for name in headers.get("sec-websocket-protocol", "").split(",")]
+    subprotocol = next((name for name in requested if name in subprotocols), None)
+    response = [
+        "HTTP/1.1 101 Switching Protocols",
+        "Upgrade: websocket",
+        "Connection: Upgrade",
+        "Sec-WebSocket-Accept: " + _accept_key(key),
+    ]
+    if subprotocol is not None:
+        response.append("Sec-WebSocket-Protocol: " + subprotocol)
+    writer.write(("\r\n".join(response) + "\r\n\r\n").encode("latin-1"))
+    return WebSocket(reader, writer, False, subprotocol), parts[1]
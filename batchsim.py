@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+# Headless batch simulation.
+# Runs the charger state machines of a fleet over a simulated period without
+# any sockets and streams the per-tick time series to a CSV or Parquet file.
+
+import logging
+import traceback
+import argparse
+import csv
+import itertools
+from datetime import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import clock
+import rng
+from charger import Charger
+from fleet import ENGINES, SAMPLE_COLUMNS
+
+
+class CsvSeriesWriter:
+    def __init__(self, path, columns):
+        self._file = open(path, 'w', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(columns)
+
+    def write(self, chunk):
+        self._writer.writerows(zip(*chunk.values()))
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetSeriesWriter:
+    def __init__(self, path, columns):
+        # pyarrow is only required for parquet output
+        import pyarrow
+        import pyarrow.parquet
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self._path = path
+        self._writer = None
+
+    def write(self, chunk):
+        table = self._pa.table(chunk)
+        if self._writer is None:
+            self._writer = self._pq.ParquetWriter(self._path, table.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+class BatchSim:
+    WRITERS = {
+        "csv": CsvSeriesWriter,
+        "parquet": ParquetSeriesWriter,
+    }
+    COLUMNS = ('time', 'charger') + SAMPLE_COLUMNS
+    NR_PHASES = [3, 1, 3, 2, 3]
+
+    def __init__(self, nr_chargers, engine="python", session_start=-1, step=1, start=None, seed=None):
+        self.step = step  # simulated seconds per tick
+        self.clock = clock.SteppedClock(start)
+        clock.set_clock(self.clock)
+        if seed is not None:
+            rng.set_seed(seed)
+
+        self.fleet = ENGINES[engine]()
+        for i in range(nr_chargers):
+            self.fleet.add(Charger(session_start, self.NR_PHASES[i % len(self.NR_PHASES)]))
+        self._charger_ids = list(range(nr_chargers))
+
+    @staticmethod
+    def _concat(parts):
+        if np is not None and isinstance(parts[0], np.ndarray):
+            return np.concatenate(parts)
+        return list(itertools.chain.from_iterable(parts))
+
+    def _flush(self, writer, buffer):
+        chunk = {name: self._concat(parts) for name, parts in buffer.items()}
+        writer.write(chunk)
+        for parts in buffer.values():
+            parts.clear()
+
+    def run(self, duration, output, file_format="csv", chunk_rows=100000):
+        """Simulate duration seconds and write the time series to output.
+
+        At most chunk_rows rows are kept in memory before they are written.
+        """
+        writer = self.WRITERS[file_format](output, self.COLUMNS)
+        buffer = {name: [] for name in self.COLUMNS}
+        nr_ticks = int(duration / self.step)
+        nr_rows = 0
+        try:
+            for _ in range(nr_ticks):
+                self.fleet.tick()
+                sample = self.fleet.sample()
+                buffer['time'].append([self.clock.timestamp()] * len(self._charger_ids))
+                buffer['charger'].append(self._charger_ids)
+                for name in SAMPLE_COLUMNS:
+                    buffer[name].append(sample[name])
+                nr_rows += len(self._charger_ids)
+                if nr_rows >= chunk_rows:
+                    self._flush(writer, buffer)
+                    nr_rows = 0
+                self.clock.advance(self.step)
+            if nr_rows:
+                self._flush(writer, buffer)
+        finally:
+            writer.close()
+        logging.info("simulated %d ticks of %d chargers", nr_ticks, len(self._charger_ids))
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Headless batch simulation of a charger fleet.")
+    parser.add_argument("--chargers", type=int, default=100, help="number of simulated chargers")
+    parser.add_argument("--hours", type=float, default=24, help="simulated duration")
+    parser.add_argument("--step", type=float, default=1, help="simulated seconds per tick")
+    parser.add_argument("--start", type=datetime.fromisoformat, help="simulated start time, ISO format")
+    parser.add_argument("--session-start", type=float, default=-1,
+                        help="minute of the hour sessions start, negative for a random timing factor")
+    parser.add_argument("--engine", choices=list(ENGINES), default="python")
+    parser.add_argument("--seed", type=int, help="seed of all random values, the run is repeatable")
+    parser.add_argument("--format", choices=list(BatchSim.WRITERS), default="csv")
+    parser.add_argument("--chunk-rows", type=int, default=100000, help="rows buffered before writing")
+    parser.add_argument("output", help="output file")
+    return parser.parse_args(args)
+
+
+def main():
+    try:
+        args = parse_args()
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+        batchsim = BatchSim(args.chargers, args.engine, args.session_start, args.step, args.start, args.seed)
+        batchsim.run(args.hours * 3600, args.output, args.format, args.chunk_rows)
+    except Exception as exc:
+        logging.error("raised exception: {}".format(traceback.format_exc()))
+        raise
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+# Microbenchmarks of the simulator hot paths.
+
+import argparse
+import json
+import random
+import struct
+import time
+
+import clock
+from charger import ChargerState
+from devicegoe import DeviceGoe
+from devicecircontrol import DeviceCircontrol
+from fleet import Fleet, NumpyFleet, EventFleet, np
+from fleetconfig import FleetConfig, ChargerMap
+from modbusserver import ModbusServer
+
+
+def _create_chargers(cls, nr_chargers):
+    chargers = []
+    for i in range(nr_chargers):
+        charger = cls(-1, [3, 1, 3, 2, 3][i % 5])
+        charger.state = random.choice(list(ChargerState))
+        charger.update_state()
+        chargers.append(charger)
+    return chargers
+
+
+def _measure(name, func, chargers, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for charger in chargers:
+            func(charger)
+    duration = time.perf_counter() - start
+    calls = rounds * len(chargers)
+    print("{:<40} {:>10.0f} calls/s {:>8.2f} us/call".format(name, calls / duration, 1e6 * duration / calls))
+    return calls / duration
+
+
+def bench_goe_status(nr_chargers, rounds):
+    chargers = _create_chargers(DeviceGoe, nr_chargers)
+    for charger in chargers:
+        assert charger._get_status() == json.dumps(charger._get_status_dict()).encode()
+
+    legacy = _measure("go-e /status json.dumps", lambda c: json.dumps(c._get_status_dict()).encode(),
+                      chargers, rounds)
+    fast = _measure("go-e /status pre-encoded", lambda c: c.handle_get_data("/status"), chargers, rounds)
+    print("speedup {:.1f}x".format(fast / legacy))
+
+
+def bench_update_state(nr_chargers, rounds):
+    chargers = _create_chargers(DeviceGoe, nr_chargers)
+    _measure("charger update_state", lambda c: c.update_state(), chargers, rounds)
+
+
+def bench_device_get(nr_chargers, rounds):
+    goe_chargers = _create_chargers(DeviceGoe, nr_chargers)
+    _measure("go-e GET /status", lambda c: c.handle_get_data("/status"), goe_chargers, rounds)
+    circontrol_chargers = _create_chargers(DeviceCircontrol, nr_chargers)
+    path = "/services/cpi/chargeState.xml"
+    _measure("circontrol GET chargeState cached", lambda c: c.handle_get_data(path), circontrol_chargers, rounds)
+
+    def uncached(charger):
+        charger._cache_key = None
+        charger.handle_get_data(path)
+    _measure("circontrol GET chargeState uncached", uncached, circontrol_chargers, rounds)
+
+
+def bench_fleet_tick(nr_chargers, rounds):
+    engines = [("python", Fleet), ("event", EventFleet)]
+    if np is not None:
+        engines.insert(1, ("numpy", NumpyFleet))
+    for name, engine in engines:
+        fleet = engine()
+        for charger in _create_chargers(DeviceGoe, nr_chargers):
+            fleet.add(charger)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            fleet.tick()
+            clock.get_clock().advance(1)
+        duration = time.perf_counter() - start
+        print("{:<40} {:>10.0f} chargers/s {:>6.2f} ms/tick".format(
+            "fleet tick " + name, rounds * nr_chargers / duration, 1000 * duration / rounds))
+
+
+def bench_modbus_read(nr_chargers, rounds):
+    chargers = _create_chargers(DeviceGoe, nr_chargers)
+    config = FleetConfig.from_dict({"groups": [{"device": "goe", "count": nr_chargers}]})
+
+    def create(group, charger_id):
+        # the prepared chargers, without dump files
+        charger = chargers[charger_id - group.first_id]
+        charger._id = charger_id
+        return charger
+    charger_map = ChargerMap(config, create)
+    for charger_id in charger_map:
+        charger_map[charger_id]
+    server = ModbusServer(charger_map, port=0)
+    start = time.perf_counter()
+    server.on_tick()
+    duration = time.perf_counter() - start
+    print("{:<40} {:>10.0f} chargers/s {:>6.2f} ms/tick".format(
+        "modbus register refresh", nr_chargers / duration, 1000 * duration))
+
+    # frame per charger reading all registers
+    frames = {}
+    for slot, charger in enumerate(chargers):
+        port, unit = divmod(slot, ModbusServer.UNITS_PER_PORT)
+        frames[id(charger)] = port, struct.pack(">HHHBBHH", 1, 0, 6, unit + 1, 3, 0, ModbusServer.NR_REGISTERS)
+    http = _measure("go-e HTTP GET /status", lambda c: c.handle_get_data("/status"), chargers, rounds)
+    modbus = _measure("modbus read all registers", lambda c: server.handle_frame(*frames[id(c)]),
+                      chargers, rounds)
+    print("speedup {:.1f}x".format(modbus / http))
+
+
+BENCHMARKS = {
+    "goe_status": bench_goe_status,
+    "update_state": bench_update_state,
+    "device_get": bench_device_get,
+    "fleet_tick": bench_fleet_tick,
+    "modbus_read": bench_modbus_read,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the simulator hot paths.")
+    parser.add_argument("benchmarks", nargs="*",
+                        help="benchmarks to run, default all of: " + ", ".join(BENCHMARKS))
+    parser.add_argument("--chargers", type=int, default=2000, help="number of simulated chargers")
+    parser.add_argument("--rounds", type=int, default=10, help="polls of each charger")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: " + name)
+
+    clock.set_clock(clock.SteppedClock())
+    for name in args.benchmarks or BENCHMARKS:
+        BENCHMARKS[name](args.chargers, args.rounds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+# Bulk access to many chargers with a single request on the multiplexed ports:
+# - GET /bulk/status[?ids=8100-8119,8150] streams the status of the selected, or of
+#   all instantiated chargers, as one JSON line per charger in a chunked response
+# - POST /bulk/current with a JSON object {"<id>": <current in A or null>, ...} sets
+#   the current limits of all given chargers at once, between two ticks.
+#   Nothing is changed if any entry is invalid.
+
+import json
+
+
+def parse_ids(text, fleet_config):
+    """Charger ids of a list of ids and id ranges, e.g. 8100-8119,8150, clipped to the fleet groups.
+
+    Raises ValueError for a range without any charger of the fleet, so the number
+    of ids is bounded by the fleet and not by the requested ranges.
+    """
+    ids = []
+    for part in text.split(","):
+        first, _, last = part.partition("-")
+        try:
+            first, last = int(first), int(last or first)
+        except ValueError:
+            raise ValueError("invalid charger ids: {}".format(part))
+        nr_ids = len(ids)
+        for group in fleet_config.groups:
+            ids.extend(range(max(first, group.first_id), min(last + 1, group.first_id + group.count)))
+        if len(ids) == nr_ids:
+            raise ValueError("charger ids outside the fleet: {}".format(part))
+        if len(ids) > len(fleet_config):
+            raise ValueError("more charger ids than chargers in the fleet")
+    return ids
+
+
+class BulkApi:
+    CHUNK_SIZE = 256  # chargers per chunk of the status stream
+    CONTENT_TYPE = "application/x-ndjson"
+
+    def __init__(self, chargers, fleet=None, recorder=None):
+        self.chargers = chargers  # handle to the correspondig chargers, by id
+        self.fleet = fleet
+        self.recorder = recorder
+
+    def _get_status(self, charger):
+        if self.fleet is not None:
+            self.fleet.before_request(charger)
+        if self.recorder is not None:
+            # sampling on access draws random values
+            self.recorder.record_request(charger, "GET", "/bulk/status", b"")
+        return json.dumps({
+            'id': charger._id,
+            'device': type(charger).__name__,
+            'state': charger.state.name,
+            'req_max_i': charger.req_max_i,
+            'charger_current': charger.charger_current,
+            'cur_power': charger.cur_power,
+            'cur_i': charger.cur_i,
+            'e_session': charger.e_session,
+            'e_total': charger.e_total,
+        })
+
+    def _stream_status(self, ids):
+        # each chunk is produced on demand by the front-end, chargers may tick in between
+        if ids is None:
+            chargers = list(self.chargers.instantiated())
+        else:
+            chargers = [self.chargers[charger_id] for charger_id in ids if charger_id in self.chargers]
+        for pos in range(0, len(chargers), self.CHUNK_SIZE):
+            lines = [self._get_status(charger) for charger in chargers[pos:pos + self.CHUNK_SIZE]]
+            yield ("\n".join(lines) + "\n").encode("utf8")
+
+    def handle_status_request(self, query):
+        """Admin endpoint, status of the ?ids=<id>[-<id>],... or of all chargers as chunks of JSON lines."""
+        ids = parse_ids(query["ids"][0], self.chargers.config) if "ids" in query else None
+        return self._stream_status(ids), self.CONTENT_TYPE
+
+    def handle_current_request(self, query, post_data):
+        """Admin POST endpoint, sets the current limits of many chargers."""
+        try:
+            limits = json.loads(post_data)
+        except ValueError:
+            raise ValueError("invalid JSON")
+        if not isinstance(limits, dict):
+            raise ValueError("expected an object of charger ids and currents")
+
+        # validate all entries before changing any charger
+        changes = []
+        for charger_id, current in limits.items():
+            charger_id = int(charger_id) if charger_id.isdigit() else charger_id
+            if charger_id not in self.chargers:
+                raise ValueError("unknown charger: {}".format(charger_id))
+            if current is not None and (not isinstance(current, int) or isinstance(current, bool) or
+                                        not self.chargers[charger_id].is_valid_current(current)):
+                raise ValueError("invalid current of charger {}: {}".format(charger_id, current))
+            changes.append((self.chargers[charger_id], current))
+
+        for charger, current in changes:
+            if self.fleet is not None:
+                # energy up to now is integrated with the current before the change
+                self.fleet.before_request(charger)
+            charger.req_max_i = current
+            if self.recorder is not None:
+                self.recorder.record_current(charger)
+        return json.dumps({'updated': len(changes)}), "application/json"
@@ -3,12 +3,17 @@
 # Author: Roman Morawek <rmorawek@embyt.com>
 
 import logging
-import random
 import json
 import os.path
-from datetime import datetime, timedelta
+import time
+from datetime import datetime
 from enum import Enum
 
+import clock
+import metrics
+import rng
+import routes
+
 
 class ChargerState(Enum):
     IDLE, PLUGGED_BEFORE_CHARGE, CHARGING, STOPPED_AFTER_CHARGING, \
@@ -25,64 +30,147 @@ STATE_TIMES = [
 ]
 
 
+# charger attributes kept in fleet columns
+FLEET_FIELDS = ('state', 'last_start', 'next_state_change', 'req_max_i', 'e_total', 'e_session',
+                'charger_current', 'cur_power', 'cur_i', 'cur_u', 'nr_phases', '_last_update')
+
+# fleet fields holding epoch seconds, dumped in ISO format
+TIMESTAMP_FIELDS = ('last_start', 'next_state_change', '_last_update')
+
+
+def parse_timestamp(text):
+    return datetime.fromisoformat(text).timestamp()
+
+
+def format_timestamp(timestamp):
+    return datetime.fromtimestamp(timestamp).isoformat(timespec='seconds')
+
+
+# value of fleet fields never set
+_UNSET = object()
+
+
+class _FleetField:
+    """Charger attribute stored in a fleet column while the charger is part of a fleet.
+
+    Otherwise the value is kept in the slot "_f_<name>" of the charger.
+    """
+
+    def __init__(self, default=None):
+        self.default = default
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        slot = owner.__dict__["_f_" + name]
+        self._get_slot = slot.__get__
+        self._set_slot = slot.__set__
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        if obj._fleet is not None:
+            return obj._fleet.get_value(self.name, obj._index)
+        value = self._get_slot(obj)
+        return self.default if value is _UNSET else value
+
+    def __set__(self, obj, value):
+        if obj._fleet is not None:
+            obj._fleet.set_value(self.name, obj._index, value)
+        else:
+            self._set_slot(obj, value)
+
+    def __delete__(self, obj):
+        self._set_slot(obj, _UNSET)
+
+
 class Charger:
+    __slots__ = ('_session_start', '_config_file_path', '_id', '_fleet', '_index', '_meter', 'auth_user') + \
+        tuple("_f_" + name for name in FLEET_FIELDS)
+
     # constant settings
     _DEV_MAX_I = 32  # A
+    _NOMINAL_U = 230  # V
 
-    # config settings
+    # config setting _session_start:
     # a positive session start describes the minute when above sequence starts
     # a negative session start gives the random factor to apply for charge timing
-    _session_start = 0
-    _config_file_path = None
-
-    # internal data
-    state = ChargerState.IDLE
-    last_start = None
-    next_state_change = None
-    req_max_i = None
-    e_total = 0       # kWh, total energy
-    e_session = 0     # kWh, session energy
-    charger_current = 0  # like cur_i
-    cur_power = 0     # W, current charging power
-    cur_i = None      # A, current charging current
-    cur_u = None      # V, current phase voltage
-    nr_phases = 3     # current number of used phases
-    auth_user = None
-
-    _last_update = None
-
-    def __init__(self, session_start, phases=3, id=None):
+
+    # internal data, timestamps are epoch seconds
+    state = _FleetField(ChargerState.IDLE)
+    last_start = _FleetField()
+    next_state_change = _FleetField()
+    req_max_i = _FleetField()
+    e_total = _FleetField(0)       # kWh, total energy
+    e_session = _FleetField(0)     # kWh, session energy
+    charger_current = _FleetField(0)  # like cur_i
+    cur_power = _FleetField(0)     # W, current charging power
+    cur_i = _FleetField()      # A, current charging current per phase
+    cur_u = _FleetField()      # V, current phase voltage per phase
+    nr_phases = _FleetField(3)     # current number of used phases
+
+    _last_update = _FleetField()
+
+    # snapshot store collecting the data dumps instead of per charger files
+    _store = None
+    # recorder of the state transitions
+    _recorder = None
+    # request routes by path, commands by name, see routes.py
+    _get_routes = {}
+    _post_routes = {}
+    _commands = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        collected = routes.collect(cls)
+        cls._get_routes = collected[routes.GET]
+        cls._post_routes = collected[routes.POST]
+        cls._commands = collected[routes.COMMAND]
+
+    def __init__(self, session_start, phases=3, id=None, datadump=None):
         # init vars
+        self._fleet = None  # storage of the fleet fields, if the charger is part of a vectorized fleet
+        self._index = None
+        self._meter = None  # totals of the site meter group, see sitemeter.py
+        for name in FLEET_FIELDS:
+            delattr(self, name)
         self._session_start = session_start
+        self._id = id
+        self._config_file_path = None
         if id is not None:
             self._config_file_path = ".chargersim_cfg_" + str(id)
 
-        if self._config_file_path is not None and os.path.isfile(self._config_file_path):
+        if datadump is None and self._config_file_path is not None and os.path.isfile(self._config_file_path):
             # load data from dump file
             with open(self._config_file_path, 'r') as dumpfile:
                 datadump = json.load(dumpfile)
-                # restore state, timing, and energy meter
-                self.state = ChargerState(datadump['state'])
-                self.next_state_change = datetime.strptime(
-                    datadump['next_state_change'], "%Y-%m-%dT%H:%M:%S")
-                self._last_update = datetime.strptime(
-                    datadump['_last_update'], "%Y-%m-%dT%H:%M:%S")
-                self.cur_i = datadump['cur_i']
-                self.e_total = datadump['e_total']
-                self.req_max_i = datadump['req_max_i'] if 'req_max_i' in datadump else None
+
+        if datadump is not None:
+            self._restore(datadump)
         else:
             # do a fresh initialization of data
             self.state = ChargerState.IDLE
-            self.e_total = random.random() * 5000   # 2.500 kWh average start
+            # chargers with an id get the same start values in any shard,
+            # the noise stream is not used so creating chargers does not shift it
+            generator = rng.derive("init", id) if id is not None else rng.get_random()
+            self.e_total = generator.random() * 5000   # 2.500 kWh average start
             self.cur_i = [0, 0, 0]
-            self.next_state_change = self._get_next_statechange()
-            self._last_update = datetime.now()
+            self.next_state_change = self._get_next_statechange(generator.gauss)
+            self._last_update = clock.timestamp()
 
         # this is always newly initialized
         self.nr_phases = phases
         self.cur_u = [230, 230, 230]
         self.auth_user = 0x4711171176abcdef
 
+    def _restore(self, datadump):
+        # restore state, timing, and energy meter
+        self.state = ChargerState(datadump['state'])
+        self.next_state_change = parse_timestamp(datadump['next_state_change'])
+        self._last_update = parse_timestamp(datadump['_last_update'])
+        self.cur_i = list(datadump['cur_i'])
+        self.e_total = datadump['e_total']
+        self.req_max_i = datadump['req_max_i'] if 'req_max_i' in datadump else None
+
     @staticmethod
     def _serialize(obj):
         """JSON serializer for objects not serializable by default json code"""
@@ -94,74 +182,196 @@ class Charger:
             return serial
         return obj.__dict__
 
+    def _get_dump_data(self):
+        if self._fleet is not None:
+            fields = self._fleet.get_row(self._index)
+        else:
+            # fields never set are not part of the dump
+            fields = {}
+            for name in FLEET_FIELDS:
+                value = getattr(self, "_f_" + name)
+                if value is not _UNSET:
+                    fields[name] = value
+        for name in TIMESTAMP_FIELDS:
+            if fields.get(name) is not None:
+                fields[name] = format_timestamp(fields[name])
+
+        data = {'_session_start': self._session_start}
+        if self._config_file_path is not None:
+            data['_config_file_path'] = self._config_file_path
+        data.update(fields)
+        data['auth_user'] = self.auth_user
+        return data
+
     def _create_dump_file(self):
         # save current data
-        if self._config_file_path is not None:
+        if self._store is not None and self._id is not None:
+            self._store.mark_dirty(self)
+        elif self._config_file_path is not None:
+            start = time.perf_counter()
             with open(self._config_file_path, 'w') as dumpfile:
-                json.dump(self.__dict__, dumpfile, default=self._serialize)
+                json.dump(self._get_dump_data(), dumpfile, default=self._serialize)
+            metrics.PERSISTENCE_WRITE.labels("file").observe(time.perf_counter() - start)
+
+    def is_valid_current(self, current):
+        """Whether a current limit in A can be set on the device."""
+        return 0 <= current <= self._DEV_MAX_I
+
+    def get_route_key(self, method, url_path):
+        """Path of the route handling a request, "other" for unrouted paths, e.g. as metrics label."""
+        routes = self._get_routes if method == "GET" else self._post_routes
+        path = url_path.partition("?")[0]
+        return path if path in routes else "other"
+
+    def get_etag(self, url_path):
+        """Entity tag of the current GET response, None if responses are not versioned."""
+        return None
 
     def handle_get_data(self, url_path):
-        return json.dumps(self.__dict__, default=self._serialize), "application/json"
+        path, query = routes.split_path(url_path)
+        route = self._get_routes.get(path)
+        if route is None:
+            # any other path returns the charger data
+            return json.dumps(self._get_dump_data(), default=self._serialize), "application/json"
+        return route.handler(self, query)
 
     def handle_post_data(self, url_path, post_data):
-        logging.warning("unhandled POST request: %s", url_path)
-        return "", "text/plain"
+        path, query = routes.split_path(url_path)
+        route = self._post_routes.get(path)
+        if route is None:
+            logging.warning("unhandled POST request: %s", url_path)
+            return "", "text/plain"
+        return route.handler(self, query, post_data)
+
+    def parse_post_data(self, url_path, post_data):
+        """Commands a POST request applies as (key, value) pairs, without applying them, see routes.py."""
+        path, query = routes.split_path(url_path)
+        route = self._post_routes.get(path)
+        if route is None:
+            return []
+        if route.parse is None:
+            return [(path, None)]
+        return route.parse(self, path, query, post_data)
 
-    def _get_next_statechange(self):
+    def parse_command(self, text):
+        """Name and parsed value of a "<name>=<value>" command, raises ValueError if it is unknown or invalid."""
+        name, _, value = text.partition("=")
+        route = self._commands.get(name)
+        if route is None:
+            raise ValueError("unknown command: {}".format(name))
+        return name, route.parse(self, value) if route.parse is not None else value
+
+    def handle_command(self, text):
+        """Applies a "<name>=<value>" command, returns False if it is unknown or invalid."""
+        if text.partition("=")[0] not in self._commands:
+            logging.warning("unhandled command: %s", text)
+            return False
+        try:
+            name, value = self.parse_command(text)
+            self._commands[name].handler(self, value)
+        except ValueError:
+            logging.warning("invalid command: %s", text)
+            return False
+        return True
+
+    def _get_next_statechange(self, gauss=None):
         timefactor = STATE_TIMES[self.state.value]
         if self._session_start >= 0:
             # deterministic state change timing
             time_minutes = timefactor * 60 / sum(STATE_TIMES)
             if self.state != ChargerState.IDLE:
-                next_start = datetime.now() + timedelta(minutes=time_minutes)
+                next_start = clock.timestamp() + 60 * time_minutes
             else:
                 # idle state always starts at defined minute
-                last_hour = datetime.now().replace(microsecond=0, second=0, minute=0)
-                next_start = last_hour + timedelta(hours=1) + timedelta(minutes=self._session_start)
+                last_hour = clock.now().replace(microsecond=0, second=0, minute=0)
+                next_start = last_hour.timestamp() + 3600 + 60 * self._session_start
         else:
             # random period
             # take session_start parameter as the weight
             mu = timefactor * -self._session_start
             # variance is 1/3
-            time_minutes = random.gauss(mu, mu/3)
+            time_minutes = (gauss or rng.get_noise().gauss)(mu, mu/3)
             # apply lower limit
             time_minutes = max(time_minutes, 1)
-            next_start = datetime.now() + timedelta(minutes=time_minutes)
+            next_start = clock.timestamp() + 60 * time_minutes
 
         return next_start
 
+    def _change_state(self):
+        # state transition
+        if self.state != ChargerState.UNPLUGGED_CAR:
+            self.state = ChargerState(self.state.value + 1)
+        else:
+            self.state = ChargerState.IDLE
+            self.last_start = clock.timestamp()
+        self.next_state_change = self._get_next_statechange()
+        # also set last update here to avoid long energy integration from other states
+        # this is i.e. important if we just restored a data dump and have a long period in between
+        self._last_update = clock.timestamp()
+        if self._recorder is not None:
+            self._recorder.record_transition(self)
+        # this is a good timing to backup config data
+        self._create_dump_file()
+
+    def _sample_measurements(self):
+        # derive noisy charging currents and power, the per-phase lists are updated in place
+        charger_current = self.charger_current = self._get_charger_current()
+        nr_phases = self.nr_phases
+        cur_u = self.cur_u
+        cur_i = self.cur_i
+        meter = self._meter
+        if meter is not None:
+            meter.remove(self.cur_power, cur_i)
+        cur_power = 0
+        gauss = rng.get_noise().gauss
+        for phase in range(3):
+            cur_u[phase] = int(gauss(self._NOMINAL_U, 3))
+            cur_i[phase] = gauss(charger_current, 0.05) if charger_current and phase < nr_phases else 0
+            cur_power += cur_i[phase] * cur_u[phase]
+        self.cur_power = cur_power
+        if meter is not None:
+            meter.add(cur_power, cur_i)
+        if self._fleet is not None:
+            # fleet columns return copies
+            self.cur_u = cur_u
+            self.cur_i = cur_i
+
+    def _integrate_energy(self, until):
+        # expected energy since last update, the measurement noise averages out
+        sec_since_last_update = until - self._last_update
+        if sec_since_last_update > 0:
+            power = self._get_charger_current() * self._NOMINAL_U * min(self.nr_phases, 3)
+            energy = power * sec_since_last_update / 3600000
+            self.e_session += energy
+            self.e_total += energy
+            if self._meter is not None:
+                self._meter.e_total += energy
+        self._last_update = until
+
+    def refresh(self):
+        """Bring measurements up to date, used instead of update_state by event driven fleets."""
+        self._integrate_energy(clock.timestamp())
+        self._sample_measurements()
+
     def update_state(self):
-        if datetime.now() > self.next_state_change:
-            # state transition
-            if self.state != ChargerState.UNPLUGGED_CAR:
-                self.state = ChargerState(self.state.value + 1)
-            else:
-                self.state = ChargerState.IDLE
-                self.last_start = datetime.now()
-            self.next_state_change = self._get_next_statechange()
-            # also set last update here to avoid long energy integration from other states
-            # this is i.e. important if we just restored a data dump and have a long period in between
-            self._last_update = datetime.now()
-            # this is a good timing to backup config data
-            self._create_dump_file()
+        now = clock.timestamp()
+        if now > self.next_state_change:
+            self._change_state()
 
         # derive charging currents, power, energy
-        sec_since_last_update = (datetime.now() - self._last_update).total_seconds()
-        self.charger_current = self._get_charger_current()
-        for phase in range(3):
-            self.cur_u[phase] = int(random.gauss(230, 3))
-            self.cur_i[phase] = random.gauss(self.charger_current, 0.05) \
-                if self.charger_current and phase < self.nr_phases else 0
-        self.cur_power = sum([self.cur_i[ph] * self.cur_u[ph] for ph in range(3)])
+        sec_since_last_update = now - self._last_update
+        self._sample_measurements()
         energy = self.cur_power * sec_since_last_update / 3600000
         self.e_session += energy
         self.e_total += energy
+        if self._meter is not None:
+            self._meter.e_total += energy
 
         if self.state.value >= ChargerState.UNPLUGGED_CAR.value:
             self.e_session = 0
 
         # set last update timestamp
-        self._last_update = datetime.now()
+        self._last_update = now
 
     def _get_charger_current(self):
         if self.state != ChargerState.CHARGING:
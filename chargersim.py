@@ -4,125 +4,475 @@
 
 import logging
 import traceback
+import argparse
+import asyncio
 import http.server
+import random
 import socketserver
 import select
+import signal
+import threading
+import time
+from urllib.parse import parse_qs
 
-from devicegoe import DeviceGoe
-from devicecircontrol import DeviceCircontrol
+from asyncserver import AsyncHttpServer
+from addressing import resolve_charger
+from fleet import ENGINES
+from snapshotstore import SnapshotStore
+from charger import Charger, ChargerState
+from fleetconfig import FleetConfig, ChargerMap, DEFAULT_FLEET, DEFAULT_START_ID, DEVICE_TYPES
+from profiling import Profiler, enable_spans
+from recorder import Recorder
+from sitemeter import SiteMeter
+from bulkapi import BulkApi
+from subscriptions import ChangeHub
+from modbusserver import ModbusServer
+from ocppclient import OcppClients
+from faults import FaultInjector
+import clock
+import metrics
+import rng
 
 
-START_PORT = 8100
-CHARGER_AREA = 10  # number of ports between chargers
-NR_CHARGERS = 10  # number of instantiated chargers, must be less than CHARGER_AREA
+START_PORT = DEFAULT_START_ID
 
 
 class HttpRequestHandler(http.server.BaseHTTPRequestHandler):
+    # persistent connections, each one is served in its own thread
+    protocol_version = "HTTP/1.1"
+    timeout = 15     # seconds a connection may stay idle
+    MAX_KEEP_ALIVE_REQUESTS = 1000  # requests per connection
+    lock = threading.Lock()  # serializes request handling with the charger updates
+
     chargers = None  # handle to the correspondig chargers
+    mux_ports = ()   # ports shared by all chargers
+    fleet = None     # fleet engine of the chargers
+    admin_routes = {}  # simulator wide GET handlers on the multiplexed ports, called with the query
+    admin_post_routes = {}  # simulator wide POST handlers, called with the query and the posted data
+    recorder = None  # recorder of the control traffic
+
+    def setup(self):
+        super().setup()
+        self._nr_requests = 0
+
+    def end_headers(self):
+        self._nr_requests += 1
+        if self._nr_requests >= self.MAX_KEEP_ALIVE_REQUESTS and not self.close_connection:
+            # this also sets close_connection
+            self.send_header("Connection", "close")
+        super().end_headers()
 
-    def _get_charger(self):
-        # determine targetted charger
+    def _get_charger(self, post_data=None):
+        # determine targetted charger and its local path
         port = self.request.getsockname()[1]
-        return self.chargers[port]
+        charger, self.path = resolve_charger(self.chargers, self.mux_ports, port, self.path, self.headers['Host'])
+        self._admin_response = None
+        if charger is None:
+            route, _, query = self.path.partition("?")
+            routes = self.admin_routes if self.command == "GET" else self.admin_post_routes
+            if port in self.mux_ports and route in routes:
+                args = (parse_qs(query),) if self.command == "GET" else (parse_qs(query), post_data)
+                try:
+                    self._admin_response = routes[route](*args)
+                except ValueError as exc:
+                    self.send_error(400, str(exc))
+            else:
+                self.send_error(404)
+        elif self.fleet is not None:
+            self.fleet.before_request(charger)
+        return charger
+
+    def _set_chunked_response(self, chunks, content_type):
+        self.send_response(200)
+        self.send_header("Content-type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        while True:
+            # chunks are produced with the chargers locked, but sent without
+            with self.lock, clock.frozen():
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _set_response(self, content, content_type, etag=None):
+        if not isinstance(content, (str, bytes)):
+            self._set_chunked_response(iter(content), content_type)
+            return
+        # Writing the HTML contents with UTF-8
+        if not isinstance(content, bytes):
+            content = bytes(content, "utf8")
 
-    def _set_response(self, content, content_type):
         # Sending an '200 OK' response
         self.send_response(200)
         # Setting the header
         self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        if etag is not None:
+            self.send_header("ETag", etag)
         # Whenever using 'send_header', you also have to call 'end_headers'
         self.end_headers()
 
-        # Writing the HTML contents with UTF-8
-        self.wfile.write(bytes(content, "utf8"))
+        self.wfile.write(content)
 
     def do_GET(self):
         # derive answer
-        charger = self._get_charger()
-        response, content_type = charger.handle_get_data(self.path)
-        self._set_response(response, content_type)
+        with self.lock, clock.frozen():
+            start = time.perf_counter()
+            charger = self._get_charger()
+            if charger is None:
+                response = self._admin_response
+            else:
+                if self.recorder is not None:
+                    self.recorder.record_request(charger, "GET", self.path, b"")
+                etag = charger.get_etag(self.path)
+                if etag is not None and etag in self.headers.get('If-None-Match', ""):
+                    metrics.observe_request(type(charger).__name__, charger.get_route_key("GET", self.path),
+                                            time.perf_counter() - start)
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                response = charger.handle_get_data(self.path) + (etag,)
+                metrics.observe_request(type(charger).__name__, charger.get_route_key("GET", self.path),
+                                        time.perf_counter() - start)
+        if response is not None:
+            self._set_response(*response)
 
     def do_POST(self):
-        content_length = int(self.headers['Content-Length'])
+        content_length = int(self.headers.get('Content-Length', 0))
         post_data = self.rfile.read(content_length)
 
         # derive answer
-        charger = self._get_charger()
-        response, content_type = charger.handle_post_data(self.path, post_data)
-        self._set_response(response, content_type)
+        with self.lock, clock.frozen():
+            start = time.perf_counter()
+            charger = self._get_charger(post_data)
+            if charger is None:
+                response = self._admin_response
+            else:
+                records = b""
+                if self.recorder is not None:
+                    try:
+                        records = self.recorder.encode_request(charger, "POST", self.path, post_data)
+                    except ValueError as exc:
+                        self.send_error(400, str(exc))
+                        return
+                response = charger.handle_post_data(self.path, post_data)
+                if records:
+                    self.recorder.write(records)
+                metrics.observe_request(type(charger).__name__, charger.get_route_key("POST", self.path),
+                                        time.perf_counter() - start)
+        if response is not None:
+            self._set_response(*response)
 
     def do_PUT(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
+        self.do_POST()
 
-        # derive answer
-        charger = self._get_charger()
-        response, content_type = charger.handle_post_data(self.path, post_data)
-        self._set_response(response, content_type)
+
+class ThreadingHttpServer(socketserver.ThreadingTCPServer):
+    # a kept alive connection must not block the other chargers and the charger updates
+    daemon_threads = True
+    allow_reuse_address = True
 
 
 class ChargerSim:
     MAIN_RECURRENCE = 1    # second
+    CHECKPOINT_INTERVAL = 10  # seconds between snapshot store writes
 
     chargers = {}  # handle to the correspondig chargers
     servers = []
 
-    def __init__(self):
+    def __init__(self, server_mode="select", mux_port=None, charger_ports=True, engine="python",
+                 snapshot_path=None, shard=None, fleet_config=None, profile_dir=".", spans=False, seed=None,
+                 record_path=None, modbus_port=None, ocpp_url=None, ocpp_ramp=50):
+        self.server_mode = server_mode
+        self.shard = shard  # (index, count) of the fleet slice simulated by this process
+        self.tick_listeners = []  # called with the simulator after each tick
+        self.running = False
+
+        # tick statistics, lag is the delay of a tick behind its schedule
+        self.nr_ticks = 0
+        self.tick_lag_total = 0
+        self.tick_lag_max = 0
+        self.tick_duration_total = 0
+        if record_path is not None and seed is None:
+            # recordings are always seeded to be replayable
+            seed = random.randrange(2 ** 32)
+        if seed is not None:
+            # shards draw from their own streams
+            rng.set_seed(seed, *(shard or ()))
+        self.fleet = ENGINES[engine]()
+
+        # record the control traffic, every shard to its own log
+        self.recorder = None
+        if record_path is not None:
+            if shard is not None:
+                record_path = "{}.{}".format(record_path, shard[0])
+            self.recorder = Recorder(record_path, seed, shard or (), engine)
+            Charger._recorder = self.recorder
+        self.mux_ports = [mux_port] if mux_port is not None else []
+        self.charger_ports = charger_ports
+        self.profiler = Profiler(profile_dir)
+        if spans:
+            enable_spans(DEVICE_TYPES.values())
+
         # disable logging of urllib and requests
         logging.getLogger("requests").setLevel(logging.WARNING)
         logging.getLogger("urllib3").setLevel(logging.WARNING)
 
-        # setup chargers and http sockets
+        # read all charger data from the snapshot store at once
+        self.store = None
+        self._snapshots = {}
+        if snapshot_path is not None:
+            self.store = SnapshotStore(snapshot_path)
+            self._snapshots = self.store.load_all()
+            Charger._store = self.store
+        self._last_checkpoint = time.monotonic()
+
+        # setup chargers, these are only instantiated on first access for lazy fleets
+        fleet_config = fleet_config or FleetConfig.from_dict(DEFAULT_FLEET)
+        # configured meter groups read as zero until their chargers are instantiated
+        self.meter = SiteMeter(group.meter for group in fleet_config.groups)
+        include = None
+        if self.shard is not None:
+            include = lambda charger_id: (charger_id - START_PORT) % self.shard[1] == self.shard[0]
+        self.chargers = ChargerMap(fleet_config, self._create_charger, include,
+                                   self._snapshots if fleet_config.lazy else None)
+        if not fleet_config.lazy:
+            for charger_id in self.chargers:
+                self.chargers[charger_id]
+
+        # setup http sockets
         HttpRequestHandler.chargers = self.chargers
-        start_times = [0, 10, 20, 30, 40]
-        nr_phases = [3, 1, 3, 2, 3]
-
-        port = START_PORT
-        # go-e chargers
-        for i in range(5):
-            self.chargers[port] = DeviceGoe(start_times[i], nr_phases[i], port)
-            self.servers.append(socketserver.TCPServer(("", port), HttpRequestHandler))
-            port += 1
-        for i in range(5):
-            self.chargers[port] = DeviceGoe(-0.3 * (i + 1), nr_phases[i], port)
-            self.servers.append(socketserver.TCPServer(("", port), HttpRequestHandler))
-            port += 1
-        # Circontrol chargers
-        for i in range(5):
-            self.chargers[port] = DeviceCircontrol(start_times[i], nr_phases[i], port)
-            self.servers.append(socketserver.TCPServer(("", port), HttpRequestHandler))
-            port += 1
-        for i in range(5):
-            self.chargers[port] = DeviceCircontrol(-0.3 * (i + 1), nr_phases[i], port)
-            self.servers.append(socketserver.TCPServer(("", port), HttpRequestHandler))
-            port += 1
-        # 100 more Circontrol chargers
-        for i in range(100):
-            self.chargers[port] = DeviceCircontrol(-1, nr_phases[i % len(nr_phases)], port)
-            self.servers.append(socketserver.TCPServer(("", port), HttpRequestHandler))
-            port += 1
+        HttpRequestHandler.mux_ports = self.mux_ports
+        HttpRequestHandler.fleet = self.fleet
+        HttpRequestHandler.recorder = self.recorder
+        self.bulk = BulkApi(self.chargers, self.fleet, self.recorder)
+        HttpRequestHandler.admin_routes = self.admin_routes = {
+            "/metrics": self._get_metrics,
+            "/profile": self.profiler.handle_request,
+            "/site": self.meter.handle_request,
+            SiteMeter.FRONIUS_PATH: self.meter.handle_fronius_request,
+            "/bulk/status": self.bulk.handle_status_request,
+        }
+        HttpRequestHandler.admin_post_routes = self.admin_post_routes = {
+            "/bulk/current": self.bulk.handle_current_request,
+        }
+        self.hub = ChangeHub(self.chargers)
+        self.tick_listeners.append(self.hub.on_tick)
+        self.faults = FaultInjector(self.chargers, fleet_config)
+        if self.server_mode == "asyncio":
+            # event streams and injected faults are served by the event loop only,
+            # a delay of the blocking handler would hold up the other requests
+            self.admin_routes["/subscribe"] = self.hub.handle_request
+            self.admin_routes["/faults"] = self.faults.handle_request
+            self.admin_post_routes["/faults"] = self.faults.handle_post_request
+        self.modbus = None
+        if modbus_port is not None:
+            self.modbus = ModbusServer(self.chargers, self.fleet, self.recorder, modbus_port)
+            self.tick_listeners.append(self.modbus.on_tick)
+        self.ocpp = None
+        if ocpp_url is not None:
+            self.ocpp = OcppClients(self.chargers, ocpp_url, self.fleet, self.recorder, ocpp_ramp)
+            self.tick_listeners.append(self.ocpp.on_tick)
+        if self.server_mode == "select":
+            for port in self._listen_ports():
+                self.servers.append(ThreadingHttpServer(("", port), HttpRequestHandler))
+
+    def _create_charger(self, group, charger_id):
+        session_start, phases = group.get_settings(charger_id)
+        datadump = self._snapshots.pop(charger_id, None)
+        charger = group.device_class(session_start, phases, charger_id, datadump)
+        if self.store is not None and datadump is None:
+            # chargers created fresh or from a legacy dump file get into the store with the next checkpoint
+            self.store.mark_dirty(charger)
+        self.fleet.add(charger)
+        self.meter.attach(charger, group.meter)
+        if self.recorder is not None:
+            self.recorder.record_init(charger)
+        return charger
+
+    def _get_metrics(self, query):
+        return metrics.render(self.chargers.instantiated(), ChargerState), metrics.CONTENT_TYPE
+
+    def _listen_ports(self):
+        ports = list(self.mux_ports)
+        if self.charger_ports:
+            ports.extend(self.chargers.keys())
+        return ports
+
+    def _update_chargers(self, lag=0):
+        self.profiler.poll()
+        start = time.perf_counter()
+        with clock.frozen():
+            self.chargers.create_due(clock.timestamp())
+            if self.recorder is not None:
+                self.recorder.record_tick()
+            self.fleet.tick()
+        clock.get_clock().advance(self.MAIN_RECURRENCE)
+        duration = time.perf_counter() - start
+        self.nr_ticks += 1
+        self.tick_lag_total += lag
+        self.tick_lag_max = max(self.tick_lag_max, lag)
+        self.tick_duration_total += duration
+        metrics.TICK_LAG.observe(lag)
+        metrics.TICK_DURATION.observe(duration)
+        for listener in self.tick_listeners:
+            try:
+                listener(self)
+            except Exception:
+                # a failing front-end must not stop the simulation
+                logging.exception("error in tick listener %s", listener)
+        if self.store is not None and time.monotonic() - self._last_checkpoint >= self.CHECKPOINT_INTERVAL:
+            self.store.checkpoint()
+            self._last_checkpoint = time.monotonic()
+
+    def stop(self):
+        """Ends run() after the current tick, may be called from a signal handler."""
+        self.running = False
+
+    def _start_profiling(self):
+        try:
+            self.profiler.start()
+        except ValueError as exc:
+            logging.warning("%s", exc)
 
     def run(self):
-        # listen for server requests
-        while True:
-            # server http requests and timeout on charger updates
-            # notice, that incoming http requests will influence the charger call repetition timing!
-            # we accept this for now
-            r, w, e = select.select(self.servers, [], [], self.MAIN_RECURRENCE)
+        self.running = True
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self._start_profiling())
+        if self.recorder is not None and self.shard is None:
+            # finish the current tick on interrupts, so the final counters are recorded consistently
+            signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+        try:
+            if self.server_mode == "asyncio":
+                asyncio.run(self._run_async())
+            else:
+                self._run_select()
+        finally:
+            if self.store is not None:
+                self.store.close()
+            if self.recorder is not None:
+                self.recorder.close(self.chargers.instantiated())
+
+    def _run_select(self):
+        # listen for server requests, the chargers are only updated when their tick is due,
+        # so requests in between get the same charger data and entity tags
+        next_tick = time.monotonic()
+        while self.running:
+            now = time.monotonic()
+            if now >= next_tick:
+                # update charger states
+                with HttpRequestHandler.lock:
+                    self._update_chargers(now - next_tick)
+                next_tick += clock.get_clock().real_interval(self.MAIN_RECURRENCE)
+            # serve http requests until the next tick
+            r, w, e = select.select(self.servers, [], [], max(next_tick - time.monotonic(), 0))
             for cur_server in self.servers:
                 if cur_server in r:
                     cur_server.handle_request()
-            # update charger states
-            for cur_charger in self.chargers.values():
-                cur_charger.update_state()
+
+    async def _run_async(self):
+        server = AsyncHttpServer(self.chargers, self.mux_ports, self.fleet, self.admin_routes, self.recorder,
+                                 self.admin_post_routes, self.faults)
+        await server.start(self._listen_ports())
+        if self.modbus is not None:
+            await self.modbus.start()
+        if self.ocpp is not None:
+            await self.ocpp.start()
+        loop = asyncio.get_running_loop()
+        try:
+            # requests are served concurrently by the event loop,
+            # so the tick keeps its schedule independent of incoming requests
+            next_tick = loop.time()
+            while self.running:
+                self._update_chargers(max(loop.time() - next_tick, 0))
+                next_tick += clock.get_clock().real_interval(self.MAIN_RECURRENCE)
+                await asyncio.sleep(max(next_tick - loop.time(), 0))
+        finally:
+            server.close()
+            if self.modbus is not None:
+                self.modbus.close()
+            if self.ocpp is not None:
+                self.ocpp.close()
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(description="Simulation of electric car chargers.")
+    parser.add_argument("--server", choices=["select", "asyncio"], default="select",
+                        help="HTTP front-end: blocking per-port servers or a single asyncio event loop")
+    parser.add_argument("--engine", choices=list(ENGINES), default="python",
+                        help="charger update engine, numpy advances the whole fleet in batched operations, "
+                        "event only handles due state transitions and updates measurements on access")
+    timing = parser.add_mutually_exclusive_group()
+    timing.add_argument("--speed", type=float,
+                        help="simulated time runs this factor faster than real time")
+    timing.add_argument("--fast", action="store_true",
+                        help="run the simulation as fast as possible")
+    parser.add_argument("--seed", type=int,
+                        help="seed of all random values, repeats a run without external requests bit for bit")
+    parser.add_argument("--record",
+                        help="write control commands and state transitions to this log, see replay.py")
+    parser.add_argument("--fleet",
+                        help="fleet configuration file (JSON or TOML), default are 120 go-e and Circontrol chargers")
+    parser.add_argument("--lazy", action="store_true",
+                        help="instantiate chargers only on first access")
+    parser.add_argument("--snapshot-db",
+                        help="keep charger data in this SQLite database instead of one dump file per charger")
+    parser.add_argument("--mux-port", type=int,
+                        help="additional port serving all chargers, addressed by /c/<id>/ path or c<id>. host")
+    parser.add_argument("--profile-dir", default=".",
+                        help="directory of profiles taken via SIGUSR1 or the /profile endpoint of the --mux-port")
+    parser.add_argument("--spans", action="store_true",
+                        help="record the duration of charger updates, requests and dumps per device type")
+    parser.add_argument("--no-charger-ports", dest="charger_ports", action="store_false",
+                        help="do not open one port per charger, requires --mux-port")
+    parser.add_argument("--modbus-port", type=int,
+                        help="serve the chargers via Modbus TCP as unit ids 1-247 from this port on, "
+                        "requires --server asyncio")
+    parser.add_argument("--ocpp-url",
+                        help="connect every charger as OCPP 1.6-J charge point to this central system, "
+                        "as <url>/<id>, requires --server asyncio")
+    parser.add_argument("--ocpp-ramp", type=float, default=50,
+                        help="OCPP sessions opened per second")
+    return parser
+
+
+def parse_args(args=None):
+    return create_arg_parser().parse_args(args)
+
+
+def configure(args):
+    """Sets up logging and the simulation clock, returns the ChargerSim arguments."""
+    if not args.charger_ports and args.mux_port is None:
+        raise ValueError("--no-charger-ports requires --mux-port")
+    if args.modbus_port is not None and args.server != "asyncio":
+        raise ValueError("--modbus-port requires --server asyncio")
+    if args.ocpp_url is not None and args.server != "asyncio":
+        raise ValueError("--ocpp-url requires --server asyncio")
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(message)s')
+    if args.fast:
+        clock.set_clock(clock.SteppedClock())
+    elif args.speed:
+        clock.set_clock(clock.ScaledClock(args.speed))
+    fleet_config = FleetConfig.load(args.fleet) if args.fleet else FleetConfig.from_dict(DEFAULT_FLEET)
+    fleet_config.lazy = fleet_config.lazy or args.lazy
+    if args.server != "asyncio" and any(group.faults is not None for group in fleet_config.groups):
+        raise ValueError("fault injection requires --server asyncio")
+    return dict(server_mode=args.server, mux_port=args.mux_port, charger_ports=args.charger_ports,
+                engine=args.engine, snapshot_path=args.snapshot_db, fleet_config=fleet_config,
+                profile_dir=args.profile_dir, spans=args.spans, seed=args.seed, record_path=args.record,
+                modbus_port=args.modbus_port, ocpp_url=args.ocpp_url, ocpp_ramp=args.ocpp_ramp)
 
 
 def main():
     try:
-        logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(message)s')
+        args = parse_args()
+        sim_args = configure(args)
 
         # setup main class
-        chargersim = ChargerSim()
+        chargersim = ChargerSim(**sim_args)
 
         # run
         chargersim.run()
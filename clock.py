@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+# Simulation time source.
+# Chargers and device protocols read the time via now() of this module,
+# so the simulation can run faster than real time.
+# timestamp() returns the same time as float epoch seconds, used for the charger timing.
+
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+
+class RealClock:
+    """Wall clock time."""
+    speed = 1
+
+    def now(self):
+        return datetime.now()
+
+    def timestamp(self):
+        return time.time()
+
+    def real_interval(self, seconds):
+        """Wall clock seconds corresponding to the given simulated seconds."""
+        return seconds / self.speed
+
+    def advance(self, seconds):
+        # time proceeds by itself
+        pass
+
+
+class ScaledClock(RealClock):
+    """Simulated time running speed times faster than wall clock time."""
+
+    def __init__(self, speed, start=None):
+        self.speed = speed
+        self._start = start.timestamp() if start is not None else time.time()
+        self._start_monotonic = time.monotonic()
+
+    def now(self):
+        return datetime.fromtimestamp(self.timestamp())
+
+    def timestamp(self):
+        return self._start + (time.monotonic() - self._start_monotonic) * self.speed
+
+
+class SteppedClock(RealClock):
+    """Simulated time only proceeding when advanced, to run as fast as possible."""
+    speed = float("inf")
+
+    def __init__(self, start=None):
+        self._now = start.timestamp() if start is not None else time.time()
+
+    def now(self):
+        return datetime.fromtimestamp(self._now)
+
+    def timestamp(self):
+        return self._now
+
+    def advance(self, seconds):
+        self._now += seconds
+
+    def set_timestamp(self, timestamp):
+        self._now = timestamp
+
+
+class FrozenClock(RealClock):
+    """Current time of another clock standing still, see frozen()."""
+
+    def __init__(self, clock):
+        self.speed = clock.speed
+        self._clock = clock
+        self._now = clock.timestamp()
+
+    def now(self):
+        return datetime.fromtimestamp(self._now)
+
+    def timestamp(self):
+        return self._now
+
+    def advance(self, seconds):
+        self._clock.advance(seconds)
+
+
+_clock = RealClock()
+
+
+def get_clock():
+    return _clock
+
+
+def set_clock(clock):
+    global _clock
+    _clock = clock
+
+
+def now():
+    return _clock.now()
+
+
+def timestamp():
+    return _clock.timestamp()
+
+
+@contextmanager
+def frozen():
+    """Simulated time stands still within, so a tick or a request is handled at a single instant."""
+    global _clock
+    running = _clock
+    _clock = FrozenClock(running)
+    try:
+        yield
+    finally:
+        _clock = running
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+# Stand-in OCPP 1.6-J central system for tests of the charge point mode.
+# Accepts every charge point connecting as ws://<host>:<port>/<path>/<id>, answers
+# the core profile calls, optionally sets a charging limit after each boot, and
+# logs the number of connections and messages periodically.
+
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import time
+
+from asyncwebsocket import accept, ConnectionClosed
+from ocppclient import CALL, CALLRESULT, CALLERROR, format_time
+
+
+class StandInCsms:
+    SUBPROTOCOLS = ("ocpp1.6",)
+
+    def __init__(self, heartbeat_interval=300, limit=None):
+        self.heartbeat_interval = heartbeat_interval
+        self.limit = limit  # A, set as default charging profile after each boot
+        self.nr_connected = 0
+        self.nr_transactions = 0  # open transactions
+        self.messages = collections.Counter()  # by action
+        self._transaction_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self.servers = []
+
+    def _boot_notification(self, payload):
+        return {'status': "Accepted", 'currentTime': format_time(time.time()), 'interval': self.heartbeat_interval}
+
+    def _heartbeat(self, payload):
+        return {'currentTime': format_time(time.time())}
+
+    def _acknowledge(self, payload):
+        return {}
+
+    def _authorize(self, payload):
+        return {'idTagInfo': {'status': "Accepted"}}
+
+    def _start_transaction(self, payload):
+        self.nr_transactions += 1
+        return {'transactionId': next(self._transaction_ids), 'idTagInfo': {'status': "Accepted"}}
+
+    def _stop_transaction(self, payload):
+        self.nr_transactions -= 1
+        return {'idTagInfo': {'status': "Accepted"}}
+
+    _HANDLERS = {
+        "BootNotification": _boot_notification,
+        "Heartbeat": _heartbeat,
+        "StatusNotification": _acknowledge,
+        "MeterValues": _acknowledge,
+        "Authorize": _authorize,
+        "StartTransaction": _start_transaction,
+        "StopTransaction": _stop_transaction,
+    }
+
+    def _set_limit(self, websocket):
+        profile = {
+            'chargingProfileId': 1,
+            'stackLevel': 0,
+            'chargingProfilePurpose': "TxDefaultProfile",
+            'chargingProfileKind': "Relative",
+            'chargingSchedule': {
+                'chargingRateUnit': "A",
+                'chargingSchedulePeriod': [{'startPeriod': 0, 'limit': self.limit}],
+            },
+        }
+        websocket.send(json.dumps([CALL, str(next(self._message_ids)), "SetChargingProfile",
+                                   {'connectorId': 0, 'csChargingProfiles': profile}]))
+
+    def _handle_message(self, websocket, charge_point, text):
+        message = json.loads(text)
+        if message[0] != CALL:
+            # responses to SetChargingProfile
+            if message[0] == CALLERROR or message[2].get('status') != "Accepted":
+                logging.warning("charge point %s rejected the charging profile: %s", charge_point, text)
+            return
+        _, message_id, action, payload = message
+        self.messages[action] += 1
+        handler = self._HANDLERS.get(action)
+        if handler is None:
+            websocket.send(json.dumps([CALLERROR, message_id, "NotImplemented", action, {}]))
+            return
+        websocket.send(json.dumps([CALLRESULT, message_id, handler(self, payload)]))
+        if action == "BootNotification" and self.limit is not None:
+            self._set_limit(websocket)
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            websocket, path = await accept(reader, writer, self.SUBPROTOCOLS)
+        except (ConnectionClosed, ConnectionError, ValueError):
+            return
+        charge_point = path.rstrip("/").rpartition("/")[2]
+        self.nr_connected += 1
+        try:
+            while True:
+                self._handle_message(websocket, charge_point, await websocket.recv())
+        except ConnectionClosed:
+            pass
+        except (ValueError, IndexError, KeyError, AttributeError):
+            logging.warning("invalid message of charge point %s, closing", charge_point)
+        finally:
+            self.nr_connected -= 1
+            websocket.close()
+
+    async def start(self, port, host=None):
+        server = await asyncio.start_server(self._handle_connection, host, port, reuse_address=True,
+                                            backlog=1024)
+        self.servers.append(server)
+        logging.info("stand-in OCPP central system listening on port %d", port)
+
+    async def log_stats(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            logging.info("%d charge points connected, %d open transactions, messages: %s",
+                         self.nr_connected, self.nr_transactions,
+                         ", ".join("{} {}".format(action, count) for action, count in sorted(self.messages.items())))
+
+
+async def run(args):
+    csms = StandInCsms(args.heartbeat, args.limit)
+    await csms.start(args.port)
+    await csms.log_stats(args.stats_interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in OCPP 1.6-J central system.")
+    parser.add_argument("--port", type=int, default=9000, help="WebSocket port")
+    parser.add_argument("--heartbeat", type=int, default=300, help="heartbeat interval in seconds")
+    parser.add_argument("--limit", type=int, help="charging limit in A set after each boot")
+    parser.add_argument("--stats-interval", type=float, default=10, help="seconds between statistics logs")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
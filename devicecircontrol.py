@@ -3,10 +3,11 @@
 # Author: Roman Morawek <rmorawek@embyt.com>
 
 import logging
-from datetime import datetime
-import xml.etree.ElementTree as ET
+import re
 
+import clock
 from charger import Charger, ChargerState
+from routes import get, post
 
 # Current values in A.
 # Power values in W.
@@ -31,205 +32,294 @@ from charger import Charger, ChargerState
 # <id>EVCommDevice</id> can be found in socketInfo.xml request
 
 
+_CURRENT = re.compile(rb"<current>\s*(-?\d+)\s*</current>")
+
+
+def parse_currents(body):
+    """Currents of the <current> elements of a control request body, in order."""
+    return [int(value) for value in _CURRENT.findall(body)]
+
+
+def _compile(template):
+    # precompile response template once: remove the indentation whitespace
+    return re.sub(r"\s*\n\s*", "", template)
+
+
+_SOCKET_INFO = _compile("""
+    <socketsInfo>
+      <socketInfo>
+        <id>672C24E1-780D-457B-BDD1-C1D3BB5A7D2B.476A1CEA-951D-436A-A6CC-F71B94E48725.4A2963B9-2831-4656-A9E7-328BA8490F52</id>
+        <name>EVSE.PLUG.SOCKET MODE 3</name>
+        <number>1</number>
+        <chargeMode>3</chargeMode>
+        <connectorType>62196 TYPE 2</connectorType>
+        <supportedCurrent>{supportedCurrent}</supportedCurrent>
+        <EVCommDevice>PLUG - Mode 3</EVCommDevice>
+        <plugCurrent>{plugCurrent}</plugCurrent>
+        <hasCover>F</hasCover>
+        <hasLock>T</hasLock>
+        <hasSafeStorageLock>F</hasSafeStorageLock>
+        <meter>PLUG - Meter</meter>
+      </socketInfo>
+    </socketsInfo>
+""")
+
+_SOCKET_STATE = _compile("""
+    <socketsState>
+      <socketState>
+        <id>672C24E1-780D-457B-BDD1-C1D3BB5A7D2B.476A1CEA-951D-436A-A6CC-F71B94E48725.4A2963B9-2831-4656-A9E7-328BA8490F52</id>
+        <name>EVSE.PLUG.SOCKET MODE 3</name>
+        <number>1</number>
+        <state>{state}</state>
+        <previousState>0</previousState>
+        <stateDate>{requestDate}</stateDate>
+        <error>0</error>
+        <vehicleConnected>{vehicleConnected}</vehicleConnected>
+        <locked>{locked}</locked>
+      </socketState>
+    </socketsState>
+""")
+
+_SOCKET = _compile("""
+    <socket>
+      <id>4A2963B9-2831-4656-A9E7-328BA8490F52</id>
+      <name>SOCKET MODE 3</name>
+      <number>1</number>
+      <reduceCurrent>{reduceCurrent}</reduceCurrent>
+      <chargingPhases>{chargingPhases}</chargingPhases>
+      <state>{state}</state>
+      <chargeId>4A8EFBD2-8996-11EB-8996-11EBAEA263C0</chargeId>
+      <user>{user}</user>
+      <requestDate>{requestDate}</requestDate>
+      <beginDate>{beginDate}</beginDate>
+      <endDate>-1.000000</endDate>
+      <chargeTime>{chargeTime}</chargeTime>
+      <stopped>{stopped}</stopped>
+      <activeEnergy>{activeEnergy}</activeEnergy>
+      <partialActiveEnergy>{partialActiveEnergy}</partialActiveEnergy>
+      <currentL1>{currentL1}</currentL1>
+      <currentL2>{currentL2}</currentL2>
+      <currentL3>{currentL3}</currentL3>
+      <currentIII>0</currentIII>
+      <voltageL1>{voltageL1}</voltageL1>
+      <voltageL2>{voltageL2}</voltageL2>
+      <voltageL3>{voltageL3}</voltageL3>
+      <voltageIII>0</voltageIII>
+      <activePower>{activePower}</activePower>
+      <limitCurrent>{limitCurrent}</limitCurrent>
+    </socket>
+""")
+
+_CHARGE_INFO = _compile("""
+    <chargesInfo>
+      <chargeInfo>
+        <id>672C24E1-780D-457B-BDD1-C1D3BB5A7D2B.476A1CEA-951D-436A-A6CC-F71B94E48725</id>
+        <name>EVSE.PLUG</name>
+        <number>1</number>
+        <state>{state}</state>
+        <chargeId>4A8EFBD2-8996-11EB-8996-11EBAEA263C0</chargeId>
+        <user>{user}</user>
+        <userType>RFID</userType>
+        <requestDate>{requestDate}</requestDate>
+        <beginDate>{beginDate}</beginDate>
+        <endDate>-1.000000</endDate>
+        <chargeTime>{chargeTime}</chargeTime>
+        <stopped>{stopped}</stopped>
+        <stoppedByError>F</stoppedByError>
+        <activeEnergy>{activeEnergy}</activeEnergy>
+        <partialActiveEnergy>{partialActiveEnergy}</partialActiveEnergy>
+        {socket}
+      </chargeInfo>
+    </chargesInfo>
+""")
+
+_CHARGE_STATE = _compile("""
+    <chargesState>
+      <chargeState>
+        <id>672C24E1-780D-457B-BDD1-C1D3BB5A7D2B.476A1CEA-951D-436A-A6CC-F71B94E48725</id>
+        <name>EVSE.PLUG</name>
+        <number>1</number>
+        <state>{state}</state>
+        <chargingPhases>{chargingPhases}</chargingPhases>
+        <chargeId>4A8EFBD2-8996-11EB-8996-11EBAEA263C0</chargeId>
+        <user>{user}</user>
+        <chargeTime>{chargeTime}</chargeTime>
+        <reduceCurrent>{reduceCurrent}</reduceCurrent>
+        <activeEnergy>{activeEnergy}</activeEnergy>
+        <partialActiveEnergy>{partialActiveEnergy}</partialActiveEnergy>
+        <currentL1>{currentL1}</currentL1>
+        <currentL2>{currentL2}</currentL2>
+        <currentL3>{currentL3}</currentL3>
+        <currentIII>0</currentIII>
+        <voltageL1>{voltageL1}</voltageL1>
+        <voltageL2>{voltageL2}</voltageL2>
+        <voltageL3>{voltageL3}</voltageL3>
+        <voltageIII>0</voltageIII>
+        <activePower>{activePower}</activePower>
+        {socket}
+      </chargeState>
+    </chargesState>
+""")
+
+
 class DeviceCircontrol(Charger):
-    def handle_get_data(self, url_path):
+    # responses are cached per path until the charger data changes
+    __slots__ = ('_cache_key', '_cache')
+
+    def __init__(self, *args, **kwargs):
+        self._cache_key = None
+        self._cache = None
+        super().__init__(*args, **kwargs)
+
+    def _get_data(self):
         # determine charging data
+        now = clock.timestamp()
+        is_charging = self.is_charging()
         state = 0  # default
-        if self.is_charging():
+        if is_charging:
             state = 8
         elif self.state == ChargerState.STOPPED_AFTER_CHARGING or self.req_max_i == 0:
             state = 10
-        data = {
-            'requestDate': datetime.now().timestamp(),
-            'beginDate': self.last_start.timestamp() if self.last_start else 0,
+        cur_i = self.cur_i
+        cur_u = self.cur_u
+        return {
+            'requestDate': now,
+            'beginDate': self.last_start if self.last_start else 0,
             'plugCurrent': self._DEV_MAX_I,
             'supportedCurrent': self._DEV_MAX_I,
-            'chargeTime': (datetime.now() - self.last_start).total_seconds() if self.last_start and self.is_charging() else 0,
+            'chargeTime': now - self.last_start if self.last_start and is_charging else 0,
             'stopped': 1 if self.state == ChargerState.STOPPED_AFTER_CHARGING or self.req_max_i == 0 else 0,
             'activeEnergy': 1000 * self.e_total,
             'partialActiveEnergy': 1000 * self.e_session,
             'state': state,
             'vehicleConnected': "T" if ChargerState.PLUGGED_BEFORE_CHARGE.value <= self.state.value < ChargerState.UNPLUGGED_CAR.value else "F",
-            'locked': "T" if self.is_charging() else "F",
+            'locked': "T" if is_charging else "F",
             'chargingPhases': self.nr_phases,
-            'currentL1': self.cur_i[0],
-            'currentL2': self.cur_i[1],
-            'currentL3': self.cur_i[2],
-            'voltageL1': self.cur_u[0],
-            'voltageL2': self.cur_u[1],
-            'voltageL3': self.cur_u[2],
+            'currentL1': cur_i[0],
+            'currentL2': cur_i[1],
+            'currentL3': cur_i[2],
+            'voltageL1': cur_u[0],
+            'voltageL2': cur_u[1],
+            'voltageL3': cur_u[2],
             'activePower': self.cur_power,
             'reduceCurrent': self.req_max_i if self.req_max_i is not None else "",
             'limitCurrent': self.req_max_i if self.req_max_i is not None else self._DEV_MAX_I,
             'user': "{:X}".format(self.auth_user),
         }
 
-        if url_path == "/services/cpi/socketInfo.xml":
-            return self._get_socket_info(data), "text/xml"
-        if url_path == "/services/cpi/socketState.xml":
-            return self._get_socket_state(data), "text/xml"
-        if url_path == "/services/cpi/chargeInfo.xml":
-            return self._get_charge_info(data), "text/xml"
-        if url_path == "/services/cpi/chargeState.xml":
-            return self._get_charge_state(data), "text/xml"
-
-        return super().handle_get_data(url_path)
-
-    def _get_socket_info(self, data):
-        return """
-          <socketsInfo>
-            <socketInfo>
-              <id>672C24E1-780D-457B-BDD1-C1D3BB5A7D2B.476A1CEA-951D-436A-A6CC-F71B94E48725.4A2963B9-2831-4656-A9E7-328BA8490F52</id>
-              <name>EVSE.PLUG.SOCKET MODE 3</name>
-              <number>1</number>
-              <chargeMode>3</chargeMode>
-              <connectorType>62196 TYPE 2</connectorType>
-              <supportedCurrent>{supportedCurrent}</supportedCurrent>
-              <EVCommDevice>PLUG - Mode 3</EVCommDevice>
-              <plugCurrent>{plugCurrent}</plugCurrent>
-              <hasCover>F</hasCover>
-              <hasLock>T</hasLock>
-              <hasSafeStorageLock>F</hasSafeStorageLock>
-              <meter>PLUG - Meter</meter>
-            </socketInfo>
-          </socketsInfo>
-        """.format(**data)
-
-    def _get_socket_state(self, data):
-        return """
-          <socketsState>
-            <socketState>
-              <id>672C24E1-780D-457B-BDD1-C1D3BB5A7D2B.476A1CEA-951D-436A-A6CC-F71B94E48725.4A2963B9-2831-4656-A9E7-328BA8490F52</id>
-              <name>EVSE.PLUG.SOCKET MODE 3</name>
-              <number>1</number>
-              <state>{state}</state>
-              <previousState>0</previousState>
-              <stateDate>{requestDate}</stateDate>
-              <error>0</error>
-              <vehicleConnected>{vehicleConnected}</vehicleConnected>
-              <locked>{locked}</locked>
-            </socketState>
-          </socketsState>
-        """.format(**data)
-
-    def _get_socket(self, data):
+    def _get_cache(self):
+        # charger data changes with each update, state change and new current limit,
+        # a state change may happen at the timestamp of the last update
+        key = (self._last_update, self.state, self.req_max_i)
+        if key != self._cache_key:
+            self._cache_key = key
+            self._cache = {}
+        return self._cache
+
+    def _get_cached(self, cache, name, render):
+        result = cache.get(name)
+        if result is None:
+            if 'data' not in cache:
+                cache['data'] = self._get_data()
+            result = cache[name] = render(cache)
+        return result
+
+    def get_etag(self, url_path):
+        route = self._get_routes.get(url_path.partition("?")[0])
+        if route is None or not route.versioned:
+            return None
+        return '"{:.3f}-{}-{}"'.format(self._last_update, self.state.value, self.req_max_i)
+
+    def _get_xml(self, name, render):
+        cache = self._get_cache()
+        result = cache.get(name)
+        if result is None:
+            if 'data' not in cache:
+                cache['data'] = self._get_data()
+            result = cache[name] = render(cache).encode("utf8")
+        return result, "text/xml"
+
+    def _render_socket_info(self, cache):
+        return _SOCKET_INFO.format_map(cache['data'])
+
+    def _render_socket_state(self, cache):
+        return _SOCKET_STATE.format_map(cache['data'])
+
+    def _get_socket(self, cache):
         if self.is_charging():
-            socket = """
-                <socket>
-                  <id>4A2963B9-2831-4656-A9E7-328BA8490F52</id>
-                  <name>SOCKET MODE 3</name>
-                  <number>1</number>
-                  <reduceCurrent>{reduceCurrent}</reduceCurrent>
-                  <chargingPhases>{chargingPhases}</chargingPhases>
-                  <state>{state}</state>
-                  <chargeId>4A8EFBD2-8996-11EB-8996-11EBAEA263C0</chargeId>
-                  <user>{user}</user>
-                  <requestDate>{requestDate}</requestDate>
-                  <beginDate>{beginDate}</beginDate>
-                  <endDate>-1.000000</endDate>
-                  <chargeTime>{chargeTime}</chargeTime>
-                  <stopped>{stopped}</stopped>
-                  <activeEnergy>{activeEnergy}</activeEnergy>
-                  <partialActiveEnergy>{partialActiveEnergy}</partialActiveEnergy>
-                  <currentL1>{currentL1}</currentL1>
-                  <currentL2>{currentL2}</currentL2>
-                  <currentL3>{currentL3}</currentL3>
-                  <currentIII>0</currentIII>
-                  <voltageL1>{voltageL1}</voltageL1>
-                  <voltageL2>{voltageL2}</voltageL2>
-                  <voltageL3>{voltageL3}</voltageL3>
-                  <voltageIII>0</voltageIII>
-                  <activePower>{activePower}</activePower>
-                  <limitCurrent>{limitCurrent}</limitCurrent>
-                </socket>
-          """.format(**data)
+            socket = _SOCKET.format_map(cache['data'])
         else:
             socket = ""
         return socket
 
-    def _get_charge_info(self, data):
-        socket = self._get_socket(data)
-        return """
-          <chargesInfo>
-            <chargeInfo>
-              <id>672C24E1-780D-457B-BDD1-C1D3BB5A7D2B.476A1CEA-951D-436A-A6CC-F71B94E48725</id>
-              <name>EVSE.PLUG</name>
-              <number>1</number>
-              <state>{state}</state>
-              <chargeId>4A8EFBD2-8996-11EB-8996-11EBAEA263C0</chargeId>
-              <user>{user}</user>
-              <userType>RFID</userType>
-              <requestDate>{requestDate}</requestDate>
-              <beginDate>{beginDate}</beginDate>
-              <endDate>-1.000000</endDate>
-              <chargeTime>{chargeTime}</chargeTime>
-              <stopped>{stopped}</stopped>
-              <stoppedByError>F</stoppedByError>
-              <activeEnergy>{activeEnergy}</activeEnergy>
-              <partialActiveEnergy>{partialActiveEnergy}</partialActiveEnergy>
-              {socket}
-            </chargeInfo>
-          </chargesInfo>
-        """.format(socket=socket, **data)
-
-    def _get_charge_state(self, data):
-        socket = self._get_socket(data)
-        return """
-          <chargesState>
-            <chargeState>
-              <id>672C24E1-780D-457B-BDD1-C1D3BB5A7D2B.476A1CEA-951D-436A-A6CC-F71B94E48725</id>
-              <name>EVSE.PLUG</name>
-              <number>1</number>
-              <state>{state}</state>
-              <chargingPhases>{chargingPhases}</chargingPhases>
-              <chargeId>4A8EFBD2-8996-11EB-8996-11EBAEA263C0</chargeId>
-              <user>{user}</user>
-              <chargeTime>{chargeTime}</chargeTime>
-              <reduceCurrent>{reduceCurrent}</reduceCurrent>
-              <activeEnergy>{activeEnergy}</activeEnergy>
-              <partialActiveEnergy>{partialActiveEnergy}</partialActiveEnergy>
-              <currentL1>{currentL1}</currentL1>
-              <currentL2>{currentL2}</currentL2>
-              <currentL3>{currentL3}</currentL3>
-              <currentIII>0</currentIII>
-              <voltageL1>{voltageL1}</voltageL1>
-              <voltageL2>{voltageL2}</voltageL2>
-              <voltageL3>{voltageL3}</voltageL3>
-              <voltageIII>0</voltageIII>
-              <activePower>{activePower}</activePower>
-              {socket}
-            </chargeState>
-          </chargesState>
-        """.format(socket=socket, **data)
-
-    def handle_post_data(self, url_path, post_data):
-        if url_path == "/services/cpi/reduceCurrent.xml":
-            xml = ET.fromstring(post_data)
-            for tag in xml.findall('current'):
-                self.req_max_i = int(tag.text)
-                logging.info("new charger current: %s", self.req_max_i)
-            return "", "text/plain"
-
-        if url_path == "/services/cpi/plugCurrent.xml":
-            # reduce current is only effective during charging
-            if self.is_charging():
-                xml = ET.fromstring(post_data)
-                for tag in xml.findall('current'):
-                    self.req_max_i = int(tag.text)
-                    logging.info("new charger current: %s", self.req_max_i)
-            return "", "text/plain"
-
-        if url_path == "/services/cpi/stopCharge.xml":
-            self.req_max_i = 0
-            logging.info("stopping charging")
-        if url_path == "/services/cpi/pauseCharge.xml":
-            self.req_max_i = 0
-            logging.info("pausing charging")
-            return "", "text/plain"
-
-        if url_path == "/services/cpi/startCharge.xml":
-            self.req_max_i = self._DEV_MAX_I
-            logging.info("resuming charging")
-            return "", "text/plain"
-
-        return super().handle_post_data(url_path, post_data)
+    def _render_charge_info(self, cache):
+        socket = self._get_cached(cache, 'socket', self._get_socket)
+        return _CHARGE_INFO.format(socket=socket, **cache['data'])
+
+    def _render_charge_state(self, cache):
+        socket = self._get_cached(cache, 'socket', self._get_socket)
+        return _CHARGE_STATE.format(socket=socket, **cache['data'])
+
+    @get("/services/cpi/socketInfo.xml", versioned=True)
+    def _get_socket_info(self, query):
+        return self._get_xml('socketInfo', self._render_socket_info)
+
+    @get("/services/cpi/socketState.xml", versioned=True)
+    def _get_socket_state(self, query):
+        return self._get_xml('socketState', self._render_socket_state)
+
+    @get("/services/cpi/chargeInfo.xml", versioned=True)
+    def _get_charge_info(self, query):
+        return self._get_xml('chargeInfo', self._render_charge_info)
+
+    @get("/services/cpi/chargeState.xml", versioned=True)
+    def _get_charge_state(self, query):
+        return self._get_xml('chargeState', self._render_charge_state)
+
+    def _get_currents(self, post_data):
+        # out of range currents are ignored
+        currents = []
+        for current in parse_currents(post_data):
+            if self.is_valid_current(current):
+                currents.append(current)
+            else:
+                logging.warning("invalid charger current: %s", current)
+        return currents
+
+    def _parse_currents(self, path, query, post_data):
+        return [(path, current) for current in self._get_currents(post_data)]
+
+    def _set_currents(self, post_data):
+        for current in self._get_currents(post_data):
+            self.req_max_i = current
+            logging.info("new charger current: %s", self.req_max_i)
+
+    @post("/services/cpi/reduceCurrent.xml", parse=_parse_currents)
+    def _post_reduce_current(self, query, post_data):
+        self._set_currents(post_data)
+        return "", "text/plain"
+
+    @post("/services/cpi/plugCurrent.xml", parse=_parse_currents)
+    def _post_plug_current(self, query, post_data):
+        # reduce current is only effective during charging
+        if self.is_charging():
+            self._set_currents(post_data)
+        return "", "text/plain"
+
+    @post("/services/cpi/stopCharge.xml")
+    def _post_stop_charge(self, query, post_data):
+        self.req_max_i = 0
+        logging.info("stopping charging")
+        return "", "text/plain"
+
+    @post("/services/cpi/pauseCharge.xml")
+    def _post_pause_charge(self, query, post_data):
+        self.req_max_i = 0
+        logging.info("pausing charging")
+        return "", "text/plain"
+
+    @post("/services/cpi/startCharge.xml")
+    def _post_start_charge(self, query, post_data):
+        self.req_max_i = self._DEV_MAX_I
+        logging.info("resuming charging")
+        return "", "text/plain"
@@ -4,9 +4,10 @@
 
 import logging
 import json
-from datetime import datetime
+from json.encoder import encode_basestring
 
 from charger import Charger, ChargerState
+from routes import get, post, command
 
 
 # see https://github.com/goecharger/go-eCharger-API-v1/blob/master/go-eCharger%20API%20v1%20DE.md
@@ -22,42 +23,93 @@ from charger import Charger, ChargerState
 
 
 class DeviceGoe(Charger):
-    def handle_get_data(self, url_path):
-        if url_path != "/status":
-            return super().handle_get_data(url_path)
+    __slots__ = ()
 
+    # keys of the status payload that change at runtime, all other values are constant
+    _DYNAMIC_STATUS_KEYS = ("car", "alw", "dws", "uby", "eto", "nrg", "amp")
+    _status_template = None  # pre-encoded constant parts of the status payload, per class
+
+    @get("/status")
+    def _handle_status(self, query):
+        return self._get_status(), "application/json"
+
+    @classmethod
+    def _get_status_template(cls, sample):
+        # encode the payload with markers for the dynamic values and split it there
+        template = cls.__dict__.get('_status_template')
+        if template is None:
+            result = sample._get_status_dict()
+            for key in cls._DYNAMIC_STATUS_KEYS:
+                result[key] = "@@" + key + "@@"
+            encoded = json.dumps(result)
+            template = []
+            for key in cls._DYNAMIC_STATUS_KEYS:
+                segment, encoded = encoded.split('"@@' + key + '@@"')
+                template.append(segment.encode())
+            template.append(encoded.encode())
+            cls._status_template = template
+        return template
+
+    def _get_status(self):
+        """Status payload as encoded JSON, same as json.dumps(self._get_status_dict())."""
+        template = self._get_status_template(self)
+        dynamic = self._get_dynamic_status()
+        # all dynamic values but nrg are strings, in order of _DYNAMIC_STATUS_KEYS
+        nrg = dynamic.pop("nrg")
+        values = [encode_basestring(value).encode() for value in dynamic.values()]
+        values.insert(self._DYNAMIC_STATUS_KEYS.index("nrg"), json.dumps(nrg).encode())
+        parts = [None] * (2 * len(values) + 1)
+        parts[0::2] = template
+        parts[1::2] = values
+        return b"".join(parts)
+
+    def _get_dynamic_status(self):
         # determine charging state
         car = 1  # default
         if self.is_charging():
             car = 2
         elif self.state == ChargerState.STOPPED_AFTER_CHARGING or self.req_max_i == 0:
             car = 4
+        cur_u = self.cur_u
+        cur_i = self.cur_i
+        return {
+            "car": str(car),
+            "alw": "1" if self.charger_current > 0 or not self.is_charging() else "0",
+            "dws": str(self.e_session * 360000),
+            "uby": str(self.auth_user) if self.is_charging() else "0",
+            "eto": str(self.e_total * 10),
+            "nrg": [
+                cur_u[0], cur_u[1], cur_u[2], 0,
+                cur_i[0] * 10, cur_i[1] * 10, cur_i[2] * 10,
+                cur_u[0] * cur_i[0] / 100, cur_u[1] *
+                cur_i[1] / 100, cur_u[2] * cur_i[2] / 100, 0,
+                self.cur_power / 10,
+                0, 0, 0, 0,
+            ],
+            "amp": str(self.req_max_i) if self.req_max_i is not None else str(self._DEV_MAX_I),
+        }
+
+    def _get_status_dict(self):
+        dynamic = self._get_dynamic_status()
         result = {
             "version": "B",
             "rbc": "251",
             "rbt": "2208867",
-            "car": str(car),
+            "car": dynamic["car"],
             "err": "0",
             "ast": "0",
-            "alw": "1" if self.charger_current > 0 or not self.is_charging() else "0",
+            "alw": dynamic["alw"],
             "stp": "0",
             "cbl": "0",
             "pha": "8",
             "tmp": "30",
-            "dws": str(self.e_session * 360000),
+            "dws": dynamic["dws"],
             "dwo": "0",
             "adi": "1",
-            "uby": str(self.auth_user) if self.is_charging() else "0",
-            "eto": str(self.e_total * 10),
+            "uby": dynamic["uby"],
+            "eto": dynamic["eto"],
             "wst": "3",
-            "nrg": [
-                self.cur_u[0], self.cur_u[1], self.cur_u[2], 0,
-                self.cur_i[0] * 10, self.cur_i[1] * 10, self.cur_i[2] * 10,
-                self.cur_u[0] * self.cur_i[0] / 100, self.cur_u[1] *
-                self.cur_i[1] / 100, self.cur_u[2] * self.cur_i[2] / 100, 0,
-                self.cur_power / 10,
-                0, 0, 0, 0,
-            ],
+            "nrg": dynamic["nrg"],
             "fwv": "020-rc1",
             "sse": "000000",
             "wss": "goe",
@@ -69,7 +121,7 @@ class DeviceGoe(Charger):
             "aho": "2",
             "afi": "8",
             "ama": str(self._DEV_MAX_I),
-            "amp": str(self.req_max_i) if self.req_max_i is not None else str(self._DEV_MAX_I),
+            "amp": dynamic["amp"],
             "al1": "11",
             "al2": "12",
             "al3": "15",
@@ -115,29 +167,45 @@ class DeviceGoe(Charger):
             "rn9": "",
             "rn1": ""
         }
-        return json.dumps(result), "application/json"
-
-    def handle_post_data(self, url_path, post_data):
-        if not url_path.startswith("/mqtt?payload="):
-            return super().handle_post_data(url_path, post_data)
-
-        command = url_path[len("/mqtt?payload="):]
-        if command.startswith("amp="):
-            # set new charger current
-            self.req_max_i = int(command[len("amp="):])
-            logging.info("new charger current: %s", self.req_max_i)
-
-        elif command.startswith("alw="):
-            # suspend/resume charging
-            is_enable = int(command[len("amp="):])
-            if is_enable:
-                self.req_max_i = self._DEV_MAX_I
-                logging.info("resuming charging")
-            else:
-                self.req_max_i = 0
-                logging.info("stopping charging")
+        return result
 
-        else:
-            logging.warning("unhandled command: %s", command)
+    def _parse_mqtt(self, path, query, post_data):
+        commands = []
+        for payload in query.get("payload", ()):
+            try:
+                commands.append(self.parse_command(payload))
+            except ValueError:
+                continue  # ignored, logged when handled
+        return commands
 
+    @post("/mqtt", parse=_parse_mqtt)
+    def _post_mqtt(self, query, post_data):
+        # e.g. /mqtt?payload=amp=16
+        for payload in query.get("payload", ()):
+            self.handle_command(payload)
         return "", "text/plain"
+
+    def _parse_current(self, value):
+        current = int(value)
+        if not self.is_valid_current(current):
+            raise ValueError("current out of range")
+        return current
+
+    @command("amp", parse=_parse_current)
+    def _set_current(self, current):
+        # set new charger current
+        self.req_max_i = current
+        logging.info("new charger current: %s", self.req_max_i)
+
+    def _parse_allowed(self, value):
+        return int(bool(int(value)))
+
+    @command("alw", parse=_parse_allowed)
+    def _set_allowed(self, allowed):
+        # suspend/resume charging
+        if allowed:
+            self.req_max_i = self._DEV_MAX_I
+            logging.info("resuming charging")
+        else:
+            self.req_max_i = 0
+            logging.info("stopping charging")
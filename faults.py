@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+# Injected misbehaviour of chargers, to test controllers against slow or flaky devices.
+# Faults are drawn per request with the probabilities of the "faults" setting of a
+# fleet group, or of the settings given at runtime by POST /faults:
+# {
+#     "delay": {"probability": 0.1, "seconds": [0.5, 5]},
+#     "timeout": 0.01,
+#     "drop": 0.01,
+#     "error": {"probability": 0.02, "status": 503},
+#     "stale": 0.05,
+#     "ignore_commands": 0.1
+# }
+# - delay: the request is handled late, "seconds" is a fixed value, a [low, high]
+#   uniform range, or {"mean": <seconds>} for exponentially distributed delays
+# - timeout: no response, the connection is held open for TIMEOUT_HOLD seconds
+# - drop: the connection is closed without response
+# - error: a response with the given status, 500 by default
+# - stale: a GET is answered with the previous response to the same path
+# - ignore_commands: a control request is acknowledged but not applied
+# A probability alone stands for {"probability": <p>}. Delays are awaited by the
+# asyncio front-end per connection, so other chargers and the tick are not held up.
+
+import json
+from http import HTTPStatus
+
+import metrics
+import rng
+from bulkapi import parse_ids
+from fleetconfig import DEVICE_TYPES
+
+DELAY, TIMEOUT, DROP, ERROR, STALE, IGNORE_COMMANDS = "delay", "timeout", "drop", "error", "stale", "ignore_commands"
+FAULTS = (DELAY, TIMEOUT, DROP, ERROR, STALE, IGNORE_COMMANDS)
+
+
+class FaultProfile:
+    """Fault probabilities of a charger."""
+    __slots__ = ('settings', 'probabilities', 'delay', 'error_status')
+
+    def __init__(self, settings):
+        if not isinstance(settings, dict):
+            raise ValueError("faults must be an object of faults and probabilities")
+        unknown = [name for name in settings if name not in FAULTS]
+        if unknown:
+            raise ValueError("unknown faults: {}".format(", ".join(unknown)))
+        self.settings = settings
+        self.probabilities = {}
+        for name, setting in settings.items():
+            if not isinstance(setting, dict):
+                setting = {'probability': setting}
+            probability = setting.get('probability', 1)
+            if not isinstance(probability, (int, float)) or not 0 <= probability <= 1:
+                raise ValueError("invalid probability of {}: {}".format(name, probability))
+            self.probabilities[name] = probability
+        self.delay = self._parse_delay(settings.get(DELAY))
+        error = settings.get(ERROR)
+        status = error.get('status', 500) if isinstance(error, dict) else 500
+        try:
+            self.error_status = HTTPStatus(status)
+        except ValueError:
+            raise ValueError("invalid error status: {}".format(status))
+
+    @staticmethod
+    def _parse_delay(setting):
+        # returns a function drawing a delay from a random generator
+        seconds = setting.get('seconds', 1) if isinstance(setting, dict) else 1
+        try:
+            if isinstance(seconds, dict):
+                rate = 1 / float(seconds['mean'])
+                return lambda random: random.expovariate(rate)
+            if isinstance(seconds, list):
+                low, high = map(float, seconds)
+                return lambda random: random.uniform(low, high)
+            seconds = float(seconds)
+            return lambda random: seconds
+        except (KeyError, TypeError, ValueError, ZeroDivisionError):
+            raise ValueError("invalid delay: {}".format(seconds))
+
+
+class Fault:
+    """Faults drawn for a request."""
+    __slots__ = ('charger_id', 'path', 'delay', 'close', 'hold', 'response', 'remember')
+
+    def __init__(self, charger_id, path):
+        self.charger_id = charger_id
+        self.path = path
+        self.delay = 0  # seconds until the request is handled
+        self.close = False  # close the connection without response
+        self.hold = 0  # seconds the connection is held open before
+        self.response = None  # status, content, content type and entity tag instead of the charger's
+        self.remember = False  # keep the response for stale answers
+
+
+class FaultInjector:
+    TIMEOUT_HOLD = 120  # seconds
+    MAX_STALE_PATHS = 16  # previous responses kept per charger
+
+    def __init__(self, chargers, fleet_config):
+        self.chargers = chargers  # handle to the correspondig chargers, by id
+        self.fleet_config = fleet_config
+        self._group_profiles = {}  # by group
+        for group in fleet_config.groups:
+            if group.faults is not None:
+                self._group_profiles[group] = FaultProfile(group.faults)
+        self._profiles = {}  # set at runtime, by charger id, None if cleared despite group faults
+        self._responses = {}  # previous responses by charger id and path
+        self._random = rng.derive("faults")
+
+    @property
+    def active(self):
+        return bool(self._group_profiles or self._profiles)
+
+    def get_profile(self, charger_id):
+        if charger_id in self._profiles:
+            return self._profiles[charger_id]
+        return self._group_profiles.get(self.fleet_config.get_group(charger_id))
+
+    def decide(self, charger_id, method, path):
+        """Draws the faults of a request to a charger, None if there are none."""
+        profile = self.get_profile(charger_id)
+        if profile is None:
+            return None
+        probabilities = profile.probabilities
+        random = self._random.random
+        fault = Fault(charger_id, path)
+        if random() < probabilities.get(DELAY, 0):
+            fault.delay = profile.delay(self._random)
+            metrics.INJECTED_FAULTS[DELAY] += 1
+        if random() < probabilities.get(DROP, 0):
+            fault.close = True
+            metrics.INJECTED_FAULTS[DROP] += 1
+        elif random() < probabilities.get(TIMEOUT, 0):
+            fault.close = True
+            fault.hold = self.TIMEOUT_HOLD
+            metrics.INJECTED_FAULTS[TIMEOUT] += 1
+        elif random() < probabilities.get(ERROR, 0):
+            fault.response = (profile.error_status, "", "text/plain", None)
+            metrics.INJECTED_FAULTS[ERROR] += 1
+        elif method == "GET" and STALE in probabilities:
+            previous = self._responses.get(charger_id, {}).get(path)
+            if previous is not None and random() < probabilities[STALE]:
+                fault.response = previous
+                metrics.INJECTED_FAULTS[STALE] += 1
+            else:
+                fault.remember = True
+        elif method != "GET" and random() < probabilities.get(IGNORE_COMMANDS, 0):
+            fault.response = (HTTPStatus.OK, "", "text/plain", None)
+            metrics.INJECTED_FAULTS[IGNORE_COMMANDS] += 1
+        return fault
+
+    def remember(self, fault, response):
+        """Keeps the response to the request of a fault for stale answers."""
+        if response[0] != HTTPStatus.OK or not isinstance(response[1], (str, bytes)):
+            return
+        responses = self._responses.setdefault(fault.charger_id, {})
+        if fault.path in responses or len(responses) < self.MAX_STALE_PATHS:
+            responses[fault.path] = response
+
+    def _select_groups(self, query):
+        if "device" not in query:
+            return list(self.fleet_config.groups)
+        names = query["device"][0].split(",")
+        unknown = [name for name in names if name not in DEVICE_TYPES]
+        if unknown:
+            raise ValueError("unknown device types: {}".format(", ".join(unknown)))
+        device_classes = tuple(DEVICE_TYPES[name] for name in names)
+        return [group for group in self.fleet_config.groups if issubclass(group.device_class, device_classes)]
+
+    def handle_request(self, query):
+        """Admin endpoint, fault settings of the groups, or of the ?ids=<id>[-<id>],... chargers."""
+        if "ids" in query:
+            chargers = {}
+            for charger_id in parse_ids(query["ids"][0], self.fleet_config):
+                if charger_id in self.chargers:
+                    profile = self.get_profile(charger_id)
+                    chargers[charger_id] = profile.settings if profile is not None else None
+            return json.dumps({'chargers': chargers, 'injected': dict(metrics.INJECTED_FAULTS)}), "application/json"
+        groups = []
+        for group in self._select_groups(query):
+            profile = self._group_profiles.get(group)
+            groups.append({'first_id': group.first_id, 'count': group.count,
+                           'faults': profile.settings if profile is not None else None})
+        return json.dumps({'groups': groups, 'chargers': {charger_id: profile.settings if profile is not None else None
+                                                          for charger_id, profile in self._profiles.items()},
+                           'injected': dict(metrics.INJECTED_FAULTS)}), "application/json"
+
+    def handle_post_request(self, query, post_data):
+        """Admin POST endpoint, sets the faults of the ?ids=... or ?device=... or of all chargers, null clears them."""
+        try:
+            settings = json.loads(post_data or b"null")
+        except ValueError:
+            raise ValueError("invalid JSON")
+        profile = FaultProfile(settings) if settings is not None else None
+        if "ids" in query:
+            selected = [charger_id for charger_id in parse_ids(query["ids"][0], self.fleet_config)
+                        if charger_id in self.chargers]
+            for charger_id in selected:
+                if profile is None and self.fleet_config.get_group(charger_id) not in self._group_profiles:
+                    # nothing left to override, keeps the injector inactive once all faults are cleared
+                    self._profiles.pop(charger_id, None)
+                else:
+                    self._profiles[charger_id] = profile
+                self._responses.pop(charger_id, None)
+            return json.dumps({'updated': len(selected)}), "application/json"
+
+        # whole groups, replacing the settings of their single chargers
+        groups = self._select_groups(query)
+        for group in groups:
+            if profile is not None:
+                self._group_profiles[group] = profile
+            else:
+                self._group_profiles.pop(group, None)
+        for charger_id in list(self._profiles):
+            if self.fleet_config.get_group(charger_id) in groups:
+                del self._profiles[charger_id]
+                self._responses.pop(charger_id, None)
+        return json.dumps({'updated': sum(group.count for group in groups)}), "application/json"
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+import heapq
+import itertools
+
+try:
+    import numpy as np
+except ImportError:  # only required for the vectorized fleet engine
+    np = None
+
+import clock
+import rng
+from charger import ChargerState, FLEET_FIELDS
+
+
+# columns of Fleet.sample()
+SAMPLE_COLUMNS = ('state', 'cur_power', 'cur_i1', 'cur_i2', 'cur_i3', 'e_session', 'e_total')
+
+
+class Fleet:
+    """Set of chargers updated once per simulation tick."""
+    samples_on_access = False  # measurements are only derived when a charger is requested
+
+    def __init__(self):
+        self.chargers = []
+
+    def add(self, charger):
+        self.chargers.append(charger)
+
+    def tick(self):
+        for cur_charger in self.chargers:
+            cur_charger.update_state()
+
+    def before_request(self, charger):
+        """Called by the HTTP front-ends before a charger is read or controlled."""
+        pass
+
+    def aggregate(self):
+        """Fleet totals as tuple of charging power, phase currents L1-L3 and total energy."""
+        power = i_l1 = i_l2 = i_l3 = e_total = 0
+        for cur_charger in self.chargers:
+            cur_i = cur_charger.cur_i
+            power += cur_charger.cur_power
+            i_l1 += cur_i[0]
+            i_l2 += cur_i[1]
+            i_l3 += cur_i[2]
+            e_total += cur_charger.e_total
+        return power, i_l1, i_l2, i_l3, e_total
+
+    def sample(self):
+        """Current measurements of all chargers as columns."""
+        data = {name: [] for name in SAMPLE_COLUMNS}
+        for cur_charger in self.chargers:
+            self.before_request(cur_charger)
+            data['state'].append(cur_charger.state.value)
+            data['cur_power'].append(cur_charger.cur_power)
+            for phase in range(3):
+                data['cur_i' + str(phase + 1)].append(cur_charger.cur_i[phase])
+            data['e_session'].append(cur_charger.e_session)
+            data['e_total'].append(cur_charger.e_total)
+        return data
+
+
+class EventFleet(Fleet):
+    """Event driven fleet engine.
+
+    State transitions are scheduled in a timer heap keyed on next_state_change,
+    so a tick only handles the chargers whose transition is due. Measurements are
+    derived on transitions and lazily when a charger is accessed, energy is integrated analytically
+    over the elapsed interval. The cost of an idle fleet thus does not depend on its size.
+    """
+
+    REFRESH_INTERVAL = 1  # seconds, measurements are sampled at most once per interval
+    samples_on_access = True
+
+    def __init__(self):
+        super().__init__()
+        self._timers = []  # heap of (next_state_change, sequence number, charger)
+        self._sequence = itertools.count()
+
+    def _schedule(self, charger):
+        heapq.heappush(self._timers, (charger.next_state_change, next(self._sequence), charger))
+
+    def add(self, charger):
+        super().add(charger)
+        self._schedule(charger)
+
+    def tick(self):
+        now = clock.timestamp()
+        while self._timers and self._timers[0][0] < now:
+            due, _, charger = heapq.heappop(self._timers)
+            if due != charger.next_state_change:
+                # outdated timer, the charger got rescheduled meanwhile
+                continue
+            charger._integrate_energy(due)
+            charger._change_state()
+            if charger.state == ChargerState.UNPLUGGED_CAR:
+                charger.e_session = 0
+            # measurements follow the state, e.g. for the site meter
+            charger._sample_measurements()
+            self._schedule(charger)
+
+    def before_request(self, charger):
+        # energy up to now is integrated with the current before any control command changes it
+        if clock.timestamp() - charger._last_update >= self.REFRESH_INTERVAL:
+            charger.refresh()
+
+
+class NumpyFleet(Fleet):
+    """Vectorized fleet engine.
+
+    Charger data is kept as struct-of-arrays columns and the whole fleet is
+    advanced by batched operations. The chargers become views on their row,
+    see Charger._FleetField, so device classes keep reading their attributes.
+    """
+    NOMINAL_U = 230     # V
+    U_SIGMA = 3         # V
+    I_SIGMA = 0.05      # A
+
+    # column name: dtype, per-phase
+    _COLUMNS = {
+        'state': ('i1', False),
+        'last_start': ('f8', False),
+        'next_state_change': ('f8', False),
+        'req_max_i': ('f8', False),
+        'e_total': ('f8', False),
+        'e_session': ('f8', False),
+        'charger_current': ('f8', False),
+        'cur_power': ('f8', False),
+        'cur_i': ('f8', True),
+        'cur_u': ('i2', True),
+        'nr_phases': ('i1', False),
+        '_last_update': ('f8', False),
+        'dev_max_i': ('f8', False),
+        'meter_group': ('i4', False),
+    }
+    _TIMESTAMPS = ('last_start', 'next_state_change', '_last_update')
+
+    def __init__(self, capacity=1024, seed=None):
+        if np is None:
+            raise RuntimeError("the vectorized fleet engine requires numpy")
+        super().__init__()
+        self.size = 0
+        self._rng = np.random.default_rng(seed if seed is not None else rng.seed_key(rng.FLEET_STREAM))
+        self.meter = None  # site meter summing up the columns per meter_group after each tick
+        self._columns = {}
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        for name, (dtype, per_phase) in self._COLUMNS.items():
+            column = np.zeros((capacity, 3) if per_phase else capacity, dtype=dtype)
+            if name in self._columns:
+                column[:self.size] = self._columns[name][:self.size]
+            self._columns[name] = column
+        self.capacity = capacity
+
+    def add(self, charger):
+        if self.size == self.capacity:
+            self._allocate(2 * self.capacity)
+        values = {name: getattr(charger, name) for name in FLEET_FIELDS}
+        index = self.size
+        self.size += 1
+        self._columns['dev_max_i'][index] = charger._DEV_MAX_I
+
+        # move its data to its row and bind the charger there
+        for name, value in values.items():
+            self.set_value(name, index, value)
+            delattr(charger, name)
+        charger._fleet = self
+        charger._index = index
+        super().add(charger)
+
+    def get_value(self, name, index):
+        value = self._columns[name][index]
+        if name == 'state':
+            return ChargerState(int(value))
+        if name in self._TIMESTAMPS:
+            return None if np.isnan(value) else value.item()
+        if name == 'req_max_i':
+            return None if np.isnan(value) else int(value)
+        if name in ('cur_i', 'cur_u'):
+            # per-phase values are returned as a snapshot list
+            return value.tolist()
+        return value.item()
+
+    def set_value(self, name, index, value):
+        if name == 'state':
+            value = value.value
+        elif value is None:
+            value = np.nan if name == 'req_max_i' or name in self._TIMESTAMPS else 0
+        self._columns[name][index] = value
+
+    def sample(self):
+        n = self.size
+        col = self._columns
+        return {
+            'state': col['state'][:n].copy(),
+            'cur_power': col['cur_power'][:n].copy(),
+            'cur_i1': col['cur_i'][:n, 0].copy(),
+            'cur_i2': col['cur_i'][:n, 1].copy(),
+            'cur_i3': col['cur_i'][:n, 2].copy(),
+            'e_session': col['e_session'][:n].copy(),
+            'e_total': col['e_total'][:n].copy(),
+        }
+
+    def aggregate(self):
+        n = self.size
+        col = self._columns
+        cur_i = col['cur_i'][:n].sum(axis=0)
+        return (col['cur_power'][:n].sum().item(), cur_i[0].item(), cur_i[1].item(), cur_i[2].item(),
+                col['e_total'][:n].sum().item())
+
+    def set_meter_group(self, index, meter, group):
+        self.meter = meter
+        self._columns['meter_group'][index] = group
+
+    def column(self, name):
+        """Values of a column for all chargers, indexed by their row."""
+        return self._columns[name][:self.size]
+
+    def get_row(self, index):
+        return {name: self.get_value(name, index) for name in FLEET_FIELDS}
+
+    def tick(self):
+        now_ts = clock.timestamp()
+        n = self.size
+        col = {name: column[:n] for name, column in self._columns.items()}
+
+        # state transitions only happen every few minutes per charger, do them one by one
+        for index in np.flatnonzero(col['next_state_change'] < now_ts):
+            self.chargers[index]._change_state()
+
+        # derive charging currents, power, energy
+        current = np.where(col['state'] == ChargerState.CHARGING.value,
+                           np.fmin(col['req_max_i'], col['dev_max_i']), 0)
+        col['charger_current'][:] = current
+        col['cur_u'][:] = np.trunc(self._rng.normal(self.NOMINAL_U, self.U_SIGMA, (n, 3)))
+        active = (current > 0)[:, None] & (np.arange(3) < col['nr_phases'][:, None])
+        noise = self._rng.normal(0, self.I_SIGMA, (n, 3))
+        col['cur_i'][:] = np.where(active, current[:, None] + noise, 0)
+        col['cur_power'][:] = (col['cur_i'] * col['cur_u']).sum(axis=1)
+        energy = col['cur_power'] * (now_ts - col['_last_update']) / 3600000
+        col['e_session'] += energy
+        col['e_total'] += energy
+        col['e_session'][col['state'] >= ChargerState.UNPLUGGED_CAR.value] = 0
+
+        # set last update timestamp
+        col['_last_update'][:] = now_ts
+
+        if self.meter is not None:
+            self.meter.set_column_totals(col['meter_group'], col['cur_power'], col['cur_i'], col['e_total'])
+
+
+# fleet engines by their command line name
+ENGINES = {
+    "python": Fleet,
+    "numpy": NumpyFleet,
+    "event": EventFleet,
+}
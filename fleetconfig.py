@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+# Declarative fleet configuration.
+# A fleet consists of groups of chargers of one device type, each group covering
+# a range of charger ids (ports). Example:
+# {
+#     "lazy": true,
+#     "groups": [
+#         {"device": "goe", "count": 5, "first_id": 8100, "phases": [3, 1], "session_start": [0, 30]},
+#         {"device": "circontrol", "count": 50000, "phases": {"3": 0.7, "1": 0.3},
+#          "session_start": {"uniform": [-1.5, -0.5]}, "meter": "garage"}
+#     ]
+# }
+# phases and session_start are either a single value, a list cycled through the group,
+# a {"uniform": [low, high]} distribution or a {value: weight} mix.
+# meter names the group of the site meter totals the chargers are part of.
+# faults sets the probabilities of injected faults of the chargers, see faults.py.
+# Random draws are seeded by the charger id, so a charger gets the same settings
+# independent of the order of its instantiation.
+
+import bisect
+import heapq
+import json
+import random
+from collections.abc import Mapping
+from charger import parse_timestamp
+from devicegoe import DeviceGoe
+from devicecircontrol import DeviceCircontrol
+
+try:
+    import tomllib
+except ImportError:  # python < 3.11, only json configurations are supported
+    tomllib = None
+
+
+DEVICE_TYPES = {
+    "goe": DeviceGoe,
+    "circontrol": DeviceCircontrol,
+}
+
+DEFAULT_START_ID = 8100
+
+# the fleet simulated if no configuration is given
+DEFAULT_FLEET = {
+    "groups": [
+        {"device": "goe", "count": 5, "phases": [3, 1, 3, 2, 3], "session_start": [0, 10, 20, 30, 40]},
+        {"device": "goe", "count": 5, "phases": [3, 1, 3, 2, 3], "session_start": [-0.3, -0.6, -0.9, -1.2, -1.5]},
+        {"device": "circontrol", "count": 5, "phases": [3, 1, 3, 2, 3], "session_start": [0, 10, 20, 30, 40]},
+        {"device": "circontrol", "count": 5, "phases": [3, 1, 3, 2, 3],
+         "session_start": [-0.3, -0.6, -0.9, -1.2, -1.5]},
+        {"device": "circontrol", "count": 100, "phases": [3, 1, 3, 2, 3], "session_start": -1},
+    ],
+}
+
+
+def _draw(setting, index, rng):
+    if isinstance(setting, list):
+        return setting[index % len(setting)]
+    if isinstance(setting, dict):
+        if "uniform" in setting:
+            return rng.uniform(*setting["uniform"])
+        values = list(setting.keys())
+        value = rng.choices(values, weights=[setting[key] for key in values])[0]
+        return float(value) if isinstance(value, str) else value
+    return setting
+
+
+class ChargerGroup:
+    def __init__(self, device, count, first_id, phases=3, session_start=-1, meter=None, faults=None):
+        if device not in DEVICE_TYPES:
+            raise ValueError("unknown device type: {}".format(device))
+        self.device_class = DEVICE_TYPES[device]
+        self.count = count
+        self.first_id = first_id
+        self.phases = phases
+        self.session_start = session_start
+        self.meter = meter  # site meter group
+        self.faults = faults  # fault settings, see faults.py
+
+    def __contains__(self, charger_id):
+        return self.first_id <= charger_id < self.first_id + self.count
+
+    def ids(self):
+        return range(self.first_id, self.first_id + self.count)
+
+    def get_settings(self, charger_id):
+        """Returns session start and number of phases of a charger."""
+        index = charger_id - self.first_id
+        rng = random.Random(charger_id)
+        return _draw(self.session_start, index, rng), int(_draw(self.phases, index, rng))
+
+
+class FleetConfig:
+    def __init__(self, groups, lazy=False):
+        self.groups = sorted(groups, key=lambda group: group.first_id)
+        self.lazy = lazy
+        self._first_ids = [group.first_id for group in self.groups]
+        for prev_group, group in zip(self.groups, self.groups[1:]):
+            if prev_group.first_id + prev_group.count > group.first_id:
+                raise ValueError("overlapping charger ids at {}".format(group.first_id))
+
+    @classmethod
+    def from_dict(cls, data):
+        groups = []
+        next_id = DEFAULT_START_ID
+        for group in data["groups"]:
+            group = dict(group)
+            first_id = group.pop("first_id", next_id)
+            groups.append(ChargerGroup(first_id=first_id, **group))
+            next_id = first_id + group["count"]
+        return cls(groups, data.get("lazy", False))
+
+    @classmethod
+    def load(cls, path):
+        if path.endswith(".toml"):
+            if tomllib is None:
+                raise ValueError("TOML fleet configurations require python 3.11")
+            with open(path, "rb") as configfile:
+                return cls.from_dict(tomllib.load(configfile))
+        with open(path, "r") as configfile:
+            return cls.from_dict(json.load(configfile))
+
+    def get_group(self, charger_id):
+        pos = bisect.bisect_right(self._first_ids, charger_id) - 1
+        if pos >= 0 and charger_id in self.groups[pos]:
+            return self.groups[pos]
+        return None
+
+    def ids(self):
+        for group in self.groups:
+            yield from group.ids()
+
+    def __len__(self):
+        return sum(group.count for group in self.groups)
+
+
+class ChargerMap(Mapping):
+    """Chargers of a fleet by id, instantiated on first access.
+
+    create is called with the group and id of a charger that is accessed the first time.
+    Chargers with a stored snapshot are also instantiated when their next state change is due.
+    """
+
+    def __init__(self, config, create, include=None, snapshots=None):
+        self.config = config
+        self._create = create
+        self._include = include  # optional filter on the charger ids
+        self._chargers = {}
+        self._due = []  # heap of (next_state_change, id) of restorable chargers
+        for charger_id, datadump in (snapshots or {}).items():
+            if charger_id in self:
+                next_change = parse_timestamp(datadump['next_state_change'])
+                self._due.append((next_change, charger_id))
+        heapq.heapify(self._due)
+
+    def __getitem__(self, charger_id):
+        charger = self._chargers.get(charger_id)
+        if charger is None:
+            group = self.config.get_group(charger_id) if isinstance(charger_id, int) else None
+            if group is None or (self._include is not None and not self._include(charger_id)):
+                raise KeyError(charger_id)
+            charger = self._chargers[charger_id] = self._create(group, charger_id)
+        return charger
+
+    def __contains__(self, charger_id):
+        if charger_id in self._chargers:
+            return True
+        return isinstance(charger_id, int) and self.config.get_group(charger_id) is not None and \
+            (self._include is None or self._include(charger_id))
+
+    def __iter__(self):
+        if self._include is None:
+            return self.config.ids()
+        return filter(self._include, self.config.ids())
+
+    def __len__(self):
+        if self._include is None:
+            return len(self.config)
+        return sum(1 for _ in self)
+
+    def instantiated(self):
+        """The chargers created so far."""
+        return self._chargers.values()
+
+    def create_due(self, now):
+        """Instantiates the restorable chargers with a state change due before the given timestamp."""
+        while self._due and self._due[0][0] < now:
+            _, charger_id = heapq.heappop(self._due)
+            self[charger_id]
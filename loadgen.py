@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+# Load generator and latency benchmark.
+# Emulates energy management clients polling and controlling the simulated
+# chargers over loopback and reports throughput and latency percentiles.
+
+import logging
+import argparse
+import asyncio
+import multiprocessing
+import random
+import time
+
+from fleetconfig import FleetConfig, DEFAULT_FLEET
+from devicegoe import DeviceGoe
+from devicecircontrol import DeviceCircontrol
+
+
+class Target:
+    """Requests of one charger, by device type."""
+
+    def __init__(self, charger_id, device_class, port, prefix=""):
+        self.charger_id = charger_id
+        self.port = port
+        self.prefix = prefix  # path prefix on a multiplexed port
+        if issubclass(device_class, DeviceGoe):
+            self.gets = ["/status"]
+            self.post = lambda current: ("/mqtt?payload=amp={}".format(current), b"")
+        elif issubclass(device_class, DeviceCircontrol):
+            self.gets = ["/services/cpi/chargeState.xml", "/services/cpi/socketInfo.xml"]
+            self.post = lambda current: (
+                "/services/cpi/reduceCurrent.xml",
+                "<device><id>EVCommDevice</id><current>{}</current></device>".format(current).encode())
+        else:
+            self.gets = ["/"]
+            self.post = None
+
+    def request(self, rng, post_share):
+        if self.post is not None and rng.random() < post_share:
+            path, body = self.post(rng.randint(6, 32))
+            return "POST", self.prefix + path, body
+        return "GET", self.prefix + rng.choice(self.gets), None
+
+
+class Client:
+    """One emulated poller with kept alive connections."""
+
+    def __init__(self, host, targets, interval, post_share, seed):
+        self.host = host
+        self.targets = targets
+        self.interval = interval  # seconds between requests, 0 for closed loop
+        self.post_share = post_share
+        self.rng = random.Random(seed)
+        self.latencies = []
+        self.errors = 0
+        self._connections = {}  # port: (reader, writer)
+
+    async def _connection(self, port):
+        connection = self._connections.get(port)
+        if connection is None:
+            connection = self._connections[port] = await asyncio.open_connection(self.host, port)
+        return connection
+
+    async def _send(self, port, method, path, body):
+        reader, writer = await self._connection(port)
+        request = "{} {} HTTP/1.1\r\nHost: {}\r\n".format(method, path, self.host)
+        if body is not None:
+            request += "Content-Length: {}\r\n".format(len(body))
+        writer.write(request.encode() + b"\r\n" + (body or b""))
+
+        status = int((await reader.readline()).split()[1])
+        content_length = 0
+        keep_alive = True
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            name = name.strip().lower()
+            if name == "content-length":
+                content_length = int(value)
+            elif name == "connection" and value.strip().lower() == "close":
+                keep_alive = False
+        if content_length:
+            await reader.readexactly(content_length)
+        if not keep_alive:
+            writer.close()
+            del self._connections[port]
+        return status
+
+    async def run(self, deadline):
+        next_send = time.perf_counter()
+        while True:
+            if self.interval:
+                # latency counts from the scheduled time, so a stalled server is not hidden
+                await asyncio.sleep(max(next_send - time.perf_counter(), 0))
+                start = next_send
+                next_send += self.interval
+            else:
+                start = time.perf_counter()
+            if start >= deadline:
+                break
+            target = self.rng.choice(self.targets)
+            method, path, body = target.request(self.rng, self.post_share)
+            try:
+                status = await self._send(target.port, method, path, body)
+                if status >= 400:
+                    self.errors += 1
+            except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+                self.errors += 1
+                connection = self._connections.pop(target.port, None)
+                if connection is not None:
+                    connection[1].close()
+                continue
+            self.latencies.append(time.perf_counter() - start)
+        for _, writer in self._connections.values():
+            writer.close()
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
+
+
+async def run_load(targets, host="localhost", duration=10, rate=0, nr_clients=10, post_share=0.05):
+    """Runs the load and returns the report as dict."""
+    interval = nr_clients / rate if rate else 0
+    clients = [Client(host, targets[i::nr_clients] or targets, interval, post_share, i) for i in range(nr_clients)]
+    start = time.perf_counter()
+    await asyncio.gather(*(client.run(start + duration) for client in clients))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for client in clients for latency in client.latencies)
+    return {
+        'requests': len(latencies),
+        'errors': sum(client.errors for client in clients),
+        'throughput': len(latencies) / elapsed,
+        'p50': _percentile(latencies, 0.50),
+        'p95': _percentile(latencies, 0.95),
+        'p99': _percentile(latencies, 0.99),
+        'max': latencies[-1] if latencies else float("nan"),
+    }
+
+
+def _run_simulator(sim_args, stats):
+    # simulator hosted in a child process, publishing its tick statistics
+    from chargersim import ChargerSim
+
+    def publish(sim):
+        stats[:] = [sim.nr_ticks, sim.tick_lag_total, sim.tick_lag_max, sim.tick_duration_total]
+
+    sim = ChargerSim(**sim_args)
+    sim.tick_listeners.append(publish)
+    sim.run()
+
+
+def create_targets(fleet_config, nr_chargers, mux_port=None):
+    targets = []
+    for charger_id in fleet_config.ids():
+        if len(targets) >= nr_chargers:
+            break
+        device_class = fleet_config.get_group(charger_id).device_class
+        if mux_port is None:
+            targets.append(Target(charger_id, device_class, charger_id))
+        else:
+            targets.append(Target(charger_id, device_class, mux_port, "/c/{}".format(charger_id)))
+    return targets
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator polling the simulated chargers.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--fleet", help="fleet configuration of the simulator, default is its built-in fleet")
+    parser.add_argument("--chargers", type=int, default=120, help="number of polled chargers")
+    parser.add_argument("--mux-port", type=int, help="address all chargers via this multiplexed port")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="total requests per second, default is as fast as possible")
+    parser.add_argument("--clients", type=int, default=10, help="number of concurrent clients")
+    parser.add_argument("--post-share", type=float, default=0.05, help="share of control requests")
+    parser.add_argument("--self-host", action="store_true",
+                        help="start the simulator in a child process and report its tick lag")
+    parser.add_argument("--engine", default="python", help="engine of the self hosted simulator")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(message)s')
+
+    fleet_config = FleetConfig.load(args.fleet) if args.fleet else FleetConfig.from_dict(DEFAULT_FLEET)
+    targets = create_targets(fleet_config, args.chargers, args.mux_port)
+
+    simulator = None
+    if args.self_host:
+        stats = multiprocessing.RawArray('d', 4)
+        sim_args = dict(server_mode="asyncio", engine=args.engine, fleet_config=fleet_config,
+                        mux_port=args.mux_port, charger_ports=args.mux_port is None)
+        simulator = multiprocessing.Process(target=_run_simulator, args=(sim_args, stats), daemon=True)
+        simulator.start()
+        time.sleep(2)  # let the simulator open its ports
+        stats_before = stats[:]
+
+    try:
+        report = asyncio.run(run_load(targets, args.host, args.duration, args.rate, args.clients, args.post_share))
+    finally:
+        if simulator is not None:
+            simulator.terminate()
+
+    print("requests   {requests:>10d}  errors {errors}".format(**report))
+    print("throughput {throughput:>10.0f} requests/s".format(**report))
+    print("latency    p50 {:.2f} ms  p95 {:.2f} ms  p99 {:.2f} ms  max {:.2f} ms".format(
+        *(1000 * report[key] for key in ('p50', 'p95', 'p99', 'max'))))
+    if simulator is not None:
+        # ticks during the load, the maximum lag also covers the start up
+        nr_ticks = stats[0] - stats_before[0]
+        print("tick       {:.0f} ticks  lag mean {:.2f} ms  max {:.2f} ms  duration mean {:.2f} ms".format(
+            nr_ticks, 1000 * (stats[1] - stats_before[1]) / max(nr_ticks, 1), 1000 * stats[2],
+            1000 * (stats[3] - stats_before[3]) / max(nr_ticks, 1)))
+
+
+if __name__ == '__main__':
+    main()
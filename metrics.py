@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+# Simulator metrics in the Prometheus text format.
+# Histogram series are allocated on their first observation, recording then only
+# increments preallocated counters, so metrics are always on.
+
+import bisect
+from collections import Counter
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+# seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+TICK_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    # label value as quoted in the text format
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _HistogramSeries:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # per bucket, not cumulative, last one is +Inf
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Histogram:
+    MAX_SERIES = 200  # further label combinations are recorded as "other"
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # by tuple of label values
+
+    def labels(self, *values):
+        series = self._series.get(values)
+        if series is None:
+            if len(self._series) >= self.MAX_SERIES:
+                values = ("other",) * len(self.label_names)
+                series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = _HistogramSeries(self.buckets)
+        return series
+
+    def observe(self, value):
+        """Records a value of the unlabelled histogram."""
+        self.labels().observe(value)
+
+    def render(self, lines):
+        lines.append("# HELP {} {}".format(self.name, self.documentation))
+        lines.append("# TYPE {} histogram".format(self.name))
+        for values, series in sorted(self._series.items()):
+            labels = ",".join('{}="{}"'.format(name, _escape(value)) for name, value in zip(self.label_names, values))
+            separator = "," if labels else ""
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series.counts):
+                total += count
+                lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(self.name, labels, separator, bound, total))
+            labels = "{" + labels + "}" if labels else ""
+            lines.append("{}_sum{} {}".format(self.name, labels, series.sum))
+            lines.append("{}_count{} {}".format(self.name, labels, total))
+
+
+REQUEST_DURATION = Histogram("chargersim_request_duration_seconds",
+                             "Time to handle a request, by device type and route.", ("device", "path"))
+TICK_DURATION = Histogram("chargersim_tick_duration_seconds",
+                          "Time to update the chargers in one tick.", buckets=TICK_BUCKETS)
+TICK_LAG = Histogram("chargersim_tick_lag_seconds",
+                     "Delay of a tick behind its schedule.", buckets=TICK_BUCKETS)
+PERSISTENCE_WRITE = Histogram("chargersim_persistence_write_seconds",
+                              "Time to write charger data dumps, by storage.", ("storage",), TICK_BUCKETS)
+SPAN_DURATION = Histogram("chargersim_span_duration_seconds",
+                          "Time spent in charger methods, by device type, if spans are enabled.", ("device", "span"))
+
+# injected faults by fault, see faults.py
+INJECTED_FAULTS = Counter()
+
+_request_series = {}  # series of REQUEST_DURATION by device and route
+_NO_SERIES = {}
+
+
+def observe_request(device, route, duration):
+    """Records the duration of a request by the key of the route handling it, see Charger.get_route_key."""
+    series = _request_series.get(device, _NO_SERIES).get(route)
+    if series is None:
+        series = _request_series.setdefault(device, {})[route] = REQUEST_DURATION.labels(device, route)
+    series.observe(duration)
+
+
+def render(chargers, states):
+    """Returns all metrics as Prometheus text, with the given chargers counted by the given states."""
+    lines = []
+    counts = Counter(charger.state for charger in chargers)
+    lines.append("# HELP chargersim_chargers Number of instantiated chargers by state.")
+    lines.append("# TYPE chargersim_chargers gauge")
+    for state in states:
+        lines.append('chargersim_chargers{{state="{}"}} {}'.format(state.name, counts[state]))
+    if INJECTED_FAULTS:
+        lines.append("# HELP chargersim_injected_faults_total Faults injected into charger requests.")
+        lines.append("# TYPE chargersim_injected_faults_total counter")
+        for fault, count in sorted(INJECTED_FAULTS.items()):
+            lines.append('chargersim_injected_faults_total{{fault="{}"}} {}'.format(fault, count))
+    for histogram in (REQUEST_DURATION, TICK_DURATION, TICK_LAG, PERSISTENCE_WRITE, SPAN_DURATION):
+        histogram.render(lines)
+    return "\n".join(lines) + "\n"
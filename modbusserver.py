@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+# Modbus TCP front-end, served by the asyncio event loop.
+# Each port serves up to 247 chargers as unit ids 1-247, in the order of their
+# charger ids: the first 247 chargers on the given port, the next on port + 1, ...
+# Holding and input registers of a charger (function 3 and 4) are the same:
+#   0      state, see ChargerState
+#   1      current limit in A, 0xFFFF for no limit, writable with function 6 and 16
+#   2      charging current in 0.01 A
+#   3-5    currents L1-L3 in 0.01 A
+#   6-8    voltages L1-L3 in V
+#   9-10   active power in W
+#   11-12  session energy in Wh
+#   13-14  total energy in Wh
+#   15     number of phases
+#   16     maximum current of the device in A
+# 32 bit values are big endian, high word first. The registers of all chargers are
+# kept in one preallocated buffer, refreshed once per tick, so a read is a slice of
+# it. Fleets sampling on access refresh the registers of a charger when it is read.
+
+import array
+import asyncio
+import logging
+import struct
+import time
+
+try:
+    import numpy as np
+except ImportError:  # the registers of vectorized fleets are refreshed by numpy
+    np = None
+
+import clock
+import metrics
+
+
+def _u16(value):
+    return min(max(round(value), 0), 0xFFFF)
+
+
+def _u32(value):
+    return min(max(round(value), 0), 0xFFFFFFFF)
+
+
+class ModbusServer:
+    UNITS_PER_PORT = 247
+    NO_LIMIT = 0xFFFF
+    CURRENT_LIMIT_REGISTER = 1
+    MAX_READ_REGISTERS = 125
+
+    READ_HOLDING_REGISTERS = 3
+    READ_INPUT_REGISTERS = 4
+    WRITE_SINGLE_REGISTER = 6
+    WRITE_MULTIPLE_REGISTERS = 16
+
+    ILLEGAL_FUNCTION = 1
+    ILLEGAL_DATA_ADDRESS = 2
+    ILLEGAL_DATA_VALUE = 3
+    TARGET_FAILED = 11
+
+    _MBAP = struct.Struct(">HHHB")  # transaction, protocol, length, unit id
+    _REGISTERS = struct.Struct(">9H3I2H")
+    NR_REGISTERS = _REGISTERS.size // 2
+    _REGISTER_DTYPE = [
+        ('state', '>u2'), ('req_max_i', '>u2'), ('charger_current', '>u2'), ('cur_i', '>u2', (3,)),
+        ('cur_u', '>u2', (3,)), ('power', '>u4'), ('e_session', '>u4'), ('e_total', '>u4'),
+        ('nr_phases', '>u2'), ('dev_max_i', '>u2'),
+    ]
+
+    def __init__(self, chargers, fleet=None, recorder=None, port=502):
+        self.chargers = chargers  # handle to the correspondig chargers, by id
+        self.fleet = fleet
+        self.recorder = recorder
+        self.port = port
+        self._ids = list(chargers)
+        self._slots = {charger_id: slot for slot, charger_id in enumerate(self._ids)}
+        self._registers = bytearray(len(self._ids) * self._REGISTERS.size)
+        # _last_update of the chargers when their registers were packed
+        self._packed = array.array('d', [float("nan")]) * len(self._ids)
+        self._nr_instantiated = None
+        self.servers = []
+
+        # vectorized fleets refresh all registers with a few array operations
+        self._columns = None
+        if np is not None and hasattr(fleet, "column"):
+            self._columns = np.frombuffer(self._registers, dtype=self._REGISTER_DTYPE)
+
+    @classmethod
+    def nr_ports(cls, nr_chargers):
+        return -(-nr_chargers // cls.UNITS_PER_PORT)
+
+    def _pack(self, slot, charger):
+        cur_i = charger.cur_i
+        cur_u = charger.cur_u
+        req_max_i = charger.req_max_i
+        if req_max_i is None:
+            req_max_i = self.NO_LIMIT
+        elif not 0 <= req_max_i <= charger._DEV_MAX_I:
+            req_max_i = min(max(round(req_max_i), 0), charger._DEV_MAX_I)
+        values = (charger.state.value, req_max_i, 100 * charger.charger_current,
+                  100 * cur_i[0], 100 * cur_i[1], 100 * cur_i[2], cur_u[0], cur_u[1], cur_u[2],
+                  charger.cur_power, 1000 * charger.e_session, 1000 * charger.e_total)
+        offset = slot * self._REGISTERS.size
+        try:
+            self._REGISTERS.pack_into(self._registers, offset, *map(round, values),
+                                      charger.nr_phases, charger._DEV_MAX_I)
+        except struct.error:
+            # clamp values out of their register range
+            self._REGISTERS.pack_into(self._registers, offset, *map(_u16, values[:9]), *map(_u32, values[9:]),
+                                      charger.nr_phases, charger._DEV_MAX_I)
+        self._packed[slot] = charger._last_update
+
+    def _refresh_columns(self):
+        instantiated = self.chargers.instantiated()
+        if len(instantiated) != self._nr_instantiated:
+            self._nr_instantiated = len(instantiated)
+            self._rows = np.array([charger._index for charger in instantiated], dtype=np.intp)
+            self._row_slots = np.array([self._slots[charger._id] for charger in instantiated], dtype=np.intp)
+        rows = self._rows
+        slots = self._row_slots
+        registers = self._columns
+        column = self.fleet.column
+        registers['state'][slots] = column('state')[rows]
+        dev_max_i = column('dev_max_i')[rows]
+        req_max_i = column('req_max_i')[rows]
+        registers['req_max_i'][slots] = np.where(np.isnan(req_max_i), self.NO_LIMIT,
+                                                 np.clip(np.rint(np.nan_to_num(req_max_i)), 0, dev_max_i))
+        u16, u32 = 0xFFFF, 0xFFFFFFFF
+        registers['charger_current'][slots] = np.clip(np.rint(100 * column('charger_current')[rows]), 0, u16)
+        registers['cur_i'][slots] = np.clip(np.rint(100 * column('cur_i')[rows]), 0, u16)
+        registers['cur_u'][slots] = np.clip(np.rint(column('cur_u')[rows]), 0, u16)
+        registers['power'][slots] = np.clip(np.rint(column('cur_power')[rows]), 0, u32)
+        registers['e_session'][slots] = np.clip(np.rint(1000 * column('e_session')[rows]), 0, u32)
+        registers['e_total'][slots] = np.clip(np.rint(1000 * column('e_total')[rows]), 0, u32)
+        registers['nr_phases'][slots] = column('nr_phases')[rows]
+        registers['dev_max_i'][slots] = dev_max_i
+        np.frombuffer(self._packed, dtype=np.float64)[slots] = column('_last_update')[rows]
+
+    def on_tick(self, sim=None):
+        """Refreshes the registers of all instantiated chargers, called after each tick."""
+        if self.fleet is not None and self.fleet.samples_on_access:
+            # refreshed when read
+            return
+        if self._columns is not None:
+            self._refresh_columns()
+            return
+        for charger in self.chargers.instantiated():
+            self._pack(self._slots[charger._id], charger)
+
+    def _get_charger(self, port, unit):
+        slot = (port - self.port) * self.UNITS_PER_PORT + unit - 1
+        if not 1 <= unit <= self.UNITS_PER_PORT or slot >= len(self._ids):
+            return None, None
+        charger = self.chargers[self._ids[slot]]
+        if self.fleet is not None:
+            self.fleet.before_request(charger)
+        if self._packed[slot] != charger._last_update:
+            # instantiated or sampled since the last refresh
+            self._pack(slot, charger)
+        return slot, charger
+
+    def _set_current_limit(self, slot, charger, value):
+        if value != self.NO_LIMIT and not 0 <= value <= charger._DEV_MAX_I:
+            return False
+        charger.req_max_i = None if value == self.NO_LIMIT else value
+        logging.info("new charger current: %s", charger.req_max_i)
+        if self.recorder is not None:
+            self.recorder.record_current(charger)
+        self._pack(slot, charger)
+        return True
+
+    def _exception(self, function, code):
+        return bytes((function | 0x80, code))
+
+    def handle_pdu(self, port, unit, pdu):
+        """Returns the response PDU of a request PDU to a unit id on a port."""
+        function = pdu[0]
+        slot, charger = self._get_charger(port, unit)
+        if charger is None:
+            return self._exception(function, self.TARGET_FAILED)
+        if self.recorder is not None:
+            # fleets sampling on access draw random values
+            self.recorder.record_request(charger, "GET", "modbus", b"")
+
+        if function in (self.READ_HOLDING_REGISTERS, self.READ_INPUT_REGISTERS):
+            if len(pdu) != 5:
+                return self._exception(function, self.ILLEGAL_DATA_VALUE)
+            address, count = struct.unpack_from(">HH", pdu, 1)
+            if not 1 <= count <= self.MAX_READ_REGISTERS:
+                return self._exception(function, self.ILLEGAL_DATA_VALUE)
+            if address + count > self.NR_REGISTERS:
+                return self._exception(function, self.ILLEGAL_DATA_ADDRESS)
+            start = slot * self._REGISTERS.size + 2 * address
+            return bytes((function, 2 * count)) + self._registers[start:start + 2 * count]
+
+        if function == self.WRITE_SINGLE_REGISTER:
+            if len(pdu) != 5:
+                return self._exception(function, self.ILLEGAL_DATA_VALUE)
+            address, value = struct.unpack_from(">HH", pdu, 1)
+        elif function == self.WRITE_MULTIPLE_REGISTERS:
+            if len(pdu) < 6 or len(pdu) != 6 + pdu[5]:
+                return self._exception(function, self.ILLEGAL_DATA_VALUE)
+            address, count = struct.unpack_from(">HH", pdu, 1)
+            if count != 1 or pdu[5] != 2:
+                # only the current limit is writable
+                return self._exception(function, self.ILLEGAL_DATA_ADDRESS)
+            value, = struct.unpack_from(">H", pdu, 6)
+        else:
+            return self._exception(function, self.ILLEGAL_FUNCTION)
+        if address != self.CURRENT_LIMIT_REGISTER:
+            return self._exception(function, self.ILLEGAL_DATA_ADDRESS)
+        if not self._set_current_limit(slot, charger, value):
+            return self._exception(function, self.ILLEGAL_DATA_VALUE)
+        return pdu if function == self.WRITE_SINGLE_REGISTER else pdu[:5]
+
+    def handle_frame(self, port, frame):
+        """Returns the response frame to a complete request frame."""
+        transaction, _, _, unit = self._MBAP.unpack_from(frame)
+        start = time.perf_counter()
+        with clock.frozen():
+            response = self.handle_pdu(port, unit, frame[self._MBAP.size:])
+        metrics.observe_request("modbus", "function {}".format(frame[self._MBAP.size]),
+                                time.perf_counter() - start)
+        return self._MBAP.pack(transaction, 0, len(response) + 1, unit) + response
+
+    async def start(self, host=None):
+        loop = asyncio.get_running_loop()
+        for port_index in range(self.nr_ports(len(self._ids))):
+            port = self.port + port_index
+            server = await loop.create_server(lambda port=port: _ModbusProtocol(self, port),
+                                              host, port, reuse_address=True)
+            self.servers.append(server)
+        logging.info("serving %d chargers via Modbus TCP on %d ports", len(self._ids), len(self.servers))
+
+    def close(self):
+        for server in self.servers:
+            server.close()
+        self.servers = []
+
+
+class _ModbusProtocol(asyncio.Protocol):
+    MAX_LENGTH = 254  # of the unit id and PDU of a frame
+
+    def __init__(self, server, port):
+        self.server = server
+        self.port = port
+        self.transport = None
+        self.buffer = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        buffer = self.buffer
+        buffer += data
+        header_size = ModbusServer._MBAP.size
+        while len(buffer) >= header_size:
+            _, protocol, length, _ = ModbusServer._MBAP.unpack_from(buffer)
+            if protocol != 0 or not 2 <= length <= self.MAX_LENGTH:
+                logging.warning("malformed Modbus frame on port %d", self.port)
+                self.transport.close()
+                return
+            end = header_size - 1 + length
+            if len(buffer) < end:
+                break
+            # pipelined requests are answered in order
+            self.transport.write(self.server.handle_frame(self.port, bytes(buffer[:end])))
+            del buffer[:end]
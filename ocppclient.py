@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+# OCPP 1.6-J charge point mode: every charger connects to a central system (CSMS)
+# as <url>/<charger id> over a WebSocket, all sessions share the asyncio event loop.
+# After each tick the sessions follow their charger:
+# - StatusNotification on connector 1 when the OCPP status of the state changes
+# - StartTransaction when charging starts, StopTransaction when it ends
+# - MeterValues while charging, every METER_VALUES_INTERVAL simulated seconds
+# - Heartbeat at the interval of the BootNotification response
+# SetChargingProfile sets the current limit to the limit of the first schedule
+# period, ClearChargingProfile removes it. Schedules over time are not simulated.
+# Sessions are opened at a limited rate and reconnect with randomized backoff.
+
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import math
+import random
+import time
+from datetime import datetime, timezone
+
+import clock
+import metrics
+from charger import ChargerState
+from asyncwebsocket import connect, ConnectionClosed
+
+CALL, CALLRESULT, CALLERROR = 2, 3, 4
+
+# connector status per charger state
+OCPP_STATUS = {
+    ChargerState.IDLE: "Available",
+    ChargerState.PLUGGED_BEFORE_CHARGE: "Preparing",
+    ChargerState.CHARGING: "Charging",
+    ChargerState.STOPPED_AFTER_CHARGING: "Finishing",
+    ChargerState.UNPLUGGED_CAR: "Available",
+}
+
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class OcppSession:
+    """Connection of one charger to the central system."""
+    CALL_TIMEOUT = 30  # seconds until a call without response drops the connection
+    MAX_WRITE_BUFFER = 1 << 16  # bytes not sent yet until the connection is considered stalled
+    METER_VALUES_INTERVAL = 60  # simulated seconds
+
+    def __init__(self, clients, charger_id):
+        self.clients = clients
+        self.charger_id = charger_id
+        self.charger = None
+        self.websocket = None
+        self.accepted = False  # by the BootNotification response
+        self.queue = collections.deque()  # (action, payload or function returning it, result callback)
+        self.pending = None  # (message id, action, result callback, send time) of the call in progress
+        self.status = None  # connector status last sent
+        self.transaction_id = None
+        self.starting = False  # StartTransaction sent, no transaction id yet
+        self.heartbeat_interval = clients.DEFAULT_HEARTBEAT_INTERVAL
+        self.next_heartbeat = 0
+        self.next_boot = None
+        self.next_meter_values = 0
+
+    async def run(self):
+        with clock.frozen():
+            self.charger = self.clients.chargers[self.charger_id]
+        url = "{}/{}".format(self.clients.url.rstrip("/"), self.charger_id)
+        backoff = self.clients.MIN_BACKOFF
+        while True:
+            try:
+                self.websocket = await asyncio.wait_for(connect(url, self.clients.SUBPROTOCOL),
+                                                        self.clients.CONNECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError) as exc:
+                logging.debug("OCPP connection of charger %s failed: %s", self.charger_id, exc)
+                await asyncio.sleep(backoff * random.uniform(0.5, 1.5))
+                backoff = min(2 * backoff, self.clients.MAX_BACKOFF)
+                continue
+            backoff = self.clients.MIN_BACKOFF
+            self.clients.nr_connected += 1
+            try:
+                self._boot()
+                while True:
+                    self._handle_message(await self.websocket.recv())
+            except ConnectionClosed:
+                logging.info("OCPP connection of charger %s closed", self.charger_id)
+            except Exception:
+                # handled like a closed connection, the session reconnects after the backoff
+                logging.exception("OCPP session of charger %s failed", self.charger_id)
+            finally:
+                self.clients.nr_connected -= 1
+                self.websocket.close()
+                self.websocket = None
+                self.accepted = False
+                self.queue.clear()
+                self.pending = None
+                # a transaction without id got lost, one with id is stopped after the reconnect if due
+                self.starting = False
+            await asyncio.sleep(backoff * random.uniform(0.5, 1.5))
+
+    def _send(self, message):
+        self.websocket.send(json.dumps(message))
+        if self.websocket.get_write_buffer_size() > self.MAX_WRITE_BUFFER:
+            logging.warning("OCPP connection of charger %s stalled", self.charger_id)
+            self.websocket.close()
+
+    def _call(self, action, payload, on_result=None):
+        # calls are sent one after another, each after the response to the previous one,
+        # on_result gets the response payload or None if the call failed
+        self.queue.append((action, payload, on_result))
+        if self.pending is None:
+            self._send_next()
+
+    def _send_next(self):
+        if not self.queue or self.websocket is None or self.websocket.closed:
+            return
+        action, payload, on_result = self.queue.popleft()
+        if callable(payload):
+            # built when sent, e.g. with the transaction id of a preceding call, None to skip it
+            payload = payload()
+            if payload is None:
+                self._send_next()
+                return
+        message_id = str(next(self.clients.message_ids))
+        self.pending = (message_id, action, on_result, time.perf_counter())
+        self.next_heartbeat = time.monotonic() + self.heartbeat_interval
+        self._send([CALL, message_id, action, payload])
+
+    def _boot(self):
+        self.next_boot = None
+        self._call("BootNotification", {
+            'chargePointVendor': "embyt",
+            'chargePointModel': "chargersim " + type(self.charger).__name__,
+            'chargePointSerialNumber': str(self.charger_id),
+        }, self._on_boot)
+
+    def _on_boot(self, payload):
+        payload = payload or {}
+        self.heartbeat_interval = payload.get('interval') or self.clients.DEFAULT_HEARTBEAT_INTERVAL
+        if payload.get('status') != "Accepted":
+            # pending or rejected, retry after the interval
+            self.next_boot = time.monotonic() + self.heartbeat_interval
+            return
+        self.accepted = True
+        self.status = None
+        self._call("StatusNotification", {'connectorId': 0, 'errorCode': "NoError", 'status': "Available"})
+
+    def _handle_message(self, text):
+        try:
+            message = json.loads(text)
+            message_type, message_id = message[0], message[1]
+        except (ValueError, TypeError, IndexError, KeyError):
+            logging.warning("invalid OCPP message of charger %s: %s", self.charger_id, text[:100])
+            return
+        if message_type == CALL:
+            self._handle_call(message_id, message)
+            return
+        if self.pending is None or self.pending[0] != message_id:
+            logging.warning("unexpected OCPP response of charger %s: %s", self.charger_id, text[:100])
+            return
+        _, action, on_result, sent = self.pending
+        self.pending = None
+        metrics.observe_request("ocpp", action, time.perf_counter() - sent)
+        if message_type != CALLRESULT:
+            logging.warning("OCPP %s of charger %s failed: %s", action, self.charger_id, message[2:4])
+        if on_result is not None:
+            on_result(message[2] if message_type == CALLRESULT else None)
+        self._send_next()
+
+    def _handle_call(self, message_id, message):
+        try:
+            action, payload = message[2], message[3]
+        except IndexError:
+            self._send([CALLERROR, message_id, "FormationViolation", "", {}])
+            return
+        if not isinstance(action, str):
+            self._send([CALLERROR, message_id, "FormationViolation", "invalid action", {}])
+            return
+        handler = self._CALL_HANDLERS.get(action)
+        if handler is None:
+            self._send([CALLERROR, message_id, "NotImplemented", action, {}])
+            return
+        try:
+            with clock.frozen():
+                result = handler(self, payload)
+        except (KeyError, TypeError, IndexError, ValueError) as exc:
+            self._send([CALLERROR, message_id, "FormationViolation", str(exc), {}])
+            return
+        except Exception as exc:
+            logging.exception("OCPP %s of charger %s failed", action, self.charger_id)
+            self._send([CALLERROR, message_id, "InternalError", str(exc), {}])
+            return
+        self._send([CALLRESULT, message_id, result])
+
+    def _set_charging_profile(self, payload):
+        schedule = payload['csChargingProfiles']['chargingSchedule']
+        period = schedule['chargingSchedulePeriod'][0]
+        limit = float(period['limit'])
+        if not math.isfinite(limit):
+            raise ValueError("invalid limit: {}".format(period['limit']))
+        if schedule['chargingRateUnit'] == "W":
+            nr_phases = period.get('numberPhases', self.charger.nr_phases)
+            if not isinstance(nr_phases, int) or isinstance(nr_phases, bool) or nr_phases <= 0:
+                raise ValueError("invalid numberPhases: {}".format(nr_phases))
+            limit /= self.charger._NOMINAL_U * nr_phases
+        if limit < 0:
+            return {'status': "Rejected"}
+        self.clients.set_current(self.charger, min(int(limit), self.charger._DEV_MAX_I))
+        return {'status': "Accepted"}
+
+    def _clear_charging_profile(self, payload):
+        self.clients.set_current(self.charger, None)
+        return {'status': "Accepted"}
+
+    _CALL_HANDLERS = {
+        "SetChargingProfile": _set_charging_profile,
+        "ClearChargingProfile": _clear_charging_profile,
+    }
+
+    def _get_meter(self):
+        return round(1000 * self.charger.e_total)  # Wh
+
+    def _on_start(self, payload):
+        self.starting = False
+        self.transaction_id = payload.get('transactionId') if payload else None
+
+    def _start_transaction(self):
+        self.starting = True
+        self._call("StartTransaction", {
+            'connectorId': 1,
+            'idTag': "{:X}".format(self.charger.auth_user),
+            'meterStart': self._get_meter(),
+            'timestamp': format_time(clock.timestamp()),
+        }, self._on_start)
+        self.next_meter_values = clock.timestamp() + self.METER_VALUES_INTERVAL
+
+    def _stop_transaction(self):
+        payload = {
+            'meterStop': self._get_meter(),
+            'timestamp': format_time(clock.timestamp()),
+            'reason': "EVDisconnected",
+        }
+
+        def get_payload():
+            # the transaction id may still be outstanding when the stop is queued
+            if self.transaction_id is None:
+                return None
+            return dict(payload, transactionId=self.transaction_id)
+
+        def on_stop(result):
+            self.transaction_id = None
+        self._call("StopTransaction", get_payload, on_stop)
+
+    def _send_meter_values(self):
+        charger = self.charger
+        self.clients.access(charger)
+        values = [
+            {'value': str(self._get_meter()), 'measurand': "Energy.Active.Import.Register", 'unit': "Wh"},
+            {'value': str(round(charger.cur_power)), 'measurand': "Power.Active.Import", 'unit': "W"},
+        ]
+        for phase in range(3):
+            values.append({'value': "{:.2f}".format(charger.cur_i[phase]), 'measurand': "Current.Import",
+                           'phase': "L{}".format(phase + 1), 'unit': "A"})
+            values.append({'value': str(charger.cur_u[phase]), 'measurand': "Voltage",
+                           'phase': "L{}-N".format(phase + 1), 'unit': "V"})
+        self._call("MeterValues", {
+            'connectorId': 1,
+            'transactionId': self.transaction_id,
+            'meterValue': [{'timestamp': format_time(clock.timestamp()), 'sampledValue': values}],
+        })
+
+    def on_tick(self):
+        """Sends the messages due after a tick, called on open connections only."""
+        now = time.monotonic()
+        if self.pending is not None and time.perf_counter() - self.pending[3] > self.CALL_TIMEOUT:
+            logging.warning("OCPP %s of charger %s timed out", self.pending[1], self.charger_id)
+            self.websocket.close()
+            return
+        if not self.accepted:
+            if self.next_boot is not None and now >= self.next_boot:
+                self._boot()
+            return
+
+        state = self.charger.state
+        status = OCPP_STATUS[state]
+        if status == "Charging" and self.charger.req_max_i == 0:
+            status = "SuspendedEVSE"
+        charging = state == ChargerState.CHARGING
+        in_transaction = self.transaction_id is not None or self.starting
+        if in_transaction and not charging:
+            self._stop_transaction()
+        elif charging and not in_transaction:
+            self._start_transaction()
+        elif self.transaction_id is not None and clock.timestamp() >= self.next_meter_values:
+            self.next_meter_values = clock.timestamp() + self.METER_VALUES_INTERVAL
+            self._send_meter_values()
+        if status != self.status:
+            self.status = status
+            self._call("StatusNotification", {'connectorId': 1, 'errorCode': "NoError", 'status': status,
+                                              'timestamp': format_time(clock.timestamp())})
+        if now >= self.next_heartbeat and self.pending is None:
+            self._call("Heartbeat", {})
+
+
+class OcppClients:
+    """OCPP sessions of all chargers of the simulator."""
+    SUBPROTOCOL = "ocpp1.6"
+    CONNECT_TIMEOUT = 10  # seconds
+    MIN_BACKOFF = 1  # seconds until a failed connection is retried, doubled up to MAX_BACKOFF
+    MAX_BACKOFF = 60
+    DEFAULT_HEARTBEAT_INTERVAL = 300  # seconds
+
+    def __init__(self, chargers, url, fleet=None, recorder=None, ramp_rate=50):
+        self.chargers = chargers  # handle to the correspondig chargers, by id
+        self.url = url
+        self.fleet = fleet
+        self.recorder = recorder
+        self.ramp_rate = ramp_rate  # sessions opened per second
+        self.message_ids = itertools.count(1)
+        self.sessions = []
+        self.nr_connected = 0
+        self._tasks = []
+
+    def access(self, charger):
+        if self.fleet is not None:
+            self.fleet.before_request(charger)
+        if self.recorder is not None:
+            # fleets sampling on access draw random values
+            self.recorder.record_request(charger, "GET", "ocpp", b"")
+
+    def set_current(self, charger, current):
+        if self.fleet is not None:
+            # energy up to now is integrated with the current before the change
+            self.fleet.before_request(charger)
+        charger.req_max_i = current
+        logging.info("new charger current: %s", current)
+        if self.recorder is not None:
+            self.recorder.record_current(charger)
+
+    async def _ramp_up(self):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for index, charger_id in enumerate(self.chargers):
+            delay = start + index / self.ramp_rate - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            session = OcppSession(self, charger_id)
+            self.sessions.append(session)
+            self._tasks.append(asyncio.ensure_future(session.run()))
+        logging.info("opened OCPP sessions of %d chargers", len(self.sessions))
+
+    async def start(self):
+        logging.info("connecting chargers to OCPP central system %s", self.url)
+        self._tasks.append(asyncio.ensure_future(self._ramp_up()))
+
+    def on_tick(self, sim=None):
+        """Sends the messages due to the central system, called after each tick."""
+        with clock.frozen():
+            for session in self.sessions:
+                if session.websocket is not None:
+                    session.on_tick()
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
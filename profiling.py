@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+# Profiling of the running simulator.
+# A profiling window is started via the /profile admin endpoint or SIGUSR1 and
+# written to the profile directory when it ends:
+# - sample: a background thread samples the stacks of all threads and writes
+#   them in collapsed stack format, as used by flamegraph tools
+# - cprofile: cProfile of the main thread, i.e. the tick and, with the asyncio
+#   front-end, all requests, written in pstats format
+
+import logging
+import cProfile
+import os.path
+import sys
+import threading
+import time
+from collections import Counter
+
+import metrics
+
+
+class Profiler:
+    MODES = ("sample", "cprofile")
+    DEFAULT_SECONDS = 30
+    MAX_SECONDS = 600
+    SAMPLE_INTERVAL = 0.005  # seconds
+
+    def __init__(self, directory="."):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._mode = None  # mode of the running window
+        self._end = 0
+        self._profile = None
+        self._path = None
+
+    def start(self, seconds=DEFAULT_SECONDS, mode="sample"):
+        """Starts a profiling window, returns the path the profile will be written to."""
+        if mode not in self.MODES:
+            raise ValueError("unknown profiling mode: {}".format(mode))
+        seconds = min(max(float(seconds), 0), self.MAX_SECONDS)
+        with self._lock:
+            if self._mode is not None:
+                raise ValueError("profiling is already running until {}".format(time.ctime(self._end)))
+            self._mode = mode
+            self._end = time.time() + seconds
+            self._path = os.path.join(self.directory, "chargersim_{}.{}".format(
+                time.strftime("%Y%m%d_%H%M%S"), "collapsed" if mode == "sample" else "pstats"))
+        if mode == "sample":
+            threading.Thread(target=self._sample, name="profiler", daemon=True).start()
+        else:
+            # must be enabled and disabled by the profiled thread, this is done by poll()
+            self._profile = cProfile.Profile()
+        logging.info("profiling in %s mode for %.0f seconds to %s", mode, seconds, self._path)
+        return self._path
+
+    def poll(self):
+        """Starts and ends cProfile windows, called by the main loop."""
+        if self._profile is None:
+            return
+        if time.time() < self._end:
+            self._profile.enable()
+            return
+        self._profile.disable()
+        self._profile.dump_stats(self._path)
+        self._profile = None
+        self._finish()
+
+    def _finish(self):
+        logging.info("profile written to %s", self._path)
+        with self._lock:
+            self._mode = None
+
+    def _sample(self):
+        stacks = Counter()
+        own_thread = threading.get_ident()
+        while time.time() < self._end:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.SAMPLE_INTERVAL)
+        with open(self._path, "w") as profile_file:
+            for stack, count in stacks.items():
+                profile_file.write("{} {}\n".format(stack, count))
+        self._finish()
+
+    def handle_request(self, query):
+        """Admin endpoint, starts a window of ?seconds=<seconds>&mode=<sample|cprofile>."""
+        path = self.start(query.get("seconds", [self.DEFAULT_SECONDS])[0], query.get("mode", ["sample"])[0])
+        return "profiling to {}\n".format(path), "text/plain"
+
+
+# methods timed by enable_spans
+SPAN_METHODS = ("update_state", "handle_get_data", "handle_post_data", "_create_dump_file")
+
+
+def _timed(func, series):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            series.observe(time.perf_counter() - start)
+    wrapper.__wrapped__ = func
+    return wrapper
+
+
+def enable_spans(device_classes):
+    """Records the duration of the span methods of the given device classes in the metrics."""
+    for device_class in device_classes:
+        for name in SPAN_METHODS:
+            func = getattr(device_class, name)
+            if not hasattr(func, "__wrapped__"):
+                series = metrics.SPAN_DURATION.labels(device_class.__name__, name)
+                setattr(device_class, name, _timed(func, series))
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+# Binary log of control commands and state transitions, see replay.py.
+# The log starts with a header (magic, JSON length, JSON of the run settings),
+# followed by records of a type byte and the simulated timestamp:
+# - INIT: a charger got instantiated, with its initial data as JSON
+# - TICK: the chargers got updated
+# - ACCESS: a charger got read, only for engines sampling on access
+# - COMMAND: a control command was applied to a charger
+# - TRANSITION: a charger changed its state, with its energy counter
+# - FINAL: state and energy counters of a charger at the end of the recording
+
+import json
+import struct
+
+import clock
+from charger import FLEET_FIELDS
+from fleetconfig import DEVICE_TYPES
+
+
+MAGIC = b"CSRL"
+_HEADER = struct.Struct("<4sI")
+
+INIT, TICK, ACCESS, COMMAND, TRANSITION, FINAL = range(6)
+RECORDS = {
+    INIT: struct.Struct("<BdIBBdI"),        # id, device type, phases, session start, JSON length
+    TICK: struct.Struct("<Bd"),
+    ACCESS: struct.Struct("<BdI"),          # id
+    COMMAND: struct.Struct("<BdIBi"),       # id, command, value
+    TRANSITION: struct.Struct("<BdIBd"),    # id, state, e_total
+    FINAL: struct.Struct("<BdIBdd"),        # id, state, e_total, e_session
+}
+
+_CURRENT_BODY = "<device><id>EVCommDevice</id><current>{}</current></device>"
+
+# command: request path and body, formatted with the value
+COMMANDS = {
+    1: ("/mqtt?payload=amp={}", None),
+    2: ("/mqtt?payload=alw={}", None),
+    3: ("/services/cpi/reduceCurrent.xml", _CURRENT_BODY),
+    4: ("/services/cpi/plugCurrent.xml", _CURRENT_BODY),
+    5: ("/services/cpi/stopCharge.xml", None),
+    6: ("/services/cpi/pauseCharge.xml", None),
+    7: ("/services/cpi/startCharge.xml", None),
+}
+# command setting req_max_i directly, e.g. by the bulk API, -1 is no limit
+SET_CURRENT = 8
+# command by key of the route applying it, POST path or command name, see routes.py
+_ROUTE_COMMANDS = {path.partition("payload=")[2].partition("=")[0] or path: command
+                   for command, (path, body) in COMMANDS.items()}
+
+DEVICE_CLASSES = list(DEVICE_TYPES.values())
+
+
+def parse_commands(url_path, body, charger):
+    """Returns the commands and values of a control request, as parsed by the routes of the charger.
+
+    Raises ValueError for an applied command without a command id.
+    """
+    commands = []
+    for key, value in charger.parse_post_data(url_path, body):
+        command = _ROUTE_COMMANDS.get(key)
+        if command is None:
+            raise ValueError("command cannot be recorded: {}".format(key))
+        commands.append((command, value if value is not None else 0))
+    return commands
+
+
+def get_fields(charger):
+    """Exact data of a charger to create it again, not rounded like the data dump."""
+    fields = {name: getattr(charger, name) for name in FLEET_FIELDS}
+    fields['state'] = fields['state'].value
+    return fields
+
+
+class Recorder:
+    """Appends the control traffic and the state transitions of a simulation to a binary log."""
+
+    def __init__(self, path, seed, stream=(), engine="python"):
+        self._file = open(path, "wb")
+        # the event engine samples measurements when a charger is read
+        self.record_accesses = engine == "event"
+        settings = json.dumps({'seed': seed, 'stream': list(stream), 'engine': engine,
+                               'start': clock.timestamp()}).encode()
+        self._file.write(_HEADER.pack(MAGIC, len(settings)) + settings)
+
+    def _pack(self, record_type, *values):
+        return RECORDS[record_type].pack(record_type, clock.timestamp(), *values)
+
+    def _write(self, record_type, *values):
+        self._file.write(self._pack(record_type, *values))
+
+    def record_init(self, charger):
+        data = json.dumps(get_fields(charger)).encode()
+        self._write(INIT, charger._id, DEVICE_CLASSES.index(type(charger)), charger.nr_phases,
+                    charger._session_start, len(data))
+        self._file.write(data)
+
+    def record_tick(self):
+        self._write(TICK)
+        # keep the log complete up to the last tick in case the simulation gets killed
+        self._file.flush()
+
+    def encode_request(self, charger, method, path, body):
+        """Returns the records of a request, to be written after it got handled.
+
+        The front-ends encode a request before handling it, so a command the log
+        cannot represent raises ValueError instead of being applied unrecorded.
+        """
+        if method in ("POST", "PUT"):
+            try:
+                return b"".join(self._pack(COMMAND, charger._id, *command)
+                                for command in parse_commands(path, body, charger))
+            except struct.error:
+                raise ValueError("command value out of range")
+        if self.record_accesses:
+            return self._pack(ACCESS, charger._id)
+        return b""
+
+    def write(self, records):
+        self._file.write(records)
+
+    def record_request(self, charger, method, path, body):
+        self.write(self.encode_request(charger, method, path, body))
+
+    def record_current(self, charger):
+        req_max_i = charger.req_max_i
+        self._write(COMMAND, charger._id, SET_CURRENT, req_max_i if req_max_i is not None else -1)
+
+    def record_transition(self, charger):
+        self._write(TRANSITION, charger._id, charger.state.value, charger.e_total)
+
+    def close(self, chargers):
+        """Records the final data of the given chargers and closes the log."""
+        for charger in chargers:
+            self._write(FINAL, charger._id, charger.state.value, charger.e_total, charger.e_session)
+        self._file.close()
+
+
+def read_log(path):
+    """Yields the header settings, then the records as tuples of type, timestamp, values."""
+    with open(path, "rb") as log:
+        magic, length = _HEADER.unpack(log.read(_HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("not a chargersim recording: {}".format(path))
+        yield json.loads(log.read(length))
+        while True:
+            record_type = log.read(1)
+            if not record_type:
+                break
+            record = RECORDS[record_type[0]]
+            data = record_type + log.read(record.size - 1)
+            if len(data) < record.size:
+                break  # truncated by a killed simulation
+            values = record.unpack(data)
+            if values[0] == INIT:
+                data = log.read(values[-1])
+                if len(data) < values[-1]:
+                    break
+                values += (json.loads(data),)
+            yield values
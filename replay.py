@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+# Replay of a recording of chargersim.py --record.
+# The recorded chargers, ticks and control commands are run through the charger
+# state machine as fast as possible, with the recorded seed and simulated time.
+# The resulting state transitions and energy counters are verified against the
+# recorded ones. Recordings of --fast runs are repeated exactly, with a real time
+# clock the chargers of a tick read slightly different times, use a tolerance.
+
+import logging
+import traceback
+import argparse
+import collections
+import sys
+import time
+
+import clock
+import rng
+from charger import Charger, ChargerState, format_timestamp
+from fleet import ENGINES
+from recorder import read_log, COMMANDS, SET_CURRENT, DEVICE_CLASSES, INIT, TICK, ACCESS, COMMAND, TRANSITION, FINAL
+
+
+class Replayer:
+    MAX_REPORTED = 10  # mismatches logged in detail
+
+    def __init__(self, path, tolerance=0):
+        self.path = path
+        self.tolerance = tolerance  # relative deviation accepted for energy counters
+        self.counts = collections.Counter()
+        self.mismatches = 0
+        self._transitions = collections.deque()  # replayed transitions not verified yet
+
+    def record_transition(self, charger):
+        # called by the chargers like the recorder
+        self._transitions.append((charger._id, charger.state.value, charger.e_total))
+
+    def _matches(self, value, expected):
+        return abs(value - expected) <= self.tolerance * max(abs(expected), 1)
+
+    def _mismatch(self, timestamp, message, *args):
+        self.mismatches += 1
+        if self.mismatches <= self.MAX_REPORTED:
+            logging.warning("%s: " + message, format_timestamp(timestamp), *args)
+
+    def _create_charger(self, charger_id, device, phases, session_start, fields):
+        # created without id, so no dump files get read or written
+        charger = DEVICE_CLASSES[device](session_start, phases)
+        charger._id = charger_id
+        for name, value in fields.items():
+            setattr(charger, name, ChargerState(value) if name == 'state' else value)
+        self.fleet.add(charger)
+        self.chargers[charger_id] = charger
+
+    def _verify_transition(self, timestamp, charger_id, state, e_total):
+        if not self._transitions:
+            self._mismatch(timestamp, "charger %d: missing transition to %s", charger_id, ChargerState(state).name)
+            return
+        replayed = self._transitions.popleft()
+        if replayed[:2] != (charger_id, state) or not self._matches(replayed[2], e_total):
+            self._mismatch(timestamp, "expected charger %d in %s with %.6f kWh, got charger %d in %s with %.6f kWh",
+                           charger_id, ChargerState(state).name, e_total,
+                           replayed[0], ChargerState(replayed[1]).name, replayed[2])
+
+    def _verify_final(self, timestamp, charger_id, state, e_total, e_session):
+        charger = self.chargers.get(charger_id)
+        if charger is None:
+            self._mismatch(timestamp, "charger %d was never created", charger_id)
+        elif charger.state.value != state or not self._matches(charger.e_total, e_total) \
+                or not self._matches(charger.e_session, e_session):
+            self._mismatch(timestamp, "expected charger %d to end in %s with %.6f/%.6f kWh, got %s with %.6f/%.6f kWh",
+                           charger_id, ChargerState(state).name, e_total, e_session,
+                           charger.state.name, charger.e_total, charger.e_session)
+
+    def run(self):
+        records = read_log(self.path)
+        settings = next(records)
+        rng.set_seed(settings['seed'], *settings['stream'])
+        self.clock = clock.SteppedClock()
+        self.clock.set_timestamp(settings['start'])
+        clock.set_clock(self.clock)
+        self.fleet = ENGINES[settings['engine']]()
+        self.chargers = {}
+        Charger._recorder = self
+
+        for record_type, timestamp, *values in records:
+            self.counts[record_type] += 1
+            self.clock.set_timestamp(timestamp)
+            if record_type == TICK:
+                self.fleet.tick()
+            elif record_type == INIT:
+                self._create_charger(values[0], values[1], values[2], values[3], values[5])
+            elif record_type == ACCESS:
+                self.fleet.before_request(self.chargers[values[0]])
+            elif record_type == COMMAND:
+                charger = self.chargers[values[0]]
+                self.fleet.before_request(charger)
+                if values[1] == SET_CURRENT:
+                    charger.req_max_i = values[2] if values[2] >= 0 else None
+                else:
+                    path, body = COMMANDS[values[1]]
+                    charger.handle_post_data(path.format(values[2]), (body or "").format(values[2]).encode())
+            elif record_type == TRANSITION:
+                self._verify_transition(timestamp, *values)
+            elif record_type == FINAL:
+                self._verify_final(timestamp, *values)
+        if not self.counts[FINAL]:
+            # a killed simulation only flushed the log up to the start of its last tick
+            logging.warning("recording ends without final data, its last tick is not verified")
+            self._transitions.clear()
+        for charger_id, state, e_total in self._transitions:
+            self._mismatch(self.clock.timestamp(), "unexpected transition of charger %d to %s",
+                           charger_id, ChargerState(state).name)
+        Charger._recorder = None
+        return self.mismatches == 0
+
+
+def main():
+    try:
+        parser = argparse.ArgumentParser(description="Replays and verifies a recording of chargersim.py --record.")
+        parser.add_argument("--tolerance", type=float, default=0,
+                            help="accepted relative deviation of the energy counters, default is exact")
+        parser.add_argument("log", help="recording to replay")
+        args = parser.parse_args()
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+        replayer = Replayer(args.log, args.tolerance)
+        start = time.perf_counter()
+        # the chargers log each command
+        logging.disable(logging.INFO)
+        success = replayer.run()
+        logging.disable(logging.NOTSET)
+        logging.info("replayed %d ticks, %d commands, %d accesses and %d transitions of %d chargers in %.1f s",
+                     replayer.counts[TICK], replayer.counts[COMMAND], replayer.counts[ACCESS],
+                     replayer.counts[TRANSITION], replayer.counts[INIT], time.perf_counter() - start)
+        if not success:
+            logging.error("%d mismatches", replayer.mismatches)
+            sys.exit(1)
+        logging.info("all transitions and final counters match")
+    except Exception:
+        logging.error("raised exception: {}".format(traceback.format_exc()))
+        raise
+
+
+if __name__ == '__main__':
+    main()
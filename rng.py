@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+# Seedable random number streams.
+# Without a seed the streams are seeded randomly. With a seed
+# - per charger streams, see derive(), make the initial charger data independent
+#   of the order of instantiation and of the split into shards
+# - the noise stream of the process, keyed by the seed and the shard, provides
+#   the measurement noise and state timing in bulk blocks
+# so a run with the same seed and shards is repeated bit for bit.
+# Requests from external clients change the order of draws and are not repeatable.
+
+import random
+
+try:
+    import numpy as np
+except ImportError:  # blocks are drawn by the random module
+    np = None
+
+
+class NoiseStream:
+    """Standard normal values drawn from one seeded stream in blocks."""
+    BLOCK_SIZE = 4096
+
+    def __init__(self, key=None):
+        if np is not None:
+            self._generator = np.random.default_rng(key)
+        else:
+            self._generator = random.Random("-".join(map(str, key)) if key is not None else None)
+        self._block = []
+        self._pos = 0
+
+    def _refill(self):
+        if np is not None:
+            self._block = self._generator.standard_normal(self.BLOCK_SIZE).tolist()
+        else:
+            gauss = self._generator.gauss
+            self._block = [gauss(0, 1) for _ in range(self.BLOCK_SIZE)]
+        self._pos = 0
+
+    def gauss(self, mu, sigma):
+        if self._pos == len(self._block):
+            self._refill()
+        value = self._block[self._pos]
+        self._pos += 1
+        return mu + sigma * value
+
+
+# keys of the numpy streams of a process
+NOISE_STREAM = 0
+FLEET_STREAM = 1
+
+_seed = None
+_stream = ()  # keys of the streams of this process, e.g. the shard
+_noise = NoiseStream()
+_random = random.Random()
+
+
+def set_seed(seed, *stream):
+    """Seeds all streams, the noise stream of the process additionally by the given keys."""
+    global _seed, _stream, _noise, _random
+    _seed = seed
+    _stream = stream
+    _noise = NoiseStream(seed_key(NOISE_STREAM))
+    _random = random.Random("-".join(map(str, seed_key()))) if seed is not None else random.Random()
+
+
+def seed_key(*keys):
+    """Seed of a numpy stream of this process, None if no seed is set."""
+    if _seed is None:
+        return None
+    return [_seed, *_stream, *keys]
+
+
+def derive(*keys):
+    """Random generator seeded by the seed and the given keys only."""
+    if _seed is None:
+        return _random
+    return random.Random("-".join(map(str, (_seed,) + keys)))
+
+
+def get_noise():
+    return _noise
+
+
+def get_random():
+    """Random generator of this process, seeded like the noise stream."""
+    return _random
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+# Declarative request routes of the device classes.
+# Device classes mark their handlers with @get(path), @post(path) or @command(name).
+# When a class is created, its routes and the ones of its base classes are collected
+# into one dict per kind, so a request is dispatched by a single lookup:
+# - GET handlers are called with the parsed query
+# - POST handlers with the parsed query and the request body
+# - command handlers with the value of a "<name>=<value>" command, e.g. of go-e MQTT payloads
+# POST routes and commands may declare a parse step, so the commands a request applies
+# are known without applying them, e.g. to record them, see Charger.parse_post_data:
+# - of POST routes, called with the path, the parsed query and the request body,
+#   returning the applied commands as (key, value) pairs, key being the path or a command name
+# - of commands, called with the value text, returning the parsed value, ValueError if invalid
+
+from urllib.parse import parse_qs
+
+GET, POST, COMMAND = "GET", "POST", "COMMAND"
+
+
+class Route:
+    __slots__ = ('kind', 'key', 'handler', 'versioned', 'parse')
+
+    def __init__(self, kind, key, handler, versioned=False, parse=None):
+        self.kind = kind
+        self.key = key  # path, or name of a command
+        self.handler = handler
+        self.versioned = versioned  # response only changes with the entity tag of the charger
+        self.parse = parse  # see above, None if the route applies one command without value
+
+
+def _register(kind, key, versioned=False, parse=None):
+    def decorator(handler):
+        handler._route = Route(kind, key, handler, versioned, parse)
+        return handler
+    return decorator
+
+
+def get(path, versioned=False):
+    return _register(GET, path, versioned)
+
+
+def post(path, parse=None):
+    return _register(POST, path, parse=parse)
+
+
+def command(name, parse=None):
+    return _register(COMMAND, name, parse=parse)
+
+
+def collect(cls):
+    """Routes of a class and its base classes by kind and key, subclasses override their bases."""
+    routes = {GET: {}, POST: {}, COMMAND: {}}
+    for base in reversed(cls.__mro__):
+        for value in vars(base).values():
+            route = getattr(value, "_route", None)
+            if isinstance(route, Route):
+                routes[route.kind][route.key] = route
+    return routes
+
+
+def split_path(url_path):
+    """Path and parsed query of a request path."""
+    path, _, query = url_path.partition("?")
+    return path, parse_qs(query) if query else {}
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+# Multi-process simulation.
+# The fleet is split into shards, each simulated by its own worker process with its
+# own event loop and tick. The workers publish their totals to shared memory.
+
+import collections
+import logging
+import traceback
+import multiprocessing
+import signal
+import time
+
+from chargersim import ChargerSim, START_PORT, create_arg_parser, configure
+from modbusserver import ModbusServer
+
+
+class ShardStats:
+    """Per shard totals in shared memory, written by the workers after each tick."""
+    FIELDS = ('heartbeat', 'ticks', 'chargers', 'power', 'i_l1', 'i_l2', 'i_l3', 'e_total')
+
+    def __init__(self, nr_shards):
+        self.nr_shards = nr_shards
+        self._values = multiprocessing.RawArray('d', nr_shards * len(self.FIELDS))
+
+    def write(self, shard, sim):
+        offset = shard * len(self.FIELDS)
+        values = self._values
+        values[offset + 1] += 1
+        values[offset + 2] = len(sim.chargers.instantiated())
+        values[offset + 3:offset + 8] = sim.fleet.aggregate()
+        values[offset] = time.time()
+
+    def clear(self, shard):
+        offset = shard * len(self.FIELDS)
+        self._values[offset:offset + len(self.FIELDS)] = [0] * len(self.FIELDS)
+        self._values[offset] = time.time()
+
+    def read(self, shard):
+        offset = shard * len(self.FIELDS)
+        return dict(zip(self.FIELDS, self._values[offset:offset + len(self.FIELDS)]))
+
+    def totals(self):
+        """Sum of all shards, except the heartbeat which is the oldest one."""
+        shards = [self.read(shard) for shard in range(self.nr_shards)]
+        result = {field: sum(cur_shard[field] for cur_shard in shards) for field in self.FIELDS}
+        result['heartbeat'] = min(cur_shard['heartbeat'] for cur_shard in shards)
+        return result
+
+
+def _run_worker(shard, nr_shards, stats, args):
+    # the supervisor handles keyboard interrupts and terminates the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        sim_args = configure(args)
+        if sim_args['mux_port'] is not None:
+            # every shard gets its own multiplexed port
+            sim_args = dict(sim_args, mux_port=sim_args['mux_port'] + shard)
+        if sim_args['modbus_port'] is not None:
+            # every shard gets its own block of Modbus ports
+            sizes = collections.Counter((charger_id - START_PORT) % nr_shards
+                                        for charger_id in sim_args['fleet_config'].ids())
+            nr_ports = ModbusServer.nr_ports(max(sizes.values()))
+            sim_args = dict(sim_args, modbus_port=sim_args['modbus_port'] + shard * nr_ports)
+        sim = ChargerSim(shard=(shard, nr_shards), **sim_args)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sim.stop())
+        sim.tick_listeners.append(lambda sim: stats.write(shard, sim))
+        logging.info("shard %d simulates %d chargers", shard, len(sim.chargers))
+        sim.run()
+    except Exception:
+        logging.error("shard %d raised exception: %s", shard, traceback.format_exc())
+        raise
+
+
+class ShardSupervisor:
+    MONITOR_INTERVAL = 1     # seconds
+    STATUS_INTERVAL = 10     # seconds between logging fleet totals
+    HEARTBEAT_TIMEOUT = 30   # seconds without tick until a worker is restarted
+    SHUTDOWN_TIMEOUT = 10    # seconds
+
+    def __init__(self, nr_shards, args):
+        self.nr_shards = nr_shards
+        self.args = args  # command line arguments, the workers set up their simulation from
+        self.stats = ShardStats(nr_shards)
+        self.workers = [None] * nr_shards
+
+    def _start_worker(self, shard):
+        worker = multiprocessing.Process(target=_run_worker, name="shard-{}".format(shard),
+                                         args=(shard, self.nr_shards, self.stats, self.args))
+        self.stats.clear(shard)
+        worker.start()
+        self.workers[shard] = worker
+
+    def _check_workers(self):
+        now = time.time()
+        for shard, worker in enumerate(self.workers):
+            if not worker.is_alive():
+                logging.error("shard %d exited with code %s, restarting", shard, worker.exitcode)
+            elif now - self.stats.read(shard)['heartbeat'] > self.HEARTBEAT_TIMEOUT:
+                logging.error("shard %d stalled, restarting", shard)
+                worker.kill()
+                worker.join()
+            else:
+                continue
+            self._start_worker(shard)
+
+    def run(self):
+        for shard in range(self.nr_shards):
+            self._start_worker(shard)
+        try:
+            last_status = time.monotonic()
+            while True:
+                time.sleep(self.MONITOR_INTERVAL)
+                self._check_workers()
+                if time.monotonic() - last_status >= self.STATUS_INTERVAL:
+                    last_status = time.monotonic()
+                    totals = self.stats.totals()
+                    logging.info("fleet of %d chargers: %.0f W, %.1f/%.1f/%.1f A, %.1f kWh",
+                                 totals['chargers'], totals['power'],
+                                 totals['i_l1'], totals['i_l2'], totals['i_l3'], totals['e_total'])
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        for worker in self.workers:
+            if worker is not None and worker.is_alive():
+                worker.terminate()
+        deadline = time.monotonic() + self.SHUTDOWN_TIMEOUT
+        for worker in self.workers:
+            if worker is not None:
+                worker.join(max(deadline - time.monotonic(), 0))
+                if worker.is_alive():
+                    logging.warning("killing %s", worker.name)
+                    worker.kill()
+                    worker.join()
+
+
+def main():
+    try:
+        parser = create_arg_parser()
+        parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                            help="number of worker processes")
+        args = parser.parse_args()
+        configure(args)
+
+        supervisor = ShardSupervisor(args.workers, args)
+        supervisor.run()
+    except KeyboardInterrupt:
+        pass
+    except Exception as exc:
+        logging.error("raised exception: {}".format(traceback.format_exc()))
+        raise
+
+
+if __name__ == '__main__':
+    main()
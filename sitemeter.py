@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+# Site meter: running totals of power, phase currents and energy of the chargers.
+# Chargers are grouped by the "meter" setting of their fleet group, the site is
+# the sum of all groups. The totals are maintained as the chargers change:
+# - chargers on their own add the change of their measurements and energy to
+#   the totals of their group, see Charger._meter
+# - vectorized fleets sum up their columns per group in their batched tick
+# A meter reading thus does not depend on the number of chargers.
+# With the event engine, the totals follow the state transitions and the reads
+# of the chargers, like their measurements.
+
+import json
+
+try:
+    import numpy as np
+except ImportError:  # only required for the vectorized fleet engine
+    np = None
+
+import clock
+from charger import format_timestamp
+
+
+class MeterTotals:
+    __slots__ = ('name', 'index', 'nr_chargers', 'power', 'i_l1', 'i_l2', 'i_l3', 'e_total')
+
+    def __init__(self, name, index):
+        self.name = name
+        self.index = index
+        self.nr_chargers = 0
+        self.power = self.i_l1 = self.i_l2 = self.i_l3 = 0  # W, A
+        self.e_total = 0  # kWh
+
+    def add(self, power, cur_i):
+        self.power += power
+        self.i_l1 += cur_i[0]
+        self.i_l2 += cur_i[1]
+        self.i_l3 += cur_i[2]
+
+    def remove(self, power, cur_i):
+        self.power -= power
+        self.i_l1 -= cur_i[0]
+        self.i_l2 -= cur_i[1]
+        self.i_l3 -= cur_i[2]
+
+
+class SiteMeter:
+    DEFAULT_GROUP = "site"
+    FRONIUS_PATH = "/solar_api/v1/GetMeterRealtimeData.cgi"
+
+    def __init__(self, groups=()):
+        self.groups = {}
+        for name in groups:
+            self._get_totals(name or self.DEFAULT_GROUP)
+
+    def _get_totals(self, name):
+        totals = self.groups.get(name)
+        if totals is None:
+            totals = self.groups[name] = MeterTotals(name, len(self.groups))
+        return totals
+
+    def attach(self, charger, group=None):
+        """Adds a charger to the totals of the given meter group."""
+        totals = self._get_totals(group or self.DEFAULT_GROUP)
+        totals.nr_chargers += 1
+        totals.add(charger.cur_power, charger.cur_i)
+        totals.e_total += charger.e_total
+        if charger._fleet is not None:
+            charger._fleet.set_meter_group(charger._index, self, totals.index)
+        else:
+            charger._meter = totals
+
+    def set_column_totals(self, groups, power, cur_i, e_total):
+        """Sets the totals of all groups from the columns of a vectorized fleet."""
+        size = len(self.groups)
+        power = np.bincount(groups, power, size)
+        i_l1 = np.bincount(groups, cur_i[:, 0], size)
+        i_l2 = np.bincount(groups, cur_i[:, 1], size)
+        i_l3 = np.bincount(groups, cur_i[:, 2], size)
+        e_total = np.bincount(groups, e_total, size)
+        for totals in self.groups.values():
+            index = totals.index
+            totals.power = power[index].item()
+            totals.i_l1 = i_l1[index].item()
+            totals.i_l2 = i_l2[index].item()
+            totals.i_l3 = i_l3[index].item()
+            totals.e_total = e_total[index].item()
+
+    def read(self, group=None):
+        """Totals of a meter group or of the whole site."""
+        if group is None:
+            groups = self.groups.values()
+        elif group in self.groups:
+            groups = [self.groups[group]]
+        else:
+            raise ValueError("unknown meter group: {}".format(group))
+        return {
+            'timestamp': format_timestamp(clock.timestamp()),
+            'chargers': sum(totals.nr_chargers for totals in groups),
+            # incremental updates leave rounding residues, e.g. of chargers stopped
+            'power': round(sum(totals.power for totals in groups), 3),
+            'i_l1': round(sum(totals.i_l1 for totals in groups), 3),
+            'i_l2': round(sum(totals.i_l2 for totals in groups), 3),
+            'i_l3': round(sum(totals.i_l3 for totals in groups), 3),
+            'e_total': round(sum(totals.e_total for totals in groups), 6),
+        }
+
+    @staticmethod
+    def _format_fronius(reading):
+        # realtime data of a Fronius Smart Meter, as read by many energy managers
+        return {
+            'Head': {'Timestamp': reading['timestamp'], 'Status': {'Code': 0}},
+            'Body': {'Data': {
+                'PowerReal_P_Sum': reading['power'],
+                'Current_AC_Phase_1': reading['i_l1'],
+                'Current_AC_Phase_2': reading['i_l2'],
+                'Current_AC_Phase_3': reading['i_l3'],
+                'EnergyReal_WAC_Sum_Consumed': round(1000 * reading['e_total'], 3),
+            }},
+        }
+
+    def handle_request(self, query):
+        """Admin endpoint, totals of ?group=<group> or of the site, ?format=fronius for a Fronius meter."""
+        reading = self.read(query.get("group", [None])[0])
+        if query.get("format", [None])[0] == "fronius":
+            reading = self._format_fronius(reading)
+        return json.dumps(reading), "application/json"
+
+    def handle_fronius_request(self, query):
+        """Admin endpoint at the path of the Fronius Solar API."""
+        return json.dumps(self._format_fronius(self.read())), "application/json"
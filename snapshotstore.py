@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+import logging
+import json
+import sqlite3
+import time
+
+from charger import Charger
+import metrics
+
+
+class SnapshotStore:
+    """Data dumps of the whole fleet in a single SQLite database.
+
+    Chargers only get marked dirty on state transitions, all dirty chargers are
+    written in one transaction by checkpoint() and the fleet is restored by one query.
+    """
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS chargers (id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+        self._dirty = {}  # dirty chargers by id
+
+    def mark_dirty(self, charger):
+        self._dirty[charger._id] = charger
+
+    def load_all(self):
+        """Returns the data dumps of all stored chargers by id."""
+        return {charger_id: json.loads(data)
+                for charger_id, data in self._db.execute("SELECT id, data FROM chargers")}
+
+    def checkpoint(self):
+        if not self._dirty:
+            return
+        start = time.perf_counter()
+        rows = [(charger_id, json.dumps(charger._get_dump_data(), default=Charger._serialize))
+                for charger_id, charger in self._dirty.items()]
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO chargers (id, data) VALUES (?, ?)", rows)
+        self._dirty = {}
+        duration = time.perf_counter() - start
+        metrics.PERSISTENCE_WRITE.labels("sqlite").observe(duration)
+        logging.debug("checkpointed %d chargers in %.1f ms", len(rows), 1000 * duration)
+
+    def close(self):
+        self.checkpoint()
+        self._db.close()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 embyt GmbH. All rights reserved.
+# Author: Roman Morawek <rmorawek@embyt.com>
+
+# Push of charger changes as Server-Sent Events, served by the asyncio front-end.
+# GET /subscribe[?ids=8100-8119&device=goe] on a multiplexed port streams
+# - a "snapshot" event with all fields of the subscribed chargers
+# - an "update" event after each tick with the fields changed since the last event
+# Values are rounded to the resolution of the device protocols, so measurement
+# noise below it is not pushed. A slow client only delays its own stream: the
+# changes for it are merged per charger until it reads on, and its stream ends
+# with an "overflow" event if too many chargers are pending.
+
+import asyncio
+import json
+from collections import Counter
+
+import clock
+from bulkapi import parse_ids
+from charger import format_timestamp
+from fleetconfig import DEVICE_TYPES
+
+
+def get_fields(charger):
+    cur_i = charger.cur_i
+    return {
+        'state': charger.state.name,
+        'req_max_i': charger.req_max_i,
+        'charger_current': charger.charger_current,
+        'cur_power': round(charger.cur_power, 1),
+        'cur_i': [round(cur_i[0], 2), round(cur_i[1], 2), round(cur_i[2], 2)],
+        'e_session': round(charger.e_session, 4),
+        'e_total': round(charger.e_total, 4),
+    }
+
+
+class Subscription:
+    # chargers with changes not sent yet, changes are merged so this also bounds large subscriptions
+    MAX_PENDING = 100000
+
+    def __init__(self, ids=None, device_classes=None):
+        self.ids = ids
+        self.device_classes = device_classes
+        self.pending = {}  # changed fields by charger id, merged until sent
+        self.overflow = False
+        self.wakeup = asyncio.Event()
+
+    def matches(self, charger):
+        return (self.ids is None or charger._id in self.ids) and \
+            (self.device_classes is None or isinstance(charger, self.device_classes))
+
+    def push(self, charger_id, changes):
+        pending = self.pending.get(charger_id)
+        if pending is not None:
+            pending.update(changes)
+        elif len(self.pending) < self.MAX_PENDING:
+            self.pending[charger_id] = dict(changes)
+        else:
+            self.overflow = True
+            self.pending = {}
+        self.wakeup.set()
+
+
+class ChangeHub:
+    MAX_SUBSCRIPTIONS = 100
+    KEEP_ALIVE = 15  # seconds without changes until a comment is sent to detect closed connections
+
+    def __init__(self, chargers):
+        self.chargers = chargers  # handle to the correspondig chargers, by id
+        self.subscriptions = []
+        self._fields = {}  # fields of the subscribed chargers as last pushed, by id
+        # union of the ids of the subscriptions, kept up to date on subscribe and unsubscribe
+        self._ids = Counter()  # number of subscriptions by id
+        self._nr_unrestricted = 0  # subscriptions to all chargers
+
+    def _subscribe(self, subscription):
+        self.subscriptions.append(subscription)
+        if subscription.ids is None:
+            self._nr_unrestricted += 1
+        else:
+            self._ids.update(subscription.ids)
+
+    def _unsubscribe(self, subscription):
+        self.subscriptions.remove(subscription)
+        if subscription.ids is None:
+            self._nr_unrestricted -= 1
+        else:
+            self._ids.subtract(subscription.ids)
+            self._ids += Counter()  # drops the ids without subscriptions
+        if not self.subscriptions:
+            self._fields = {}
+
+    def _get_subscribed(self):
+        if self._nr_unrestricted:
+            return self.chargers.instantiated()
+        return [self.chargers[charger_id] for charger_id in self._ids]
+
+    def on_tick(self, sim=None):
+        """Pushes the changes of the tick to the subscriptions, called after each tick."""
+        if not self.subscriptions:
+            return
+        last_fields = self._fields
+        for charger in self._get_subscribed():
+            fields = get_fields(charger)
+            last = last_fields.get(charger._id)
+            if last is None:
+                changes = fields
+            else:
+                changes = {name: value for name, value in fields.items() if value != last[name]}
+                if not changes:
+                    continue
+            last_fields[charger._id] = fields
+            for subscription in self.subscriptions:
+                if subscription.matches(charger):
+                    subscription.push(charger._id, changes)
+
+    @staticmethod
+    def _format_event(event, data):
+        return "event: {}\ndata: {}\n\n".format(event, json.dumps(data)).encode("utf8")
+
+    async def _stream(self, subscription, chargers):
+        # subscribed by handle_request already, the front-end starts the stream right away
+        try:
+            snapshot = {}
+            for charger in chargers:
+                fields = snapshot[charger._id] = get_fields(charger)
+                # changes since the last tick are still pushed to the other subscriptions
+                self._fields.setdefault(charger._id, fields)
+            yield self._format_event("snapshot", {'timestamp': format_timestamp(clock.timestamp()),
+                                                  'chargers': snapshot})
+            while True:
+                try:
+                    await asyncio.wait_for(subscription.wakeup.wait(), self.KEEP_ALIVE)
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+                    continue
+                subscription.wakeup.clear()
+                if subscription.overflow:
+                    yield self._format_event("overflow", {'max_pending': subscription.MAX_PENDING})
+                    return
+                pending, subscription.pending = subscription.pending, {}
+                yield self._format_event("update", {'timestamp': format_timestamp(clock.timestamp()),
+                                                    'chargers': pending})
+        finally:
+            self._unsubscribe(subscription)
+
+    def handle_request(self, query):
+        """Admin endpoint, event stream of the ?ids=<id>[-<id>],... and ?device=<type>,... chargers."""
+        if len(self.subscriptions) >= self.MAX_SUBSCRIPTIONS:
+            raise ValueError("too many subscriptions")
+        device_classes = None
+        if "device" in query:
+            names = query["device"][0].split(",")
+            unknown = [name for name in names if name not in DEVICE_TYPES]
+            if unknown:
+                raise ValueError("unknown device types: {}".format(", ".join(unknown)))
+            device_classes = tuple(DEVICE_TYPES[name] for name in names)
+        ids = None
+        if "ids" in query:
+            # resolved against the fleet once, so a tick only visits the subscribed chargers
+            config = self.chargers.config
+            ids = {charger_id for charger_id in parse_ids(query["ids"][0], config) if charger_id in self.chargers and
+                   (device_classes is None or issubclass(config.get_group(charger_id).device_class, device_classes))}
+
+        subscription = Subscription(ids, device_classes)
+        if ids is None:
+            chargers = [charger for charger in self.chargers.instantiated() if subscription.matches(charger)]
+        else:
+            chargers = [self.chargers[charger_id] for charger_id in ids]
+        # subscribed in the same step as the limit check, so concurrent requests cannot exceed it
+        self._subscribe(subscription)
+        return self._stream(subscription, chargers), "text/event-stream"